@@ -3,24 +3,329 @@
 # ---------------------------------------------------------------------------- #
 import os
 import time
-from datetime import datetime
+import argparse
+from typing import Optional
 import shutil
 import pandas as pd
 
 # ---------------------------------------------------------------------------- #
 #                                 Import Class                                 #
 # ---------------------------------------------------------------------------- #
-from class_calval import FLEX, S2
+from class_calval import FLEX, S2, LogRecord
+from planner import Planner
+from band_share import BandShare
+from time_series import TimeSeries
+
+# ---------------------------------------------------------------------------- #
+#                                 User Settings                                #
+# ---------------------------------------------------------------------------- #
+# Propagate FLOX uncertainties and S2 reflectance noise through the transfer functions by Monte Carlo
+BOOL_UNCERTAINTY = False
+# Number of Monte Carlo samples per job
+NUM_UNCERTAINTY_SAMPLES = 1000
+# Relative noise (1 sigma) of S2 L2A reflectances
+S2_REFLECTANCE_NOISE = 0.05
+# Add bootstrap confidence intervals to the validation reports
+BOOL_BOOTSTRAP = False
+# Number of bootstrap resamples
+NUM_BOOTSTRAP = 2000
+# Confidence level of the bootstrap intervals
+BOOTSTRAP_CONFIDENCE = 0.95
+# Format of the log, full spectrum and matchup tables: "csv" or "parquet" (partitioned by site and year, needs pyarrow)
+OUTPUT_FORMAT = "csv"
+# Resume an interrupted run from the job journal in the cache folder, skipping the jobs already done (the journal is cleared when a run finishes)
+BOOL_RESUME = True
+# Maximum number of attempts of a failed job across runs
+MAX_JOB_ATTEMPTS = 3
+# Number of sites scanned at the same time by the preflight check
+NUM_PREFLIGHT_WORKERS = 8
+# Process the full-tile S2 rasters in row strips, keeping the peak memory within the budget below
+BOOL_STRIP_PROCESSING = False
+# Memory budget of the strip processing, in MB
+MEMORY_BUDGET_MB = 256
+# Floating point precision of the S2 indices: "float32" or "float64"
+S2_PRECISION = "float32"
+# Convert the S2 bands once into cloud optimized GeoTIFFs in the cache folder, and read them instead of the JP2 files
+BOOL_BAND_CACHE = False
+# Decode the S2 bands once per product into memory-mapped files in the cache folder, shared by all the jobs using the product
+BOOL_SHARED_BANDS = False
+# Run the jobs grouped by S2 product, then FLEX image, then site, instead of the order of Sites.csv
+BOOL_LOCALITY_ORDER = True
+# Thresholds tested by the sweep mode (--sweep), between 0 and 1; every combination is tested
+SWEEP_THRESHOLD_CV = [0.1, 0.15, 0.2, 0.25, 0.3]
+SWEEP_THRESHOLD_CLOUD = [0.5, 0.6, 0.7, 0.8, 0.9]
+SWEEP_VEGETATION_PIXEL = [0.5]
+# Number of rows of the time series mode (--time-series) kept in memory before being written to the table of the site
+TIME_SERIES_BUFFER_ROWS = 50
+# Maximum number of raster files (S2 bands and cache rasters) kept open and reused by all the jobs
+MAX_OPEN_RASTERS = 16
+# Debug: export the ROI of each job as shapefiles ("roi_4326.shp" and "roi_utm.shp") to the cache folder of the site
+BOOL_EXPORT_ROI = False
     
 # ---------------------------------------------------------------------------- #
 #                                   Main Code                                  #
 # ---------------------------------------------------------------------------- #
 
-def main():
+def run_job(flex: FLEX, row: pd.Series, temp_flex_filename: str, dict_flox_dates: dict, band_share: Optional[BandShare] = None) -> LogRecord:
+    '''
+    Process a FLEX image of a site through the job journal. A job already done by an interrupted run is skipped and its saved record is reused; 
+    a failed job is retried until it reaches the maximum number of attempts, and a job skipped for missing inputs is always run again. Any error is saved in the journal and the run goes on with the next job. 
+    Args:
+        flex (FLEX): the FLEX class. 
+        row (pd.Series): the info of the site from Sites.csv. 
+        temp_flex_filename (str): the name of the FLEX image. 
+        dict_flox_dates (dict): the dates of the FLOX data of each site. 
+        band_share (BandShare): the decoded S2 bands shared between jobs, None to read the band files. 
+    Returns:
+        LogRecord: the row of the log report of this FLEX image. 
+    '''
+    temp_site_name = row['Sites']
+    journal = flex.job_journal
+    if not journal.should_run(temp_site_name, temp_flex_filename):
+        temp_job = journal.get_job(temp_site_name, temp_flex_filename)
+        if temp_job['state'] == 'done':
+            print(f"FLEX image '{temp_flex_filename}' of the site {temp_site_name} has already been processed by the interrupted run! This job has been skipped!")
+        else:
+            print(f"FLEX image '{temp_flex_filename}' of the site {temp_site_name} has failed {temp_job['attempts']} time(s)! This job has been skipped!")
+        print("-"*80)
+        if temp_job['record'] is not None:
+            return LogRecord.from_dict(temp_job['record'])
+        # Interrupted without saving any record
+        record = create_record(row)
+        record.flex_filename = temp_flex_filename
+        record.note = f"Failed after {temp_job['attempts']} attempt(s)"
+        return record
+
+    temp_attempt = journal.start_job(temp_site_name, temp_flex_filename)
+    # The results of an earlier run of the job are removed, so that a job skipped or failed by this run leaves none in the outputs
+    flex.results_store.delete_job(temp_site_name, temp_flex_filename)
+    try:
+        record, bool_done = process_flex_image(flex, row, temp_flex_filename, dict_flox_dates, band_share)
+    except Exception as e:
+        print(f"\033[91mThe job of the site {temp_site_name} and its FLEX image {temp_flex_filename} has failed (attempt {temp_attempt} of {journal.max_attempts}): {e!r}\033[0m")
+        print("-"*80)
+        record = create_record(row)
+        record.flex_filename = temp_flex_filename
+        record.note = f"Failed after {temp_attempt} attempt(s): {e!r}"
+        journal.fail_job(temp_site_name, temp_flex_filename, repr(e), record.to_dict())
+        return record
+    if bool_done:
+        journal.finish_job(temp_site_name, temp_flex_filename, record.s2_filename, record.to_dict())
+    else:
+        # Skipped for missing inputs, run again by the next run in case they have been added
+        journal.skip_job(temp_site_name, temp_flex_filename, record.s2_filename, record.to_dict())
+    return record
+
+def create_record(row: pd.Series) -> LogRecord:
+    '''
+    Create an empty LogRecord holding the info of a site. 
+    '''
+    return LogRecord(row['Sites'], row['Latitude'], row['Longitude'], row['ROI'], row['Time Window Days'],
+                     row['Threshold CV'], row['Vegetation Pixel'], row['Threshold Cloud'])
+
+def process_flex_image(flex: FLEX, row: pd.Series, temp_flex_filename: str, dict_flox_dates: dict, band_share: Optional[BandShare] = None) -> tuple:
+    '''
+    Process a FLEX image of a site: find the S2 image with the nearest date, check its valid pixels, calculate NDVI and NIRvREF, 
+    the SIF of the FLEX image and apply the transfer functions. 
+    Args:
+        flex (FLEX): the FLEX class. 
+        row (pd.Series): the info of the site from Sites.csv. 
+        temp_flex_filename (str): the name of the FLEX image. 
+        dict_flox_dates (dict): the dates of the FLOX data of each site. 
+        band_share (BandShare): the decoded S2 bands shared between jobs, None to read the band files. 
+    Returns:
+        tuple: (the row of the log report of this FLEX image as a LogRecord, False if the job has been skipped for missing or 
+        unusable inputs, e.g. no FLOX data, no S2 image in the time window or too many invalid pixels). 
+    '''
+    temp_start_time = time.time()
+    # Read current line site info
+    temp_site_name = row['Sites']
+    temp_site_lat = row['Latitude']
+    temp_site_lon = row['Longitude']
+    temp_site_roi = row['ROI']
+    temp_site_time_window_days = row['Time Window Days']
+    temp_site_threshold_cv = row['Threshold CV']
+    temp_site_threshold_cloud = row['Threshold Cloud']
+    record = create_record(row)
+
+    # ----------------------------- FLEX IMAGE CHECK ----------------------------- #
+    time.sleep(1)
+    print("\033[92m" + "*" * 5 + "FLEX IMAGES CHECK" + "*" * 5 + "\033[0m")
+    time.sleep(1)
+    # Check FLEX filename format
+    flex.check_filename(temp_flex_filename)
+    # Get the date of the FLEX image
+    temp_flex_date = temp_flex_filename.split('.')[0].split('_')[-2]
+    if temp_flex_date not in dict_flox_dates.get(temp_site_name, []):
+        print(f"The date of the current FLEX image is {temp_flex_date}, not found in the FLOX input! This site has been skipped!")
+        print("\033[92m" + "*" * 5 + "FLEX IMAGES CHECK DONE" + "*" * 5 + "\033[0m")
+        print("-"*80)
+        time.sleep(1)
+        record.note = f'No FLOX data on the same date {temp_flex_date}'
+        return record, False
+
+    ## Start to process the FLEX image
+    print(f"The date of the current FLEX image is {temp_flex_date}, found in the FLOX input!!")
+    time.sleep(0.5)
+
+    # Veg pixel check - PENDING!!!!!!!!!!
+    # if temp_site_vegetation_pixel:
+    #     flex.vegetation_pixel = temp_site_vegetation_pixel
+    #     print(f"The vegetation pixel threshold for the site {temp_site_name} has been set to {temp_site_vegetation_pixel}!")
+    # else:
+    #     print("The vegetation pixel threshold is not set, the default value will be used!")
+    print("There are enough vegetation pixels inside the ROI in this image! The date and the time of this image will be recorded!")
+    time.sleep(0.5)
+
+    # Save the FLEX image information into the record
+    record.flex_filename = temp_flex_filename
+    record.flex_date = temp_flex_filename.split('.')[0].split('_')[-2]
+    record.flex_time = temp_flex_filename.split('.')[0].split('_')[-1]
+    record.flex_valid_pixels = 100
+    print("\033[92m" + "*" * 5 + "FLEX IMAGES CHECK DONE" + "*" * 5 + "\033[0m")
+    time.sleep(1)
+    # ----------------------------- FINDING S2 IMAGE ----------------------------- #
+    print("\033[92m" + "*" * 5 + "SEARCHING ONE S2 IMAGE WITH THE NEAREST DATE" + "*" * 5 + "\033[0m")
+    time.sleep(0.5)
+    # Now look for S2 images
+    print(f"Now looking for the nearest Sentinel-2 image for the site {temp_site_name}, within {temp_site_time_window_days} days!")
+    temp_path_s2_images = os.path.join(flex.path_s2_input, temp_site_name)
+    # S2 images without a valid sensing date in their names are ignored
+    temp_list_s2 = [i for i in os.listdir(temp_path_s2_images) if Planner.get_s2_date(i) is not None]
+    if len(temp_list_s2) == 0:
+        print(f"No Sentinel-2 images found for the site {temp_site_name}. This site has been skipped!")
+        print("-"*80)
+        time.sleep(1)
+        record.note = f'No input Sentinel-2 images'
+        return record, False
+    print(f"Found {len(temp_list_s2)} Sentinel-2 images for the site {temp_site_name}!")
+    time.sleep(1)
+    temp_s2_image_final, temp_timediff_final = Planner.find_nearest_s2(temp_list_s2, temp_flex_date)
+    # Check if the difference between the FLEX image date and the S2 image date is greater than the input time_window_days
+    if temp_timediff_final.days > temp_site_time_window_days:
+        print(f"The nearest S2 images found for the site {temp_site_name} has time difference greater than {temp_site_time_window_days} days. This site has been skipped!")
+        print("-"*80)
+        time.sleep(1)
+        record.note = f'No input Sentinel-2 images available within {temp_site_time_window_days} days'
+        return record, False
+    record.s2_filename = temp_s2_image_final
+    record.s2_date = temp_s2_image_final.split('_')[2].split('T')[0]
+    record.s2_time = temp_s2_image_final.split('_')[2].split('T')[1]
+    record.time_difference_s2_flex = temp_timediff_final.days
+    print(f"S2 image '{temp_s2_image_final}' has the nearest date ({temp_timediff_final.days} days) to the FLEX image {temp_flex_filename}")
+    time.sleep(0.5)
+    print(f"Now reading the metadata of the S2 image......")
+    # Finally we can initiate the S2 class provided we already find the S2 image to use! 
+    s2 = S2(temp_site_name, temp_site_lat, temp_site_lon, temp_s2_image_final)
+    s2.area = temp_site_roi
+    s2.threshold_cv = temp_site_threshold_cv
+    s2.cloud = temp_site_threshold_cloud
+    s2.flex_filename = temp_flex_filename
+    s2.bool_uncertainty = BOOL_UNCERTAINTY
+    s2.num_samples = NUM_UNCERTAINTY_SAMPLES
+    s2.reflectance_noise = S2_REFLECTANCE_NOISE
+    s2.bool_strip_processing = BOOL_STRIP_PROCESSING
+    s2.memory_budget = MEMORY_BUDGET_MB
+    s2.precision = S2_PRECISION
+    s2.bool_export_roi = BOOL_EXPORT_ROI
+    if BOOL_BAND_CACHE:
+        s2.ingest_bands()
+    print("\033[92m" + "*" * 5 + "SEARCHING ONE S2 IMAGE WITH THE NEAREST DATE DONE" + "*" * 5 + "\033[0m")
+    time.sleep(1)
+
+    # ------------------------------ S2 IMAGE CHECK ------------------------------ #
+    print("\033[92m" + "*" * 5 + "S2 Valid Pixel Check" + "*" * 5 + "\033[0m")
+    time.sleep(1)
+
+    # Create the cache subfolder for the current site
+    s2.create_cache_subfolder(temp_site_name)
+    # Decoded window of the bands shared with the other jobs of the S2 product, if registered
+    if band_share is not None and band_share.get_window(S2.get_product_id(temp_s2_image_final)) is not None:
+        temp_product_id = S2.get_product_id(temp_s2_image_final)
+        s2.attach_shared_bands(band_share.attach(temp_product_id, {'B04': s2.path_l2a_b04, 'B08': s2.path_l2a_b08, 'MSK_CLASSI_B00': s2.path_l2a_mask}),
+                               band_share.get_window(temp_product_id))
+
+    print(f"Checking the valid pixels of the S2 image. Only if the valid pixels are greater than {temp_site_threshold_cloud * 100}% of the total pixels, the S2 image will be used for further processing!")
+
+    # Read masks of opaque clouds, cirrus clouds and snow ice areas
+    temp_pass_l2a, temp_valid_pixels_l2a, temp_valid_pixels_percentage_l2a = s2.cal_valid_pixels()
+    # Save valid pixel result
+    record.s2_valid_pixels = temp_valid_pixels_percentage_l2a * 100
+
+    time.sleep(1)
+    # Valid pixels check
+    if not temp_pass_l2a:
+        print(f"\033[92mThe calculation and validation of site {temp_site_name} and its S2 image {temp_s2_image_final} has been skipped, due to exceeding invalid pixels!\033[0m")
+        record.note = f"The percentage of invalid pixels exceeding {s2.cloud * 100}%"
+        print("-"*80)
+        time.sleep(1)
+        return record, False
+
+    print(f"{temp_site_name} and its S2 image {temp_s2_image_final} has sufficient valid pixels!")
+    print("\033[92m" + "*" * 5 + "S2 Valid Pixel Check DONE" + "*" * 5 + "\033[0m")
+    time.sleep(1)
+    # ------------------------------ S2 NDVI NIRvREF ----------------------------- #
+
+    print("\033[92m" + "*" * 5 + "S2 NDVI & NIRvREF Calculation" + "*" * 5 + "\033[0m")
+    print(f"Now calculating NDVI and NIRvREF inside the ROI of the site {temp_site_name}......")
+    temp_ndvi_std, temp_ndvi_avg, temp_ndvi_cv, temp_ndvi_flag, temp_nirv_std, temp_nirv_avg, temp_nirv_cv, temp_nirv_flag = s2.cal_l2a_indices()
+    record.s2_ndvi_sd = temp_ndvi_std
+    record.s2_ndvi_avg = temp_ndvi_avg
+    record.s2_ndvi_cv = temp_ndvi_cv * 100
+    record.s2_ndvi_cv_flag = temp_ndvi_flag
+    record.s2_nirv_sd = temp_nirv_std
+    record.s2_nirv_avg = temp_nirv_avg
+    record.s2_nirv_cv = temp_nirv_cv * 100
+    record.s2_nirv_cv_flag = temp_nirv_flag
+    # The same indices in each FLEX pixel of the ROI
+    s2.cal_flex_pixel_indices()
+    print("\033[92m" + "*" * 5 + "S2 NDVI & NIRvREF Calculation DONE" + "*" * 5 + "\033[0m")
+
+    # --------------------------------- FLEX SIF --------------------------------- #
+
+    print("\033[92m" + "*" * 5 + "FLEX SIF Calculation" + "*" * 5 + "\033[0m")
+    time.sleep(0.5)
+    print(f"Now starting to calculate the SIF for the site {temp_site_name} and its FLEX image {temp_flex_filename}!")
+    # Read converted FLEX .tiff file from the cache folder
+    flex.cal_sif(temp_site_name, temp_flex_filename, temp_site_lon, temp_site_lat, temp_site_roi, temp_s2_image_final)
+    flex.sif_output(temp_site_name, temp_flex_filename, temp_site_lon, temp_site_lat, temp_site_roi, temp_s2_image_final)
+    print("\033[92m" + "*" * 5 + "FLEX SIF Calculation DONE" + "*" * 5 + "\033[0m")
+    time.sleep(1)
+
+    # ----------------------------- Transfer Function ---------------------------- #
+
+    print("\033[92m" + "*" * 5 + "TRANSFER FUNCTION" + "*" * 5 + "\033[0m")
+    time.sleep(0.5)
+    print(f"Now applying transfer functions for the site {temp_site_name} and its FLEX image {temp_flex_filename}!")
+    bool_flox_invalid = s2.cal_transfer_function(temp_flex_date)
+    if bool_flox_invalid:
+        record.note = 'FLOX is on an invalid pixel'
+    print("\033[92m" + "*" * 5 + "TRANSFER FUNCTION DONE" + "*" * 5 + "\033[0m")
+
+    temp_end_time = time.time()
+    temp_elapsed_time = temp_end_time - temp_start_time
+    print(f"The calculation and validation of site {temp_site_name} has been finished successfully, which took {temp_elapsed_time:.2f} seconds! ")
+    time.sleep(0.5)
+    print("-"*80)
+    s2.remove_cache()
+    time.sleep(1)
+    return record, True
+
+def main(bool_dry_run: bool = False):
+    '''
+    Args:
+        bool_dry_run (bool): only check the inputs and print the job plan, without processing any image. 
+    '''
     time_start = time.time()
     print("Code starts!")
     # Initiate classes
     flex = FLEX()
+    flex.bool_bootstrap = BOOL_BOOTSTRAP
+    flex.num_bootstrap = NUM_BOOTSTRAP
+    flex.confidence_level = BOOTSTRAP_CONFIDENCE
+    flex.output_format = OUTPUT_FORMAT
+    flex.job_journal.max_attempts = MAX_JOB_ATTEMPTS
+    flex.raster_pool.max_handles = MAX_OPEN_RASTERS
     
     # --------------------------------- FLOX FILE -------------------------------- #
     if os.path.exists(flex.file_flox_csv):
@@ -36,352 +341,126 @@ def main():
     # ------------------------------ LOOP EACH SITE ------------------------------ #
     # Read Sites.csv
     df_site = flex.get_site_info()
+
+    # ---------------------------------- PREFLIGHT --------------------------------- #
+    print("Now checking all inputs before processing!")
+    planner = Planner(flex, NUM_PREFLIGHT_WORKERS)
+    df_plan, df_issues = planner.plan(df_site, dict_flox_dates)
+    planner.print_plan(df_plan, df_issues)
+    print("-"*80)
+    # Order the jobs by their shared inputs
+    if BOOL_LOCALITY_ORDER:
+        df_order = planner.order_jobs(df_plan)
+    else:
+        df_order = df_plan
+    df_locality = planner.cal_locality(df_plan, df_order)
+    planner.print_locality(df_locality)
+    print("-"*80)
+    if bool_dry_run:
+        df_plan.to_csv(os.path.join(flex.path_output, "L2B_job_plan.csv"), index=False)
+        df_locality.to_csv(os.path.join(flex.path_output, "L2B_job_locality.csv"), index=False)
+        print(f"Dry run finished! Please find the job plan 'L2B_job_plan.csv' and the locality report 'L2B_job_locality.csv' in the following folder: {flex.path_output}")
+        return
+    if not BOOL_RESUME:
+        flex.job_journal.clear()
+    # Only the results of the jobs of this plan are read into the outputs, not the ones of sites or FLEX images of earlier runs
+    flex.plan_jobs = list(zip(df_plan['site_code'], df_plan['flex_filename']))
+
     print("Now start to proceed all FLEX images!")
     print("-"*80)
-    # Create empty lists to store the results
-    list_site_name = []
-    list_site_lat = []
-    list_site_lon = []
-    list_roi = []
-    list_threshold_cv = []
-    list_vegetation_pixel = []
-    list_threshold_cloud = []
-    list_time_window_days = []
-
-    list_flex_date = []
-    list_flex_time = []
-    list_flex_filename = []
-    list_flex_valid_pixels = []
-    list_s2_filename = []
-    list_s2_date = []
-    list_s2_time = []
-    list_s2_valid_pixels = []
-    list_time_difference = []
-    list_s2_nirv_avg = []
-    list_s2_nirv_std = []
-    list_s2_nirv_cv = []
-    list_s2_nirv_cv_flag = []
-    list_s2_ndvi_avg = []
-    list_s2_ndvi_std = []
-    list_s2_ndvi_cv = []
-    list_s2_ndvi_cv_flag = []
-
-    list_note = []
-
-    # Some nested lists for empty output
-    list_list_others = [list_flex_date, list_flex_time, list_flex_filename,
-                        list_flex_valid_pixels, list_s2_filename, list_s2_date,
-                        list_s2_time, list_s2_valid_pixels, list_time_difference,list_s2_nirv_avg,
-                        list_s2_nirv_std, list_s2_nirv_cv, list_s2_ndvi_avg, list_s2_ndvi_std,
-                        list_s2_ndvi_cv, list_s2_nirv_cv_flag, list_s2_ndvi_cv_flag]
-    list_list_others_noflex = [list_s2_filename, list_s2_date,
-                    list_s2_time, list_s2_valid_pixels, list_time_difference,list_s2_nirv_avg,
-                    list_s2_nirv_std, list_s2_nirv_cv, list_s2_ndvi_avg, list_s2_ndvi_std,
-                    list_s2_ndvi_cv, list_s2_nirv_cv_flag, list_s2_ndvi_cv_flag]
-    
-    # Iterate each site in Sites.csv!
-    for index, row in df_site.iterrows():
-        temp_start_time = time.time()
-
-        # Read current line site info
-        temp_site_name = row['Sites']
-        temp_site_lat = row['Latitude']
-        temp_site_lon = row['Longitude']
-        temp_site_roi = row['ROI']
-        temp_site_time_window_days = row['Time Window Days']
-        temp_site_threshold_cv = row['Threshold CV']
-        temp_site_vegetation_pixel = row['Vegetation Pixel']
-        temp_site_threshold_cloud = row['Threshold Cloud']
-        # Save current line site info into the lists
-        list_site_name.append(temp_site_name)
-        list_site_lat.append(temp_site_lat)
-        list_site_lon.append(temp_site_lon)
-        list_roi.append(temp_site_roi)
-        list_threshold_cv.append(temp_site_threshold_cv * 100)
-        list_vegetation_pixel.append(temp_site_vegetation_pixel * 100)
-        list_time_window_days.append(temp_site_time_window_days)
-        list_threshold_cloud.append(temp_site_threshold_cloud * 100)
-        # Modify the class attributes accordingly
-        flex.vegetation_pixel = temp_site_vegetation_pixel
+    # Each job returns its own row of the log report
+    dict_records = {}
+    dict_site_rows = {row['Sites']: row for index, row in df_site.iterrows()}
 
-        # ----------------------------- FLEX IMAGE CHECK ----------------------------- #
-        time.sleep(1)
-        print("\033[92m" + "*" * 5 + "FLEX IMAGES CHECK" + "*" * 5 + "\033[0m")
-        time.sleep(1)
-        # Check if there is a folder inside "input_flex_images" for the current site
-        temp_site_path_input = os.path.join(flex.path_flex_input,temp_site_name)
-        if not os.path.exists(temp_site_path_input):
-            print(f"{temp_site_name} doesn't have any input FLEX images! This site has been skipped!")
-            print("\033[92m" + "*" * 5 + "FLEX IMAGES CHECK DONE" + "*" * 5 + "\033[0m")
-            print("-"*80)
-            time.sleep(1)
-            for temp_list in list_list_others:
-                temp_list.append('N/A')
-            list_note.append('No input FLEX images')
-            continue
-        # Check if there are any FLEX images inside the folder for the current site
-        temp_site_flex_images_list = os.listdir(temp_site_path_input)
-        temp_site_flex_images_list_nc = [i for i in temp_site_flex_images_list if i.endswith('.nc')]
-        temp_site_flex_images_num = len(temp_site_flex_images_list_nc)
-        if temp_site_flex_images_num == 0:
-            print(f"{temp_site_name} doesn't have any input FLEX images! This site has been skipped!")
-            print("\033[92m" + "*" * 5 + "FLEX IMAGES CHECK DONE" + "*" * 5 + "\033[0m")
+    # Sites without any FLEX image
+    for index, row in df_site.iterrows():
+        if row['Sites'] not in df_plan['site_code'].values:
+            print(f"{row['Sites']} doesn't have any input FLEX images! This site has been skipped!")
             print("-"*80)
             time.sleep(1)
-            for temp_list in list_list_others:
-                temp_list.append('N/A')
-            list_note.append('No input FLEX images')
-            continue
-
-        # Real work begins here
-        print(f"{temp_site_name} has {temp_site_flex_images_num} FLEX image(s)!")
-        time.sleep(0.5)
-        # Processing all the FLEX images for the current site
-        for i in range(temp_site_flex_images_num):
-            temp_flex_filename = temp_site_flex_images_list_nc[i]
-            print(f"Now starting with No.{i + 1} FLEX image '{temp_flex_filename}' of the site {temp_site_name}")
-            # Check FLEX filename format
-            flex.check_filename(temp_flex_filename)
-            # Get the date of the FLEX image
-            temp_flex_date = temp_flex_filename.split('.')[0].split('_')[-2]
-            if temp_flex_date not in dict_flox_dates[temp_site_name]:
-                print(f"The date of the current FLEX image is {temp_flex_date}, not found in the FLOX input! This site has been skipped!")
-                print("\033[92m" + "*" * 5 + "FLEX IMAGES CHECK DONE" + "*" * 5 + "\033[0m")
-                print("-"*80)
-                time.sleep(1)
-                for temp_list in list_list_others:
-                    temp_list.append('N/A')
-                list_note.append(f'No FLOX data on the same date {temp_flex_date}')
-                continue
-
-            ## Start to process the FLEX image
-            print(f"The date of the current FLEX image is {temp_flex_date}, found in the FLOX input!!")
-            time.sleep(0.5)
-
-            # Veg pixel check - PENDING!!!!!!!!!!
-            # if temp_site_vegetation_pixel:
-            #     flex.vegetation_pixel = temp_site_vegetation_pixel
-            #     print(f"The vegetation pixel threshold for the site {temp_site_name} has been set to {temp_site_vegetation_pixel}!")
-            # else:
-            #     print("The vegetation pixel threshold is not set, the default value will be used!")
-            print("There are enough vegetation pixels inside the ROI in this image! The date and the time of this image will be recorded!")
-            time.sleep(0.5)
-
-            # Save the FLEX image information into the lists
-            list_flex_filename.append(temp_flex_filename)
-            list_flex_date.append(temp_flex_filename.split('.')[0].split('_')[-2])
-            list_flex_time.append(temp_flex_filename.split('.')[0].split('_')[-1])
-            list_flex_valid_pixels.append(100)
-            print("\033[92m" + "*" * 5 + "FLEX IMAGES CHECK DONE" + "*" * 5 + "\033[0m")
-            time.sleep(1)
-            # ----------------------------- FINDING S2 IMAGE ----------------------------- #
-            print("\033[92m" + "*" * 5 + "SEARCHING ONE S2 IMAGE WITH THE NEAREST DATE" + "*" * 5 + "\033[0m")
-            time.sleep(0.5)
-            # Now look for S2 images
-            print(f"Now looking for the nearest Sentinel-2 image for the site {temp_site_name}, within {temp_site_time_window_days} days!")
-            temp_flex_image_datetime = datetime.strptime(temp_flex_filename.split('.')[0].split('_')[-2], '%Y%m%d')
-            temp_path_s2_images = os.path.join(flex.path_s2_input, temp_site_name)
-            temp_s2_image_final = os.listdir(temp_path_s2_images)
-            if len(temp_s2_image_final) == 0:
-                print(f"No Sentinel-2 images found for the site {temp_site_name}. This site has been skipped!")
-                print("-"*80)
-                time.sleep(1)
-                for temp_list in list_list_others_noflex:
-                    temp_list.append('N/A')
-                list_note.append(f'No input Sentinel-2 images')
-                continue
-            else:
-                print(f"Found {len(temp_s2_image_final)} Sentinel-2 images for the site {temp_site_name}!")
-                time.sleep(1)
-                temp_s2_image_final = temp_s2_image_final[0]
-                for j in range(len(os.listdir(temp_path_s2_images))):
-                    temp_s2_image = os.listdir(temp_path_s2_images)[j]
-                    temp_s2_image_date = temp_s2_image.split('_')[2].split('T')[0]
-                    temp_s2_image_datetime = datetime.strptime(temp_s2_image_date, '%Y%m%d')
-                    if j == 0:
-                        temp_timediff_final = temp_s2_image_datetime - temp_flex_image_datetime
-                    else:
-                        temp_timediff = temp_s2_image_datetime - temp_flex_image_datetime
-                        # print(f"Comparing S2 image {temp_s2_image} with FLEX image {temp_flex_filename}, the time difference is {temp_timediff}")
-                        if abs(temp_timediff) < abs(temp_timediff_final):
-                            temp_timediff_final = temp_timediff
-                            temp_s2_image_final = temp_s2_image
-                # Check if the difference between the FLEX image date and the S2 image date is greater than the input time_window_days
-                if temp_timediff_final.days > temp_site_time_window_days:
-                    print(f"The nearest S2 images found for the site {temp_site_name} has time difference greater than {temp_site_time_window_days} days. This site has been skipped!")
-                    print("-"*80)
-                    time.sleep(1)
-                    for temp_list in list_list_others_noflex:
-                        temp_list.append('N/A')
-                    list_note.append(f'No input Sentinel-2 images available within {temp_site_time_window_days} days')
-                    continue
-                list_s2_filename.append(temp_s2_image_final)
-                list_s2_date.append(temp_s2_image_final.split('_')[2].split('T')[0])
-                list_s2_time.append(temp_s2_image_final.split('_')[2].split('T')[1])
-                list_time_difference.append(temp_timediff_final.days)
-                print(f"S2 image '{temp_s2_image_final}' has the nearest date ({temp_timediff_final.days} days) to the FLEX image {temp_flex_filename}")
-                time.sleep(0.5)
-                print(f"Now reading the metadata of the S2 image......")
-                # Finally we can initiate the S2 class provided we already find the S2 image to use! 
-                s2 = S2(temp_site_name, temp_site_lat, temp_site_lon, temp_s2_image_final)
-                s2.area = temp_site_roi
-                s2.threshold_cv = temp_site_threshold_cv
-                s2.cloud = temp_site_threshold_cloud
-                s2.flex_filename = temp_flex_filename
-                print("\033[92m" + "*" * 5 + "SEARCHING ONE S2 IMAGE WITH THE NEAREST DATE DONE" + "*" * 5 + "\033[0m")
-                time.sleep(1)
-
-                # ------------------------------ S2 IMAGE CHECK ------------------------------ #
-                print("\033[92m" + "*" * 5 + "S2 Valid Pixel Check" + "*" * 5 + "\033[0m")
-                time.sleep(1)
-
-                # Create the cache subfolder for the current site
-                s2.create_cache_subfolder(temp_site_name)
-
-                print(f"Checking the valid pixels of the S2 image. Only if the valid pixels are greater than {temp_site_threshold_cloud * 100}% of the total pixels, the S2 image will be used for further processing!")
-
-                # Read masks of opaque clouds, cirrus clouds and snow ice areas
-                temp_pass_l2a, temp_valid_pixels_l2a, temp_valid_pixels_percentage_l2a = s2.cal_valid_pixels()
-                # Save valid pixel result
-                list_s2_valid_pixels.append(temp_valid_pixels_percentage_l2a * 100)
-
-                time.sleep(1)
-                # Valid pixels check
-                if temp_pass_l2a:
-                    print(f"{temp_site_name} and its S2 image {temp_s2_image_final} has sufficient valid pixels!")
-                    print("\033[92m" + "*" * 5 + "S2 Valid Pixel Check DONE" + "*" * 5 + "\033[0m")
-                    time.sleep(1)
-                    # ------------------------------ S2 NDVI NIRvREF ----------------------------- #
-
-                    print("\033[92m" + "*" * 5 + "S2 NDVI & NIRvREF Calculation" + "*" * 5 + "\033[0m")
-                    print(f"Now calculating NDVI and NIRvREF inside the ROI of the site {temp_site_name}......")
-                    temp_ndvi_std, temp_ndvi_avg, temp_ndvi_cv, temp_ndvi_flag, temp_nirv_std, temp_nirv_avg, temp_nirv_cv, temp_nirv_flag = s2.cal_l2a_indices()
-                    list_s2_ndvi_std.append(temp_ndvi_std)
-                    list_s2_ndvi_avg.append(temp_ndvi_avg)
-                    list_s2_ndvi_cv.append(temp_ndvi_cv * 100)
-                    list_s2_ndvi_cv_flag.append(temp_ndvi_flag)
-                    list_s2_nirv_std.append(temp_nirv_std)
-                    list_s2_nirv_avg.append(temp_nirv_avg)
-                    list_s2_nirv_cv.append(temp_nirv_cv * 100)
-                    list_s2_nirv_cv_flag.append(temp_nirv_flag)
-                    print("\033[92m" + "*" * 5 + "S2 NDVI & NIRvREF Calculation DONE" + "*" * 5 + "\033[0m")
-
-                    # --------------------------------- FLEX SIF --------------------------------- #
-
-                    print("\033[92m" + "*" * 5 + "FLEX SIF Calculation" + "*" * 5 + "\033[0m")
-                    time.sleep(0.5)
-                    print(f"Now starting to calculate the SIF for the site {temp_site_name} and its FLEX image {temp_flex_filename}!")
-                    # Read converted FLEX .tiff file from the cache folder
-                    flex.cal_sif(temp_site_name, temp_flex_filename, temp_site_lon, temp_site_lat, temp_site_roi, temp_s2_image_final)
-                    flex.sif_output(temp_site_name, temp_flex_filename, temp_site_lon, temp_site_lat, temp_site_roi, temp_s2_image_final)
-                    print("\033[92m" + "*" * 5 + "FLEX SIF Calculation DONE" + "*" * 5 + "\033[0m")
-                    time.sleep(1)
-
-                    # ----------------------------- Transfer Function ---------------------------- #
-
-                    print("\033[92m" + "*" * 5 + "TRANSFER FUNCTION" + "*" * 5 + "\033[0m")
-                    time.sleep(0.5)
-                    print(f"Now applying transfer functions for the site {temp_site_name} and its FLEX image {temp_flex_filename}!")
-                    bool_flox_invalid = s2.cal_transfer_function(temp_flex_date)
-                    if bool_flox_invalid:
-                        list_note.append('FLOX is on an invalid pixel')
-                    else:
-                        list_note.append("N/A")
-                    print("\033[92m" + "*" * 5 + "TRANSFER FUNCTION DONE" + "*" * 5 + "\033[0m")
-
-                    temp_end_time = time.time()
-                    temp_elapsed_time = temp_end_time - temp_start_time
-                    print(f"The calculation and validation of site {temp_site_name} has been finished successfully, which took {temp_elapsed_time:.2f} seconds! ")
-                    time.sleep(0.5)
-                    print("-"*80)
-                    s2.remove_cache()
-                    time.sleep(1)
-
-                else:
-                    print(f"\033[92mThe calculation and validation of site {temp_site_name} and its S2 image {temp_s2_image_final} has been skipped, due to exceeding invalid pixels!\033[0m")
-                    list_s2_nirv_avg.append('N/A')
-                    list_s2_nirv_std.append('N/A')
-                    list_s2_nirv_cv.append('N/A')
-                    list_s2_nirv_cv_flag.append('N/A')
-                    list_s2_ndvi_avg.append('N/A')
-                    list_s2_ndvi_std.append('N/A')
-                    list_s2_ndvi_cv.append('N/A')
-                    list_s2_ndvi_cv_flag.append('N/A')
-                    list_note.append(f"The percentage of invalid pixels exceeding {s2.cloud * 100}%")
-                    print("-"*80)
-                    time.sleep(1)
-                    continue
+            record = create_record(row)
+            record.note = 'No input FLEX images'
+            dict_records[(row['Sites'], None)] = record
+
+    # Decoded S2 bands shared by the jobs of each product, released after the last one
+    band_share = None
+    dict_consumers = {}
+    if BOOL_SHARED_BANDS:
+        band_share = BandShare(flex.path_cache, flex.results_store.path_db)
+        dict_product_jobs = {}
+        for job in df_order.itertuples():
+            if job.status == 'ready' and flex.job_journal.should_run(job.site_code, job.flex_filename):
+                temp_product_id = S2.get_product_id(job.s2_filename)
+                dict_consumers[temp_product_id] = dict_consumers.get(temp_product_id, 0) + 1
+                dict_product_jobs.setdefault(temp_product_id, []).append(job)
+        # The shares of the products not in this plan, e.g. left by an interrupted run, are removed
+        band_share.clean(list(dict_consumers))
+        for temp_product_id, temp_num_consumers in dict_consumers.items():
+            # Only the window of the tile covering the ROI of all the jobs of the product is decoded
+            list_rows = [dict_site_rows[job.site_code] for job in dict_product_jobs[temp_product_id]]
+            try:
+                s2 = S2(list_rows[0]['Sites'], list_rows[0]['Latitude'], list_rows[0]['Longitude'], dict_product_jobs[temp_product_id][0].s2_filename)
+                temp_window = s2.get_shared_window([row['Latitude'] for row in list_rows], [row['Longitude'] for row in list_rows], [row['ROI'] for row in list_rows])
+            except Exception as e:
+                print(f"\033[91mThe window of the S2 product {temp_product_id} to share can't be found, its bands won't be shared: {e!r}\033[0m")
+                temp_window = None
+            band_share.register(temp_product_id, temp_num_consumers, temp_window)
+
+    # Iterate each job of the plan!
+    temp_num_jobs = len(df_order)
+    for i, job in enumerate(df_order.itertuples()):
+        row = dict_site_rows[job.site_code]
+        # Modify the class attributes accordingly
+        flex.vegetation_pixel = row['Vegetation Pixel']
+        print(f"Now starting with No.{i + 1} of {temp_num_jobs} jobs: FLEX image '{job.flex_filename}' of the site {job.site_code}")
+        temp_bool_consumer = band_share is not None and job.status == 'ready' and flex.job_journal.should_run(job.site_code, job.flex_filename)
+        dict_records[(job.site_code, job.flex_filename)] = run_job(flex, row, job.flex_filename, dict_flox_dates, band_share)
+        if temp_bool_consumer:
+            band_share.release(S2.get_product_id(job.s2_filename))
+
+    # Rows of the log report in the order of Sites.csv
+    list_records = []
+    for index, row in df_site.iterrows():
+        if (row['Sites'], None) in dict_records:
+            list_records.append(dict_records[(row['Sites'], None)])
+        for temp_flex_filename in df_plan.loc[df_plan['site_code'] == row['Sites'], 'flex_filename']:
+            list_records.append(dict_records[(row['Sites'], temp_flex_filename)])
 
     # Loop finished, now we save the output to a new .csv file
 
     # ---------------------------------- output ---------------------------------- #
 
     # log report
-
-    df_log_report = pd.DataFrame({
-        "site_code": list_site_name,
-        "latitude": list_site_lat,
-        "longitude": list_site_lon,
-        "reference_area": list_roi,
-        "time_window": list_time_window_days,
-        "threshold_CV": list_threshold_cv,
-        "vegetation_pixel": list_vegetation_pixel,
-        "threshold_cloud": list_threshold_cloud,
-        "flex_date": list_flex_date,
-        "flex_time": list_flex_time,
-        "flex_filename": list_flex_filename,
-        "flex_valid_pixels": list_flex_valid_pixels,
-        "s2_filename": list_s2_filename,
-        "s2_date": list_s2_date,
-        "s2_time": list_s2_time,
-        "time_difference_s2_flex": list_time_difference,
-        "s2_valid_pixels": list_s2_valid_pixels,
-        "s2_ndvi_avg": list_s2_ndvi_avg,
-        "s2_ndvi_sd": list_s2_ndvi_std,
-        "s2_ndvi_cv": list_s2_ndvi_cv,
-        "s2_ndvi_cv_flag": list_s2_ndvi_cv_flag,
-        "s2_nirv_avg": list_s2_nirv_avg,
-        "s2_nirv_sd": list_s2_nirv_std,
-        "s2_nirv_cv": list_s2_nirv_cv,
-        "s2_nirv_cv_flag": list_s2_nirv_cv_flag,
-        "note": list_note
-    })
-    df_log_report.to_csv(os.path.join(s2.path_output,"L2B_log_report.csv"), index = False)
+    df_log_report = LogRecord.to_dataframe(list_records)
+    flex.write_output(df_log_report, "L2B_log_report")
 
     # sif avg
-    list_csv_file_avg = []
-    for csv_file in os.listdir(os.path.join(s2.path_cache, 'FLEX', 'avg')):
-        if csv_file.endswith('.csv'):
-            list_csv_file_avg.append(os.path.join(s2.path_cache,'FLEX', 'avg', csv_file))
-    df_sif_avg = pd.concat([pd.read_csv(f) for f in list_csv_file_avg], ignore_index=True)
-    df_sif_avg.to_csv(os.path.join(s2.path_output, "Full_Spectrum_avg_FLEX_table.csv"), index=False)
+    df_sif_avg = flex.results_store.read_table('FLEX_avg', flex.plan_jobs)
+    flex.write_output(df_sif_avg, "Full_Spectrum_avg_FLEX_table")
 
     # sif std
-    list_csv_file_std = []
-    for csv_file in os.listdir(os.path.join(s2.path_cache, 'FLEX', 'std')):
-        if csv_file.endswith('.csv'):
-            list_csv_file_std.append(os.path.join(s2.path_cache,'FLEX', 'std', csv_file))
-    df_sif_std = pd.concat([pd.read_csv(f) for f in list_csv_file_std], ignore_index=True)
-    df_sif_std.to_csv(os.path.join(s2.path_output, "Full_Spectrum_std_FLEX_table.csv"), index=False)
-
-    # sif
-    list_csv_file = []
-    for csv_file in os.listdir(os.path.join(s2.path_cache, 'FLEX', 'sif')):
-        if csv_file.endswith('.csv'):
-            list_csv_file.append(os.path.join(s2.path_cache,'FLEX', 'sif', csv_file))
-    df_sif = pd.concat([pd.read_csv(f) for f in list_csv_file], ignore_index=True)
-    df_sif.to_csv(os.path.join(s2.path_cache, "L2B_FLEX_table.csv"), index=False)
+    df_sif_std = flex.results_store.read_table('FLEX_std', flex.plan_jobs)
+    flex.write_output(df_sif_std, "Full_Spectrum_std_FLEX_table")
 
     flex.create_matchup_report()
+    flex.create_pixel_matchup_report()
     flex.cal_statistic_flex_flox()
     flex.cal_statistic_flex_tf()
+
+    # The run has finished, so the journal is cleared: the next run processes all jobs again with its own inputs and settings
+    flex.job_journal.clear()
     
+    dict_pool = flex.raster_pool.stats()
+    print(f"Raster files: {dict_pool['opened']} opened, {dict_pool['reused']} reads served by an open file, {dict_pool['evicted']} closed when the pool was full, {dict_pool['open']} still open")
+    # All pooled rasters are closed before the cache folder holding them can be deleted
+    flex.raster_pool.close_all()
+
     # Delete cache folder? 
-    if s2.bool_delete_cache:
-        shutil.rmtree(s2.path_cache)
+    if flex.bool_delete_cache:
+        shutil.rmtree(flex.path_cache)
         print("The cache folder and all its contents has been deleted permanently! ")
 
-    print(f"Please find the final output.csv in the following folder: {s2.path_output}")
+    print(f"Please find the final output.csv in the following folder: {flex.path_output}")
 
     # ------------------------------ Code Terminates ----------------------------- #
     time_end = time.time()
@@ -389,5 +468,53 @@ def main():
     print(f"This python code has finished its work, and in totale it has taken {time_elapsed:.2f} seconds!")
 
 
+def sweep():
+    '''
+    Test the thresholds of the sweep settings on the results of a previous run saved in the cache folder, without reading any image. 
+    '''
+    time_start = time.time()
+    print("Threshold sweep starts!")
+    flex = FLEX()
+    df_flags, df_reports = flex.sweep_thresholds(SWEEP_THRESHOLD_CV, SWEEP_THRESHOLD_CLOUD, SWEEP_VEGETATION_PIXEL)
+    df_flags.to_csv(os.path.join(flex.path_output, "L2B_threshold_sweep_flags.csv"), index=False)
+    df_reports.to_csv(os.path.join(flex.path_output, "L2B_threshold_sweep_validation_report.csv"), index=False)
+    temp_num_missing = df_reports['n_jobs_not_processed'].max()
+    if temp_num_missing > 0:
+        print(f"\033[91mUp to {temp_num_missing} job(s) pass some of the thresholds but failed the cloud check of the run, so they have no FLEX nor TF results! Please rerun them with a lower threshold of cloud to include them!\033[0m")
+    print(f"Threshold sweep finished! Please find 'L2B_threshold_sweep_flags.csv' and 'L2B_threshold_sweep_validation_report.csv' in the following folder: {flex.path_output}")
+    time_elapsed = time.time() - time_start
+    print(f"The threshold sweep has taken {time_elapsed:.2f} seconds!")
+
+
+def time_series():
+    '''
+    Calculate the NDVI, NIRvREF and TF2 statistics of the ROI of every S2 image of each site, one table per site. 
+    '''
+    time_start = time.time()
+    print("Time series starts!")
+    flex = FLEX()
+    df_site = flex.get_site_info()
+    series = TimeSeries(flex, TIME_SERIES_BUFFER_ROWS)
+    series.precision = S2_PRECISION
+    flex.raster_pool.max_handles = MAX_OPEN_RASTERS
+    series.run(df_site)
+    dict_pool = flex.raster_pool.stats()
+    print(f"Raster files: {dict_pool['opened']} opened, {dict_pool['reused']} reads served by an open file, {dict_pool['evicted']} closed when the pool was full, {dict_pool['open']} still open")
+    flex.raster_pool.close_all()
+    print(f"Time series finished! Please find the tables '<site>_S2_time_series.csv' in the following folder: {series.path_output}")
+    time_elapsed = time.time() - time_start
+    print(f"The time series has taken {time_elapsed:.2f} seconds!")
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="CAL/VAL of FLEX L2B SIF products against FLOX and Sentinel-2 data.")
+    parser.add_argument("--dry-run", action="store_true", help="only check the inputs and print the job plan with the estimated bytes to read")
+    parser.add_argument("--sweep", action="store_true", help="test the thresholds of the sweep settings on the saved results of a previous run, without reading any image")
+    parser.add_argument("--time-series", action="store_true", help="calculate the S2 indices of the ROI of every S2 image of each site, one table per site")
+    args = parser.parse_args()
+    if args.sweep:
+        sweep()
+    elif args.time_series:
+        time_series()
+    else:
+        main(args.dry_run)
@@ -0,0 +1,167 @@
+import os
+import time
+import shutil
+import sqlite3
+from contextlib import closing
+import numpy as np
+import rasterio as rio
+import rasterio.windows
+
+class BandShare:
+
+    # Constuctor
+    def __init__(self, path_cache: str, path_db: str, timeout: int = 600):
+        '''
+        Decoded S2 bands shared by all the jobs, and all the processes, working on the same S2 product. The first job decodes the
+        window of B04, B08 and MSK_CLASSI_B00 covering the ROI of all the jobs of the product (see S2.get_shared_window) once into
+        memory-mapped .npy files in the cache folder; the other jobs attach to them without copying, the operating system sharing
+        the same pages between processes. A reference count, kept in the SQLite database of the run and set from the job plan,
+        removes the files when the last job using the product has finished, and the shares of the products not in the plan, e.g.
+        left by an interrupted run, are removed when the plan is registered (see clean).
+        Args:
+            path_cache (str): path to the cache folder.
+            path_db (str): path to the SQLite database file of the run.
+            timeout (int): the maximum time in seconds to wait for another process decoding the same product. Defaults to 600.
+        '''
+        self._path_share = os.path.join(path_cache, "band_share")
+        self._path_db = path_db
+        self._timeout = timeout
+        # The window of the tile decoded for each registered product
+        self._windows = {}
+        self.__check_db()
+
+    # ------------------------------ Private Methods ----------------------------- #
+
+    # Create the database and its table if not exists
+    def __check_db(self):
+        if not os.path.exists(self._path_share):
+            os.makedirs(self._path_share, exist_ok=True)
+        with closing(self.connect()) as conn, conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS band_shares (
+                    product_id TEXT PRIMARY KEY,
+                    refcount INTEGER NOT NULL
+                )''')
+
+    # Decode a window of a band into a memory-mapped .npy file, one block of rows at a time
+    @staticmethod
+    def __decode(path_band: str, path_npy: str, window: rio.windows.Window) -> None:
+        with rio.open(path_band) as src:
+            shape = (src.count, window.height, window.width) if src.count > 1 else (window.height, window.width)
+            values = np.lib.format.open_memmap(path_npy, mode='w+', dtype=src.dtypes[0], shape=shape)
+            temp_rows = src.block_shapes[0][0]
+            for row_start in range(0, window.height, temp_rows):
+                temp_window = rio.windows.Window(window.col_off, window.row_off + row_start, window.width, min(temp_rows, window.height - row_start))
+                if src.count > 1:
+                    values[:, row_start:row_start + temp_window.height, :] = src.read(window=temp_window)
+                else:
+                    values[row_start:row_start + temp_window.height, :] = src.read(1, window=temp_window)
+            values.flush()
+            del values
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def path_share(self):
+        return self._path_share
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    def connect(self) -> sqlite3.Connection:
+        '''
+        Open a new connection to the database. Every call opens its own connection, so the share can be used from several processes.
+        '''
+        conn = sqlite3.connect(self._path_db, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def register(self, product_id: str, num_consumers: int, window: rio.windows.Window) -> None:
+        '''
+        Set the number of jobs that will use a product in this run, and the window of the tile to decode. Called once per product, 
+        before the jobs start.
+        Args:
+            product_id (str): the ID of the S2 product.
+            num_consumers (int): the number of jobs using the product.
+            window (rio.windows.Window): the 10 m window covering the ROI of all these jobs, aligned to the 60 m grid of MSK_CLASSI_B00,
+                None not to share the bands of the product.
+        '''
+        self._windows[product_id] = window
+        with closing(self.connect()) as conn, conn:
+            conn.execute('''
+                INSERT INTO band_shares (product_id, refcount) VALUES (?, ?)
+                ON CONFLICT (product_id) DO UPDATE SET refcount = excluded.refcount''', (product_id, int(num_consumers)))
+
+    def clean(self, list_product_ids: list) -> None:
+        '''
+        Remove the decoded bands and the reference counts of all products but the given ones, i.e. the ones of the current plan.
+        Called once, before the products of the plan are registered.
+        '''
+        temp_keep = set(list_product_ids)
+        with closing(self.connect()) as conn, conn:
+            for (product_id,) in conn.execute('SELECT product_id FROM band_shares').fetchall():
+                if product_id not in temp_keep:
+                    conn.execute('DELETE FROM band_shares WHERE product_id = ?', (product_id,))
+        for product_id in os.listdir(self._path_share):
+            if product_id not in temp_keep:
+                shutil.rmtree(os.path.join(self._path_share, product_id), ignore_errors=True)
+
+    def get_window(self, product_id: str) -> rio.windows.Window:
+        '''
+        Get the 10 m window of the tile decoded for a product, as registered, or None if the bands of the product aren't shared.
+        '''
+        return self._windows.get(product_id)
+
+    def attach(self, product_id: str, dict_paths: dict) -> dict:
+        '''
+        Attach to the decoded bands of a product, decoding them first if no other job has done it yet.
+        Args:
+            product_id (str): the ID of the S2 product.
+            dict_paths (dict): from the band name, e.g. 'B04', to the path of the band file.
+        Returns:
+            dict: from the band name to its read-only memory-mapped array, covering the registered window (see get_window).
+        '''
+        window = self._windows[product_id]
+        temp_path_product = os.path.join(self._path_share, product_id)
+        if not os.path.exists(temp_path_product):
+            os.makedirs(temp_path_product, exist_ok=True)
+        dict_values = {}
+        for band, path_band in dict_paths.items():
+            # The 60 m window of the mask
+            temp_scale = 6 if band == 'MSK_CLASSI_B00' else 1
+            temp_window = rio.windows.Window(window.col_off // temp_scale, window.row_off // temp_scale, window.width // temp_scale, window.height // temp_scale)
+            # Named after the window, so that the bands decoded for another window are never used
+            temp_path_npy = os.path.join(temp_path_product, f"{band}_{window.col_off}_{window.row_off}_{window.width}_{window.height}.npy")
+            temp_path_lock = temp_path_npy + ".lock"
+            temp_start = time.time()
+            while not os.path.exists(temp_path_npy):
+                try:
+                    # Only the job holding the lock decodes the band, the others wait for the file
+                    fd = os.open(temp_path_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except FileExistsError:
+                    if time.time() - temp_start > self._timeout:
+                        raise TimeoutError(f"Waited more than {self._timeout} seconds for {band} of {product_id} to be decoded! Please remove '{temp_path_lock}' if no other run is active.")
+                    time.sleep(0.1)
+                    continue
+                try:
+                    print(f"Decoding {band} of the S2 product {product_id} into the shared cache......")
+                    temp_path_tmp = temp_path_npy + f".{os.getpid()}.tmp.npy"
+                    self.__decode(path_band, temp_path_tmp, temp_window)
+                    os.replace(temp_path_tmp, temp_path_npy)
+                finally:
+                    os.close(fd)
+                    os.remove(temp_path_lock)
+            dict_values[band] = np.load(temp_path_npy, mmap_mode='r')
+        return dict_values
+
+    def release(self, product_id: str) -> None:
+        '''
+        Tell that a job has finished with a product. When the last registered job has finished, the decoded bands are removed.
+        Jobs must drop their arrays before releasing the product.
+        '''
+        with closing(self.connect()) as conn, conn:
+            conn.execute('UPDATE band_shares SET refcount = refcount - 1 WHERE product_id = ?', (product_id,))
+            row = conn.execute('SELECT refcount FROM band_shares WHERE product_id = ?', (product_id,)).fetchone()
+            if row is None or row[0] > 0:
+                return
+            conn.execute('DELETE FROM band_shares WHERE product_id = ?', (product_id,))
+        shutil.rmtree(os.path.join(self._path_share, product_id), ignore_errors=True)
@@ -2,6 +2,10 @@ import os
 import csv
 from typing import Optional, Union
 import re
+import shutil
+import warnings
+import zipfile
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 import xarray as xr
@@ -9,22 +13,33 @@ from bs4 import BeautifulSoup
 import shapely as shp
 import geopandas as gpd
 import rasterio as rio
-import rasterio.mask
-from sklearn.metrics import r2_score
-from scipy.stats import linregress
-from sklearn.linear_model import LinearRegression
+import rasterio.windows
+import rasterio.shutil
+from results_store import ResultsStore, JobJournal
+from site_index import SiteIndex
+from flex_catalog import FlexCatalog
+from zonal_stats import ZonalStats, CellStats
+from geodesy import Geodesy
+from raster_pool import RasterPool
 
 class CalVal:
 
+    # FLEX image resolution
+    _FLEX_RESOLUTION = 300
+    # Open raster datasets, shared by all the jobs of the process
+    _raster_pool = RasterPool()
+
     # Constuctor
-    def __init__(self):
+    def __init__(self, path_main: Optional[str] = None):
         '''
         Initialize the class. 
+        Args:
+            path_main (str): the work directory, holding the input, output and cache folders. The folder of the script by default. 
         '''
 
         # -------------------------------- Attributes -------------------------------- #
-        # Current work directory (where the script is located)
-        self._path_main = os.path.realpath(os.path.dirname(__file__)) 
+        # Current work directory (where the script is located by default)
+        self._path_main = os.path.realpath(path_main if path_main is not None else os.path.dirname(__file__)) 
         # Input folder
         self._path_input = os.path.join(self.path_main, "input")
         # The absolute path of the S2 images
@@ -43,12 +58,23 @@ class CalVal:
         self._bool_delete_cache = False
         # Flex filename
         self.flex_filename = None
+        # The (site_code, flex_filename) pairs of the jobs of the current plan, the only ones read into the output tables; all jobs if None
+        self.plan_jobs = None
+        # Format of the output tables, "csv" by default or "parquet"
+        self._output_format = "csv"
 
         ### Automatically check
         self.__check_site_csv()
         self.__check_output()
         self.__check_cache()
 
+        # Results of all jobs, saved in the cache folder
+        self._results_store = ResultsStore(os.path.join(self._path_cache, "results.sqlite"))
+        # Journal of all jobs, to resume an interrupted run
+        self._job_journal = JobJournal(os.path.join(self._path_cache, "results.sqlite"))
+        # Spatial index of the sites, built by get_site_info
+        self._site_index = None
+
     # ------------------------------ Private Methods ----------------------------- #
 
     # Create an output folder if not exists
@@ -103,6 +129,31 @@ class CalVal:
     def bool_delete_cache(self):
         return self._bool_delete_cache
     
+    @property
+    def output_format(self):
+        return self._output_format
+    @output_format.setter
+    def output_format(self, value):
+        if value not in ["csv", "parquet"]:
+            raise ValueError("The output format can only be 'csv' or 'parquet'!")
+        self._output_format = value
+
+    @property
+    def results_store(self):
+        return self._results_store
+
+    @property
+    def job_journal(self):
+        return self._job_journal
+
+    @property
+    def raster_pool(self):
+        return self._raster_pool
+
+    @property
+    def site_index(self):
+        return self._site_index
+
     @property
     def file_flox_csv(self):
         return self._file_flox_csv
@@ -110,8 +161,99 @@ class CalVal:
     def file_flox_csv(self, value):
         self._file_flox_csv = value
 
+    # Central directory of a zipped SAFE archive, cached per archive as long as its size and modification time are unchanged
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def _list_zip_members(path_zip: str, mtime_ns: int, size: int) -> tuple:
+        with zipfile.ZipFile(path_zip) as z:
+            return tuple((info.filename, info.file_size) for info in z.infolist() if not info.is_dir())
+
     # ------------------------------ Public Methods ------------------------------ #
 
+    @staticmethod
+    def list_s2_files(path_safe: str) -> list:
+        '''
+        List all files of an S2 product, either an unzipped .SAFE folder or a zipped .SAFE archive (ending with ".zip"). 
+        Files inside an archive get GDAL "/vsizip/" paths, so that rasterio reads them without extracting the archive. 
+        Args:
+            path_safe (str): the path to the .SAFE folder or archive. 
+        Returns:
+            list: (path relative to the product, full path, size in bytes) of each file. 
+        '''
+        list_files = []
+        if path_safe.lower().endswith('.zip'):
+            temp_stat = os.stat(path_safe)
+            temp_path_zip = os.path.abspath(path_safe)
+            for member, size in CalVal._list_zip_members(temp_path_zip, temp_stat.st_mtime_ns, temp_stat.st_size):
+                list_files.append((member, f"/vsizip/{temp_path_zip}/{member}", size))
+        else:
+            for path, subdirs, files in os.walk(path_safe):
+                for name in files:
+                    temp = os.path.join(path, name)
+                    list_files.append((os.path.relpath(temp, path_safe), temp, os.path.getsize(temp)))
+        return list_files
+
+    @staticmethod
+    def read_text(path: str) -> str:
+        '''
+        Read a text file, which can also be a "/vsizip/" path to a member of a zipped archive. 
+        '''
+        if path.startswith('/vsizip/'):
+            temp_index = path.lower().index('.zip/') + len('.zip')
+            with zipfile.ZipFile(path[len('/vsizip/'):temp_index]) as z:
+                return z.read(path[temp_index + 1:]).decode('utf-8')
+        with open(path, 'r') as f:
+            return f.read()
+
+    def get_flex_path(self, site_name: str, flex_filename: str) -> str:
+        '''
+        Get the path to a FLEX image of a site: in the folder of the site if it is there, otherwise directly in the folder of the FLEX images. 
+        '''
+        temp_path = os.path.join(self.path_flex_input, site_name, flex_filename)
+        if os.path.exists(temp_path):
+            return temp_path
+        return os.path.join(self.path_flex_input, flex_filename)
+
+    @staticmethod
+    def get_flex_window(latitudes: np.ndarray, longitudes: np.ndarray, site_lat: float, site_lon: float, roi: int) -> tuple:
+        '''
+        Find the FLEX pixels of the ROI of a site: a window of N x N pixels, N = roi / 300, whose centre is the nearest to the site, i.e. 
+        centred on the pixel of the site when N is odd, and on the pixel corner nearest to the site when N is even. 
+        Near the edges of the grid, the window is cut to the pixels of the grid. 
+        Args:
+            latitudes (np.ndarray): the latitudes of the pixel centres, ascending or descending. 
+            longitudes (np.ndarray): the longitudes of the pixel centres, ascending or descending. 
+            site_lat (float): the latitude of the site. 
+            site_lon (float): the longitude of the site. 
+            roi (int): the size of the ROI in m, a multiple of 300. 
+        Returns:
+            tuple: (the slice of the latitude axis, the slice of the longitude axis). 
+        '''
+        num_pixels = int(roi // CalVal._FLEX_RESOLUTION)
+        list_slices = []
+        for coords, value in [(latitudes, site_lat), (longitudes, site_lon)]:
+            coords = np.asarray(coords, dtype=float)
+            temp_step = coords[1] - coords[0]
+            # Position of the site in pixels, from the centre of the first pixel
+            temp_position = (value - coords[0]) / temp_step
+            if temp_position < -0.5 or temp_position > len(coords) - 0.5:
+                raise ValueError(f"The site ({site_lat}, {site_lon}) is outside the FLEX image!")
+            temp_start = int(np.floor(temp_position - (num_pixels - 1) / 2 + 0.5))
+            list_slices.append(slice(max(temp_start, 0), min(temp_start + num_pixels, len(coords))))
+        return tuple(list_slices)
+
+    @staticmethod
+    def read_flex_window(temp_ds: xr.Dataset, list_vars: list, lat_slice: slice, lon_slice: slice) -> np.ndarray:
+        '''
+        Read the pixels of a window of several variables of a FLEX image at once. 
+        Returns:
+            np.ndarray: one row per variable, one column per pixel of the window. 
+        '''
+        if len(list_vars) == 0:
+            return np.empty((0, 0))
+        temp_values = temp_ds[list_vars].isel(latitude=lat_slice, longitude=lon_slice).to_array().values
+        return temp_values.reshape(len(list_vars), -1)
+
     # Create a pandas dataframe using Sites.csv
     def get_site_info(self):
         df_sites = pd.read_csv(self.file_site_csv)
@@ -142,8 +284,8 @@ class CalVal:
         
         # reference_area
         site_roi = df_sites["reference_area(m)"]
-        if not site_roi.isin([300, 600, 900]).all():
-            raise ValueError("The input reference area(m) can only be 300, 600 or 900")
+        if not ((site_roi > 0) & (site_roi % self._FLEX_RESOLUTION == 0)).all():
+            raise ValueError(f"The input reference area(m) can only be a multiple of the FLEX resolution, {self._FLEX_RESOLUTION} m, such as 300, 600 or 900")
 
         # time_window_days
         site_time_window = df_sites["time_window(days)"]
@@ -168,25 +310,71 @@ class CalVal:
             "Vegetation Pixel": site_vegetation_pixel,
             "Threshold Cloud": site_threshold_cloud
         })
+        # Spatial index of the sites, to find the sites covered by the S2 tiles or FLEX scenes in bulk
+        self._site_index = SiteIndex(df_sites)
         print("'Sites.csv' read successfully!")
         return df_sites
     
+    def write_output(self, df: pd.DataFrame, table_name: str, na_rep: str = '') -> None:
+        '''
+        Write an output table, either as a .csv file or as a Parquet dataset partitioned by site and year. 
+        In Parquet mode, the columns are typed and the full spectrum is stored in long form (one row per wavelength). 
+        Args:
+            df (pd.DataFrame): the table to write. 
+            table_name (str): the name of the table, e.g. "L2B_1P_matchup". 
+            na_rep (str): representation of missing values in the .csv file. 
+        '''
+        if self.output_format == "csv":
+            df.to_csv(os.path.join(self.path_output, table_name + ".csv"), index=False, na_rep=na_rep)
+            return
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("The Parquet output needs the package 'pyarrow'! Please install it or use the csv output format.")
+        df = df.replace('N/A', np.nan)
+        # Type the columns: identifiers, dates and notes are strings, everything else that is numeric becomes numeric
+        list_str_columns = ['site_code', 'date', 'flex_date', 'flex_time', 'flex_filename', 's2_filename', 's2_date', 's2_time', 'note']
+        for col in df.columns:
+            if col in list_str_columns:
+                df[col] = df[col].astype('string')
+            elif df[col].dtype == object:
+                temp_numeric = pd.to_numeric(df[col], errors='coerce')
+                if temp_numeric.notna().sum() == df[col].notna().sum():
+                    df[col] = temp_numeric
+        # Full spectrum in long form
+        list_spectrum = [col for col in df.columns if "Sif Emission Spectrum_sif_wavelength_grid=" in col]
+        if list_spectrum:
+            df = df.melt(id_vars=[col for col in df.columns if col not in list_spectrum], value_vars=list_spectrum,
+                         var_name='wavelength', value_name='sif')
+            df['wavelength'] = df['wavelength'].str.split('=').str[-1].astype(float)
+        # Partition columns
+        col_date = 'flex_date' if 'flex_date' in df.columns else 'date'
+        df['year'] = df[col_date].str[:4].fillna('unknown').astype(object)
+        path_dataset = os.path.join(self.path_output, table_name + ".parquet")
+        if os.path.exists(path_dataset):
+            shutil.rmtree(path_dataset)
+        df.to_parquet(path_dataset, partition_cols=['site_code', 'year'], index=False)
+
+    def read_output(self, table_name: str) -> pd.DataFrame:
+        '''
+        Read an output table written by write_output. 
+        Args:
+            table_name (str): the name of the table, e.g. "L2B_1P_matchup". 
+        Returns:
+            pd.DataFrame: the table. In Parquet mode the spectrum stays in long form. 
+        '''
+        if self.output_format == "csv":
+            return pd.read_csv(os.path.join(self.path_output, table_name + ".csv"))
+        df = pd.read_parquet(os.path.join(self.path_output, table_name + ".parquet"))
+        df['site_code'] = df['site_code'].astype(str)
+        return df.drop(columns=['year'])
+
     def create_matchup_report(self):
         # Merge transfer function output
-        df_tf = pd.concat((pd.read_csv(os.path.join(self.path_cache,'TF',csv_file)) for csv_file in os.listdir(os.path.join(self.path_cache,'TF'))), ignore_index=True)
+        df_tf = self.results_store.read_table('TF', self.plan_jobs)
         df_tf['date'] = df_tf['date'].astype(str)
-        df_tf.rename(columns={
-            "SIF_O2A": "SIF_O2A_TF",
-            "SIF_FARRED_max": "SIF_FARRED_max_TF",
-            "SIF_int": "SIF_int_TF",
-            "SIF_O2B": "SIF_O2B_TF",
-            "SIF_RED_max": "SIF_RED_max_TF",
-            "SIF_O2A_un": "SIF_O2A_un_TF",
-            "SIF_FARRED_max_un": "SIF_FARRED_max_un_TF",
-            "SIF_int_un": "SIF_int_un_TF",
-            "SIF_O2B_un": "SIF_O2B_un_TF",
-            "SIF_RED_max_un": "SIF_RED_max_un_TF"
-        }, inplace = True)
+        # Add the suffix "_TF" to all SIF columns, including the Monte Carlo ones if present
+        df_tf.rename(columns={col: col + "_TF" for col in df_tf.columns if col.startswith("SIF_")}, inplace = True)
         # Read FLOX
         df_flox = pd.read_csv(self.file_flox_csv, sep = ';')
         df_flox = df_flox[['ID_SITE','UTC_datetime','SIF_FARRED_max','SIF_FARRED_max_wvl','SIF_RED_max','SIF_RED_max_wvl','SIF_O2B','SIF_O2A','SIF_int','SIF_FARRED_max_un','SIF_FARRED_max_wvl_un','SIF_RED_max_un','SIF_RED_max_wvl_un','SIF_O2B_un','SIF_O2A_un','SIF_int_un']]
@@ -195,31 +383,68 @@ class CalVal:
         # Convert to string date format
         df_flox['date'] = df_flox['date'].dt.strftime('%Y%m%d')
         # Read FLEX
-        df_flex = pd.read_csv(os.path.join(self.path_cache,"L2B_FLEX_table.csv"))
+        df_flex = self.results_store.read_table('FLEX_sif', self.plan_jobs)
         df_flex = df_flex[['site_code','latitude','longitude','flex_date','flex_time','flex_filename','s2_filename','SIF_FARRED_max','SIF_FARRED_max_wvl','SIF_RED_max','SIF_RED_max_wvl','SIF_O2B','SIF_O2A','SIF_int','SIF_FARRED_max_un','SIF_FARRED_max_wvl_un','SIF_RED_max_un','SIF_RED_max_wvl_un','SIF_O2B_un','SIF_O2A_un','SIF_int_un']]
         df_flex.rename(columns={'flex_date': 'date'}, inplace=True)
         df_flex['date'] = df_flex['date'].astype(str)
         # Merge into a single dataframe
         df_merge = pd.merge(df_flox,df_flex,how='inner',on=['site_code','date'], suffixes=('_flox','_flex'))
         df_merge = pd.merge(df_merge,df_tf,how='inner',on=['site_code','date'])
-        df_merge.to_csv(os.path.join(self.path_output,"L2B_1P_matchup.csv"), index=False, na_rep= 'N/A')
+        self.write_output(df_merge, "L2B_1P_matchup", na_rep='N/A')
 
-class FLEX(CalVal):
+    def create_pixel_matchup_report(self):
+        '''
+        Put the S2 indices of every FLEX pixel of the ROI of each job next to the SIF values of the same pixel, one row per FLEX pixel.
+        '''
+        df_flex = self.results_store.read_table('FLEX_pixels', self.plan_jobs)
+        df_s2 = self.results_store.read_table('S2_pixels', self.plan_jobs)
+        if df_flex.empty or df_s2.empty:
+            print("\033[91mNo job has per-pixel results, the pixel matchup report is not created!\033[0m")
+            return
+        df_merge = pd.merge(df_flex, df_s2, how='inner', on=['site_code', 'flex_filename', 's2_filename', 'flex_row', 'flex_col'])
+        df_merge['flex_date'] = df_merge['flex_date'].astype(str)
+        df_merge['flex_time'] = df_merge['flex_time'].astype(str)
+        self.write_output(df_merge, "L2B_1P_pixel_matchup", na_rep='N/A')
 
-    # FLEX image resolution
-    _FLEX_RESOLUTION = 300
+class FLEX(CalVal):
 
-    def __init__(self):
-        super().__init__()
+    # Pairs of [reference column, FLEX column] of the validation reports against FLOX and against the transfer functions
+    _COLUMN_PAIRS_FLOX = [
+        ['SIF_FARRED_max_flox', 'SIF_FARRED_max_flex'],
+        ['SIF_FARRED_max_wvl_flox', 'SIF_FARRED_max_wvl_flex'],
+        ['SIF_RED_max_flox', 'SIF_RED_max_flex'],
+        ['SIF_RED_max_wvl_flox', 'SIF_RED_max_wvl_flex'],
+        ['SIF_O2B_flox', 'SIF_O2B_flex'],
+        ['SIF_O2A_flox', 'SIF_O2A_flex'],
+        ['SIF_int_flox', 'SIF_int_flex']]
+    _COLUMN_PAIRS_TF = [
+        ['SIF_FARRED_max_TF', 'SIF_FARRED_max_flex'],
+        ['SIF_RED_max_TF', 'SIF_RED_max_flex'],
+        ['SIF_O2B_TF', 'SIF_O2B_flex'],
+        ['SIF_O2A_TF', 'SIF_O2A_flex'],
+        ['SIF_int_TF', 'SIF_int_flex']]
+
+    def __init__(self, path_main: Optional[str] = None):
+        super().__init__(path_main)
         # Input FLEX Images path
 
         # ROI size
         self._area_roi = 900
         # Vegetation pixel percentage! 
         self._vegetation_pixel = 0.5
+        # Bootstrap confidence intervals of the validation metrics, disabled by default
+        self._bool_bootstrap = False
+        # Default number of bootstrap resamples
+        self._num_bootstrap = 2000
+        # Default confidence level of the bootstrap intervals
+        self._confidence_level = 0.95
+        # Seed of the bootstrap random generator, None for a random seed
+        self.random_seed = None
 
         # Check input flex images folder
         self.__check_input()
+        # Catalog of the FLEX images, saved in the cache folder
+        self._flex_catalog = FlexCatalog(self.path_flex_input, self.results_store.path_db)
     # ------------------------------ Private Methods ----------------------------- #
 
     def __check_input(self):
@@ -230,6 +455,10 @@ class FLEX(CalVal):
         
     # ----------------------------- Getter and Setter ---------------------------- #
     
+    @property
+    def flex_catalog(self):
+        return self._flex_catalog
+
     # Getter and setter for ROI
     @property
     def area_roi(self):
@@ -257,6 +486,32 @@ class FLEX(CalVal):
             raise ValueError("The valid vegetation pixel percentage must be between 0 and 1!")
         self._vegetation_pixel = value
 
+    # Getter and setter for the bootstrap
+    @property
+    def bool_bootstrap(self):
+        return self._bool_bootstrap
+    @bool_bootstrap.setter
+    def bool_bootstrap(self, value):
+        self._bool_bootstrap = bool(value)
+
+    @property
+    def num_bootstrap(self):
+        return self._num_bootstrap
+    @num_bootstrap.setter
+    def num_bootstrap(self, value):
+        if int(value) < 2:
+            raise ValueError("The number of bootstrap resamples must be at least 2!")
+        self._num_bootstrap = int(value)
+
+    @property
+    def confidence_level(self):
+        return self._confidence_level
+    @confidence_level.setter
+    def confidence_level(self, value):
+        if value <= 0 or value >= 1:
+            raise ValueError("The confidence level must be between 0 and 1!")
+        self._confidence_level = value
+
     # ------------------------------ Public Methods ------------------------------ #
     ## Check file name convention
     # PRS_TD_20230616_101431.nc 
@@ -284,68 +539,20 @@ class FLEX(CalVal):
     ## SIF Calculation
     def cal_sif(self, site_name: str, filename: str, site_lon: Union[int, float], site_lat: Union[int, float], roi: int, s2_filename: str) -> None:
         # Open the FLEX image
-        temp_ds = xr.open_dataset(os.path.join(self.path_flex_input,site_name,filename))
-        # Read longitudes and latitudes from the dataset
-        longitudes = temp_ds['longitude'].values
-        latitudes = temp_ds['latitude'].values
-        # Get the indices of the closest longitudes and latitudes to the site
-        lon_left = np.where(longitudes <= site_lon)[0][-1]
-        lon_right = np.where(longitudes >= site_lon)[0][0]
-        lat_top = np.where(latitudes >= site_lat)[0][-1]
-        lat_bottom = np.where(latitudes <= site_lat)[0][0]
-        # print(f"lon_left: {lon_left}, lon_right: {lon_right}, lat_top: {lat_top}, lat_bottom: {lat_bottom}")
-        # Now find the indices of the pixel where the site is located
-        if abs(site_lon - longitudes[lon_left]) < abs(site_lon - longitudes[lon_right]):
-            lon_index = lon_left
-        else:
-            lon_index = lon_right
-        if abs(site_lat - latitudes[lat_top]) < abs(site_lat - latitudes[lat_bottom]):
-            lat_index = lat_top
-        else:
-            lat_index = lat_bottom
-
-        # Prepare empty lists to store results of each loop
-        temp_list_sif_name = []
-        temp_list_sif_avg = []
-        temp_list_sif_std = []
-        temp_name_rar = list(temp_ds.data_vars)
-
-        for var_name in temp_name_rar:
-            if "Sif Emission Spectrum_sif_wavelength_grid" in var_name:
-                if roi == 300:
-                    temp_array = temp_ds[var_name][lat_index,lon_index].values
-                elif roi == 600:
-                    if abs(site_lat - latitudes[lat_index - 1]) < abs(site_lat - latitudes[lat_index + 1]):
-                        lat_index_600 = lat_index - 1
-                    else:
-                        lat_index_600 = lat_index + 1
-                    if abs(site_lon - longitudes[lon_index - 1]) < abs(site_lon - longitudes[lon_index + 1]):
-                        lon_index_600 = lon_index - 1
-                    else:
-                        lon_index_600 = lon_index + 1
-                    lat_index_start = min(lat_index_600, lat_index)
-                    lat_index_end = max(lat_index_600, lat_index)
-                    lon_index_start = min(lon_index_600, lon_index)
-                    lon_index_end = min(lon_index_600, lon_index)
-                    temp_array = temp_ds[var_name][lat_index_start:(lat_index_end+1),lon_index_start:(lon_index_end+1)].values
-                else:
-                    temp_array = temp_ds[var_name][(lat_index-1):(lat_index+2),(lon_index-1):(lon_index+2)].values
-                temp_list_sif_name.append(var_name)
-                temp_avg = np.average(temp_array).item()
-                temp_list_sif_avg.append(temp_avg)
-                temp_std = np.std(temp_array).item()
-                temp_list_sif_std.append(temp_std)
+        temp_ds = xr.open_dataset(self.get_flex_path(site_name, filename))
+        # All SIF spectrum variables, averaged over the ROI in one slice and one reduction
+        temp_list_sif_name = [var_name for var_name in temp_ds.data_vars if "Sif Emission Spectrum_sif_wavelength_grid" in var_name]
+        temp_lat_slice, temp_lon_slice = self.get_flex_window(temp_ds['latitude'].values, temp_ds['longitude'].values, site_lat, site_lon, roi)
+        temp_array = self.read_flex_window(temp_ds, temp_list_sif_name, temp_lat_slice, temp_lon_slice)
+        temp_list_sif_avg = temp_array.mean(axis=1).tolist()
+        temp_list_sif_std = temp_array.std(axis=1).tolist()
+        temp_ds.close()
         temp_list_sif_name = ['site_code','latitude','longitude','flex_date','flex_time','flex_filename','s2_filename'] + temp_list_sif_name
         temp_list_sif_avg = [site_name, site_lat, site_lon, filename.split('.')[0].split('_')[-2], filename.split('.')[0].split('_')[-1], filename, s2_filename] + temp_list_sif_avg
         temp_list_sif_std = [site_name, site_lat, site_lon, filename.split('.')[0].split('_')[-2], filename.split('.')[0].split('_')[-1], filename, s2_filename] + temp_list_sif_std
-        temp_df_sif_avg = pd.DataFrame([temp_list_sif_avg], columns = temp_list_sif_name)
-        temp_df_sif_std = pd.DataFrame([temp_list_sif_std], columns = temp_list_sif_name)
-        if not os.path.exists(os.path.join(self.path_cache,'FLEX', 'avg')):
-            os.makedirs(os.path.join(self.path_cache,'FLEX', 'avg'))
-        if not os.path.exists(os.path.join(self.path_cache,'FLEX', 'std')):
-            os.makedirs(os.path.join(self.path_cache,'FLEX', 'std'))
-        temp_df_sif_avg.to_csv(os.path.join(self.path_cache,'FLEX','avg',site_name + "_" + filename + ".csv"), index = False)
-        temp_df_sif_std.to_csv(os.path.join(self.path_cache,'FLEX','std',site_name + "_" + filename + ".csv"), index = False)
+        # Save to the results store
+        self.results_store.upsert('FLEX_avg', site_name, filename, s2_filename, dict(zip(temp_list_sif_name, temp_list_sif_avg)))
+        self.results_store.upsert('FLEX_std', site_name, filename, s2_filename, dict(zip(temp_list_sif_name, temp_list_sif_std)))
 
     def sif_output(self, site_name: str, filename: str, site_lon: Union[int, float], site_lat: Union[int, float], roi: int, s2_filename: str) -> list:
         '''
@@ -361,199 +568,470 @@ class FLEX(CalVal):
             list_value: list, a list of average values of SIF metrics in a 3x3 pixel ROI of a FLEX image of a site: 
         '''
         # Open the FLEX image
-        temp_ds = xr.open_dataset(os.path.join(self.path_flex_input,site_name,filename))
-        # Read longitudes and latitudes from the dataset
-        longitudes = temp_ds['longitude'].values
-        latitudes = temp_ds['latitude'].values
-        # Get the indices of the closest longitudes and latitudes to the site
-        lon_left = np.where(longitudes <= site_lon)[0][-1]
-        lon_right = np.where(longitudes >= site_lon)[0][0]
-        lat_top = np.where(latitudes >= site_lat)[0][-1]
-        lat_bottom = np.where(latitudes <= site_lat)[0][0]
-        # print(f"lon_left: {lon_left}, lon_right: {lon_right}, lat_top: {lat_top}, lat_bottom: {lat_bottom}")
-        # Now find the indices of the pixel where the site is located
-        if abs(site_lon - longitudes[lon_left]) < abs(site_lon - longitudes[lon_right]):
-            lon_index = lon_left
-        else:
-            lon_index = lon_right
-        if abs(site_lat - latitudes[lat_top]) < abs(site_lat - latitudes[lat_bottom]):
-            lat_index = lat_top
-        else:
-            lat_index = lat_bottom
-
-        # Prepare empty lists to store results of each loop
-        temp_list_sif_name = []
-        temp_list_sif_avg = []
-
+        temp_ds = xr.open_dataset(self.get_flex_path(site_name, filename))
         # Get all variable names in the dataset
-        temp_name_rar = list(temp_ds.data_vars)
         list_indices = ['SIF_FARRED_max','SIF_FARRED_max_wvl','SIF_RED_max','SIF_RED_max_wvl','SIF_O2B','SIF_O2A','SIF_int','SIF_FARRED_max_un','SIF_FARRED_max_wvl_un','SIF_RED_max_un','SIF_RED_max_wvl_un','SIF_O2B_un','SIF_O2A_un','SIF_int_un']
+        temp_list_sif_name = [var_name for var_name in temp_ds.data_vars if var_name in list_indices]
 
-        # Loop through each variable name and calculate the average value in the ROI
-        for var_name in temp_name_rar:
-            if var_name in list_indices:
-                if roi == 300:
-                    temp_array = temp_ds[var_name][lat_index,lon_index].values
-                elif roi == 600:
-                    if abs(site_lat - latitudes[lat_index - 1]) < abs(site_lat - latitudes[lat_index + 1]):
-                        lat_index_600 = lat_index - 1
-                    else:
-                        lat_index_600 = lat_index + 1
-                    if abs(site_lon - longitudes[lon_index - 1]) < abs(site_lon - longitudes[lon_index + 1]):
-                        lon_index_600 = lon_index - 1
-                    else:
-                        lon_index_600 = lon_index + 1
-                    lat_index_start = min(lat_index_600, lat_index)
-                    lat_index_end = max(lat_index_600, lat_index)
-                    lon_index_start = min(lon_index_600, lon_index)
-                    lon_index_end = min(lon_index_600, lon_index)
-                    temp_array = temp_ds[var_name][lat_index_start:(lat_index_end+1),lon_index_start:(lon_index_end+1)].values
-                else:
-                    temp_array = temp_ds[var_name][(lat_index-1):(lat_index+2),(lon_index-1):(lon_index+2)].values
-                temp_list_sif_name.append(var_name)
-                temp_avg = np.average(temp_array).item()
-                temp_list_sif_avg.append(temp_avg)
+        # Average value of all variables in the ROI, in one slice and one reduction
+        latitudes = temp_ds['latitude'].values
+        longitudes = temp_ds['longitude'].values
+        temp_lat_slice, temp_lon_slice = self.get_flex_window(latitudes, longitudes, site_lat, site_lon, roi)
+        temp_array = self.read_flex_window(temp_ds, temp_list_sif_name, temp_lat_slice, temp_lon_slice)
+        temp_list_sif_avg = temp_array.mean(axis=1).tolist()
+        temp_ds.close()
+
+        # Values of every FLEX pixel of the ROI, to be compared with the S2 indices of the same pixel (see S2.cal_flex_pixel_indices)
+        temp_rows, temp_cols = np.meshgrid(np.arange(temp_lat_slice.start, temp_lat_slice.stop), np.arange(temp_lon_slice.start, temp_lon_slice.stop), indexing='ij')
+        df_pixels = pd.DataFrame({'site_code': site_name, 'flex_date': filename.split('.')[0].split('_')[-2], 'flex_time': filename.split('.')[0].split('_')[-1],
+                                  'flex_filename': filename, 's2_filename': s2_filename, 'flex_row': temp_rows.ravel(), 'flex_col': temp_cols.ravel(),
+                                  'latitude': latitudes[temp_rows.ravel()], 'longitude': longitudes[temp_cols.ravel()]})
+        for var_name, values in zip(temp_list_sif_name, temp_array):
+            df_pixels[var_name] = values
+        self.results_store.upsert('FLEX_pixels', site_name, filename, s2_filename, df_pixels.to_dict(orient='records'))
 
         # Output as a list
         list_header = ['site_code', 'latitude', 'longitude', 'flex_date', 'flex_time', 'flex_filename', 's2_filename'] + temp_list_sif_name
         list_value = [site_name, site_lat, site_lon, filename.split('.')[0].split('_')[-2], filename.split('.')[0].split('_')[-1], filename, s2_filename] + temp_list_sif_avg
 
-        # Export to the cache folder. This output csv file will be used for validation with FLOX data later. 
-        if not os.path.exists(os.path.join(self.path_cache, 'FLEX', 'sif')):
-            os.makedirs(os.path.join(self.path_cache, 'FLEX', 'sif'))
-        pd.DataFrame([list_value], columns=list_header).to_csv(os.path.join(self.path_cache, 'FLEX', 'sif',f'{site_name}_{filename}.csv'), index=False)
+        # Export to the results store. This record will be used for validation with FLOX data later. 
+        self.results_store.upsert('FLEX_sif', site_name, filename, s2_filename, dict(zip(list_header, list_value)))
     
     def cal_statistic_flex_flox(self) -> None:
         # Read matchup.csv
-        df_merge = pd.read_csv(os.path.join(self.path_output,"L2B_1P_matchup.csv"))
-        num_sites = df_merge['site_code'].nunique()
-        num_flex_img = df_merge['date'].nunique()
-        #
-        column_pairs = [
-            ['SIF_FARRED_max_flox', 'SIF_FARRED_max_flex'],
-            ['SIF_FARRED_max_wvl_flox', 'SIF_FARRED_max_wvl_flex'],
-            ['SIF_RED_max_flox', 'SIF_RED_max_flex'],
-            ['SIF_RED_max_wvl_flox', 'SIF_RED_max_wvl_flex'],
-            ['SIF_O2B_flox', 'SIF_O2B_flex'],
-            ['SIF_O2A_flox', 'SIF_O2A_flex'],
-            ['SIF_int_flox', 'SIF_int_flex']]
-        list_r_2 = []
-        list_rmse = []
-        list_mean_residual = []
-        list_random_uncertainty = []
-        list_slope = []
-        list_intercept = []
-        for pair in column_pairs:
-            # print(f"Calculating statistics for {pair[0]} and {pair[1]}...")
-            temp_r_2, temp_slope, temp_intercept = self.cal_r_2(df_merge[pair[0]],df_merge[pair[1]])
-            temp_rmse = self.cal_rmse(df_merge[pair[0]],df_merge[pair[1]])
-            temp_mean_residual = self.cal_mean_residual(df_merge[pair[0]],df_merge[pair[1]])
-            temp_random_uncertainty = self.cal_random_uncertainty(df_merge[pair[0]],df_merge[pair[1]],temp_mean_residual)
-            list_r_2.append(temp_r_2)
-            list_rmse.append(temp_rmse)
-            list_mean_residual.append(temp_mean_residual)
-            list_random_uncertainty.append(temp_random_uncertainty)
-            list_slope.append(temp_slope)
-            list_intercept.append(temp_intercept)
-        df_output = pd.DataFrame(
-            {
-            "Metrics": ['R^2', 'RMSE', 'Bias', 'Slope', 'Intercept', 'Random uncertainty'],
-            'n_sites': [num_sites] * 6,
-            'n_images': [num_flex_img] * 6,
-            'SIF_FARRED_max': [list_r_2[0], list_rmse[0], list_mean_residual[0], list_slope[0], list_intercept[0], list_random_uncertainty[0]],
-            'SIF_FARRED_max_wvl': [list_r_2[1], list_rmse[1], list_mean_residual[1], list_slope[1], list_intercept[1], list_random_uncertainty[1]],
-            'SIF_RED_max': [list_r_2[2], list_rmse[2], list_mean_residual[2], list_slope[2], list_intercept[2], list_random_uncertainty[2]],
-            'SIF_RED_max_wvl': [list_r_2[3], list_rmse[3], list_mean_residual[3], list_slope[3], list_intercept[3], list_random_uncertainty[3]],
-            'SIF_O2B': [list_r_2[4], list_rmse[4], list_mean_residual[4], list_slope[4], list_intercept[4], list_random_uncertainty[4]],
-            'SIF_O2A': [list_r_2[5], list_rmse[5], list_mean_residual[5], list_slope[5], list_intercept[5], list_random_uncertainty[5]],
-            'SIF_int': [list_r_2[6], list_rmse[6], list_mean_residual[6], list_slope[6], list_intercept[6], list_random_uncertainty[6]]
-        })
+        df_merge = self.read_output("L2B_1P_matchup")
+        column_pairs = self._COLUMN_PAIRS_FLOX
+        # Only the partials of the new or changed sites and dates of the matchup table are calculated again
+        df_stats = self.update_statistics_store(df_merge, column_pairs, "L2B_1P_validation")
+        df_output = self.create_validation_report(df_stats)
+        if self.bool_bootstrap:
+            df_output = self.add_bootstrap_intervals(df_output, df_merge, column_pairs)
         df_output.to_csv(os.path.join(self.path_output,"L2B_1P_validation_report.csv"), index = False)
+        # Stratified report per site, month, reference area and S2-FLEX time difference
+        df_stratified = self.create_stratified_report(df_merge, column_pairs)
+        df_stratified.to_csv(os.path.join(self.path_output,"L2B_1P_stratified_validation_report.csv"), index = False)
     
     def cal_statistic_flex_tf(self) -> None:
         # Read matchup.csv
-        df_merge = pd.read_csv(os.path.join(self.path_output,"L2B_1P_matchup.csv"))
-        # Remove empty rows
-        df_merge.replace('', np.nan, inplace=True)
-        df_merge.replace('N/A', np.nan, inplace=True)
-        df_merge.dropna(inplace = True)
-        # Get number of sites and iamges
-        num_sites = df_merge['site_code'].nunique()
-        num_flex_img = df_merge['date'].nunique()
-        #
-        column_pairs = [
-            ['SIF_FARRED_max_TF', 'SIF_FARRED_max_flex'],
-            ['SIF_RED_max_TF', 'SIF_RED_max_flex'],
-            ['SIF_O2B_TF', 'SIF_O2B_flex'],
-            ['SIF_O2A_TF', 'SIF_O2A_flex'],
-            ['SIF_int_TF', 'SIF_int_flex']]
-        list_r_2 = []
-        list_rmse = []
-        list_mean_residual = []
-        list_random_uncertainty = []
-        list_slope = []
-        list_intercept = []
-        for pair in column_pairs:
-            # print(f"Calculating statistics for {pair[0]} and {pair[1]}...")
-            temp_r_2, temp_slope, temp_intercept = self.cal_r_2(df_merge[pair[0]],df_merge[pair[1]])
-            temp_rmse = self.cal_rmse(df_merge[pair[0]],df_merge[pair[1]])
-            temp_mean_residual = self.cal_mean_residual(df_merge[pair[0]],df_merge[pair[1]])
-            temp_random_uncertainty = self.cal_random_uncertainty(df_merge[pair[0]],df_merge[pair[1]],temp_mean_residual)
-            list_r_2.append(temp_r_2)
-            list_rmse.append(temp_rmse)
-            list_mean_residual.append(temp_mean_residual)
-            list_random_uncertainty.append(temp_random_uncertainty)
-            list_slope.append(temp_slope)
-            list_intercept.append(temp_intercept)
-        df_output = pd.DataFrame(
-            {
+        df_merge = self.read_output("L2B_1P_matchup")
+        column_pairs = self._COLUMN_PAIRS_TF
+        # Only the partials of the new or changed sites and dates of the matchup table are calculated again
+        df_stats = self.update_statistics_store(df_merge, column_pairs, "L2B_1P_TF_validation")
+        df_output = self.create_validation_report(df_stats)
+        if self.bool_bootstrap:
+            df_output = self.add_bootstrap_intervals(df_output, df_merge, column_pairs)
+        df_output.to_csv(os.path.join(self.path_output,"L2B_1P_TF_validation_report.csv"), index = False)
+        # Stratified report per site, month, reference area and S2-FLEX time difference
+        df_stratified = self.create_stratified_report(df_merge, column_pairs)
+        df_stratified.to_csv(os.path.join(self.path_output,"L2B_1P_TF_stratified_validation_report.csv"), index = False)
+
+    def sweep_thresholds(self, list_threshold_cv: list, list_threshold_cloud: list, list_vegetation_pixel: Optional[list] = None) -> tuple:
+        '''
+        Test a grid of thresholds from the raw quantities saved by a previous run (tables "S2_valid" and "S2_indices" of the results 
+        store and the matchup table), without reading any image. The CV flags, the pass/fail decisions of the valid pixels and the 
+        validation reports of all combinations are calculated together: the flags by broadcasting the saved CVs against the thresholds, 
+        the reports by a single product of the pass/fail matrix with the sufficient statistics of each job. 
+        Jobs that would pass a looser cloud threshold than the one of the run have no FLEX nor TF results and are only counted. 
+        Args:
+            list_threshold_cv (list): thresholds of CV, between 0 and 1. 
+            list_threshold_cloud (list): minimum ratios of valid pixels, between 0 and 1. 
+            list_vegetation_pixel (list): thresholds of vegetation pixels, between 0 and 1. Defaults to the current one. 
+        Returns:
+            tuple: (the flags, one row per job and combination of thresholds; the validation reports, one row per combination, report and variable). 
+        '''
+        if list_vegetation_pixel is None:
+            list_vegetation_pixel = [self.vegetation_pixel]
+        df_valid = self.results_store.read_table('S2_valid')
+        if len(df_valid) == 0:
+            raise ValueError("No saved valid pixels found in the results store! Please run the code once, keeping the cache folder, before sweeping thresholds!")
+        df_indices = self.results_store.read_table('S2_indices')
+        df_jobs = df_valid[['site_code', 'date', 'flex_filename', 's2_filename', 'valid_ratio']].copy()
+        if len(df_indices) > 0:
+            df_jobs = df_jobs.merge(df_indices[['site_code', 'flex_filename', 's2_filename', 'ndvi_cv', 'nirv_cv']], how='left', on=['site_code', 'flex_filename', 's2_filename'])
+        else:
+            df_jobs['ndvi_cv'] = np.nan
+            df_jobs['nirv_cv'] = np.nan
+        df_jobs['site_code'] = df_jobs['site_code'].astype(str)
+        df_jobs['date'] = df_jobs['date'].astype(str)
+        df_jobs['flex_filename'] = df_jobs['flex_filename'].astype(str)
+        # The vegetation pixel check of FLEX images is still pending, so all FLEX images count 100% vegetation pixels as in the log report
+        df_jobs['vegetation_ratio'] = 1.0
+
+        # Grid of thresholds, one column per combination
+        grid = np.array(np.meshgrid(list_threshold_cv, list_threshold_cloud, list_vegetation_pixel, indexing='ij'), dtype=float).reshape(3, -1)
+        num_jobs, num_combinations = len(df_jobs), grid.shape[1]
+        bool_pass = (df_jobs['valid_ratio'].values[:, None] >= grid[1][None, :]) & (df_jobs['vegetation_ratio'].values[:, None] >= grid[2][None, :])
+        with np.errstate(invalid='ignore'):
+            ndvi_flag = np.where(np.isnan(df_jobs['ndvi_cv'].values[:, None]), np.nan, df_jobs['ndvi_cv'].values[:, None] <= grid[0][None, :])
+            nirv_flag = np.where(np.isnan(df_jobs['nirv_cv'].values[:, None]), np.nan, df_jobs['nirv_cv'].values[:, None] <= grid[0][None, :])
+        df_flags = df_jobs.loc[df_jobs.index.repeat(num_combinations)].reset_index(drop=True)
+        df_flags['threshold_CV'] = np.tile(grid[0], num_jobs) * 100
+        df_flags['threshold_cloud'] = np.tile(grid[1], num_jobs) * 100
+        df_flags['vegetation_pixel'] = np.tile(grid[2], num_jobs) * 100
+        df_flags['pass'] = bool_pass.ravel().astype(int)
+        # CV flags only exist for the jobs passing the thresholds
+        df_flags['s2_ndvi_cv_flag'] = np.where(bool_pass, ndvi_flag, np.nan).ravel()
+        df_flags['s2_nirv_cv_flag'] = np.where(bool_pass, nirv_flag, np.nan).ravel()
+
+        # Validation reports: sufficient statistics of each job, summed over the jobs passing each combination
+        df_merge = self.read_output("L2B_1P_matchup")
+        df_merge['site_code'] = df_merge['site_code'].astype(str)
+        df_merge['flex_filename'] = df_merge['flex_filename'].astype(str)
+        list_stats = ['n', 'sum_x', 'sum_y', 'sum_xx', 'sum_yy', 'sum_xy']
+        list_reports = []
+        for report_name, column_pairs in [('L2B_1P_validation', self._COLUMN_PAIRS_FLOX), ('L2B_1P_TF_validation', self._COLUMN_PAIRS_TF)]:
+            # One job per FLEX image of a site, even if the site has several FLEX images on the same date
+            df_stats = self.cal_sufficient_statistics(df_merge, column_pairs, keys=['site_code', 'flex_filename'])
+            list_variables = list(pd.unique(df_stats['variable']))
+            # Jobs x (statistics x variables)
+            df_wide = df_stats.pivot_table(index=['site_code', 'flex_filename'], columns='variable', values=list_stats, aggfunc='sum', sort=False)
+            df_wide = df_wide.reindex(columns=pd.MultiIndex.from_product([list_stats, list_variables]))
+            index_jobs = pd.MultiIndex.from_arrays([df_jobs['site_code'], df_jobs['flex_filename']])
+            values = df_wide.reindex(index_jobs).fillna(0).to_numpy()
+            bool_processed = index_jobs.isin(df_wide.index)
+            values_sum = bool_pass.T.astype(float) @ values
+            values_sum = values_sum.reshape(num_combinations, len(list_stats), len(list_variables))
+            dict_metrics = self.cal_metrics_from_statistics(*[values_sum[:, k, :] for k in range(len(list_stats))])
+            df_report = pd.DataFrame({
+                'report': report_name,
+                'threshold_CV': np.repeat(grid[0], len(list_variables)) * 100,
+                'threshold_cloud': np.repeat(grid[1], len(list_variables)) * 100,
+                'vegetation_pixel': np.repeat(grid[2], len(list_variables)) * 100,
+                'n_jobs': np.repeat((bool_pass & bool_processed[:, None]).sum(axis=0), len(list_variables)),
+                'n_jobs_not_processed': np.repeat((bool_pass & ~bool_processed[:, None]).sum(axis=0), len(list_variables)),
+                'variable': np.tile(list_variables, num_combinations),
+                'n': values_sum[:, 0, :].ravel().astype(int)})
+            # No metrics for the combinations without any job passing
+            for metric in ['r_2', 'rmse', 'bias', 'slope', 'intercept', 'random_uncertainty']:
+                df_report[metric] = np.where(values_sum[:, 0, :] > 0, dict_metrics[metric], np.nan).ravel()
+            list_reports.append(df_report)
+        return df_flags, pd.concat(list_reports, ignore_index=True)
+
+    def create_validation_report(self, df_stats: pd.DataFrame, sites: Optional[list] = None, dates: Optional[list] = None) -> pd.DataFrame:
+        '''
+        Create a validation report by merging the sufficient statistics of all sites and dates, or of a subset of them. 
+        Args:
+            df_stats (pd.DataFrame): sufficient statistics per site_code, date and variable (see update_statistics_store). 
+            sites (list): the sites to include. All sites by default. 
+            dates (list): the FLEX dates (YYYYMMDD) to include. All dates by default. 
+        Returns:
+            pd.DataFrame: one row per metric and one column per variable, plus the number of sites and images. 
+        '''
+        if sites is not None:
+            df_stats = df_stats[df_stats['site_code'].isin([str(site) for site in sites])]
+        if dates is not None:
+            df_stats = df_stats[df_stats['date'].isin([str(date) for date in dates])]
+        # Merge the partial statistics of each variable
+        df_sum = df_stats.groupby('variable', sort=False)[['n', 'sum_x', 'sum_y', 'sum_xx', 'sum_yy', 'sum_xy']].sum()
+        dict_metrics = self.cal_metrics_from_statistics(df_sum['n'].values, df_sum['sum_x'].values, df_sum['sum_y'].values,
+                                                        df_sum['sum_xx'].values, df_sum['sum_yy'].values, df_sum['sum_xy'].values)
+        # Get number of sites and images, counting only the ones valid for at least one variable
+        df_valid = df_stats[df_stats['n'] > 0]
+        num_sites = df_valid['site_code'].nunique()
+        num_flex_img = df_valid['date'].nunique()
+        df_output = pd.DataFrame({
             "Metrics": ['R^2', 'RMSE', 'Bias', 'Slope', 'Intercept', 'Random uncertainty'],
             'n_sites': [num_sites] * 6,
-            'n_images': [num_flex_img] * 6,
-            'SIF_FARRED_max': [list_r_2[0], list_rmse[0], list_mean_residual[0], list_slope[0], list_intercept[0], list_random_uncertainty[0]],
-            'SIF_RED_max': [list_r_2[1], list_rmse[1], list_mean_residual[1], list_slope[1], list_intercept[1], list_random_uncertainty[1]],
-            'SIF_O2B': [list_r_2[2], list_rmse[2], list_mean_residual[2], list_slope[2], list_intercept[2], list_random_uncertainty[2]],
-            'SIF_O2A': [list_r_2[3], list_rmse[3], list_mean_residual[3], list_slope[3], list_intercept[3], list_random_uncertainty[3]],
-            'SIF_int': [list_r_2[4], list_rmse[4], list_mean_residual[4], list_slope[4], list_intercept[4], list_random_uncertainty[4]]
+            'n_images': [num_flex_img] * 6
         })
-        df_output.to_csv(os.path.join(self.path_output,"L2B_1P_TF_validation_report.csv"), index = False)
-
-    def cal_r_2(self, x: np.array, y: np.array) -> float:
-        # Fit linear model
-        model = LinearRegression()
-        model.fit(y.to_numpy().reshape(-1,1), x.to_numpy())
+        for k, var_name in enumerate(df_sum.index):
+            df_output[var_name] = [dict_metrics[metric][k] for metric in ['r_2', 'rmse', 'bias', 'slope', 'intercept', 'random_uncertainty']]
+        return df_output
 
-        # Predict using model
-        y_pred_from_model = model.predict(y.to_numpy().reshape(-1,1))
+    def create_stratified_report(self, df_merge: pd.DataFrame, column_pairs: list) -> pd.DataFrame:
+        '''
+        Create validation reports stratified by site_code, month, reference_area and S2-FLEX time difference. 
+        The sufficient statistics are calculated with a single groupby over the finest strata, and the partials are then 
+        merged for each stratum, so that the metrics of all groups are calculated together. 
+        Args:
+            df_merge (pd.DataFrame): the matchup table. 
+            column_pairs (list): pairs of [reference column, FLEX column]. 
+        Returns:
+            pd.DataFrame: one row per stratum, group and variable, with the number of matchups, sites and images and all metrics. 
+        '''
+        df_strata = df_merge[[col for pair in column_pairs for col in pair]].copy()
+        df_strata['site_code'] = df_merge['site_code'].astype(str)
+        df_strata['date'] = df_merge['date'].astype(str)
+        df_strata['month'] = df_strata['date'].str[4:6]
+        # Reference area of each site from Sites.csv
+        df_sites = pd.read_csv(self.file_site_csv)
+        dict_area = dict(zip(df_sites['site_code'].astype(str), df_sites['reference_area(m)']))
+        df_strata['reference_area'] = df_strata['site_code'].map(dict_area).astype(str)
+        # Time difference in days between the S2 image and the FLEX image
+        s2_date = pd.to_datetime(df_merge['s2_filename'].astype(str).str.split('_').str[2].str[:8], format='%Y%m%d', errors='coerce')
+        flex_date = pd.to_datetime(df_strata['date'], format='%Y%m%d', errors='coerce')
+        time_difference = pd.cut((s2_date - flex_date).dt.days.abs(), bins=[0, 1, 4, 8, 16, np.inf], right=False,
+                                 labels=['0', '1-3', '4-7', '8-15', '>15'])
+        df_strata['time_difference'] = time_difference.cat.add_categories('N/A').fillna('N/A').astype(str)
+
+        list_strata = ['site_code', 'month', 'reference_area', 'time_difference']
+        list_stats = ['n', 'sum_x', 'sum_y', 'sum_xx', 'sum_yy', 'sum_xy']
+        df_stats = self.cal_sufficient_statistics(df_strata, column_pairs, ['site_code', 'date'] + list_strata[1:])
+        df_valid = df_stats[df_stats['n'] > 0]
+        list_reports = []
+        for stratum in list_strata:
+            # Merge the partials of all groups of the stratum at once
+            df_sum = df_stats.groupby([stratum, 'variable'], sort=True)[list_stats].sum()
+            dict_metrics = self.cal_metrics_from_statistics(*[df_sum[stat].values for stat in list_stats])
+            df_count = df_valid.groupby([stratum, 'variable']).agg(n_sites=('site_code', 'nunique'), n_images=('date', 'nunique'))
+            df_count = df_count.reindex(df_sum.index, fill_value=0)
+            df_report = pd.DataFrame({
+                'stratum': stratum,
+                'group': df_sum.index.get_level_values(0),
+                'variable': df_sum.index.get_level_values(1),
+                'n': df_sum['n'].values,
+                'n_sites': df_count['n_sites'].values,
+                'n_images': df_count['n_images'].values,
+                'R^2': dict_metrics['r_2'],
+                'RMSE': dict_metrics['rmse'],
+                'Bias': dict_metrics['bias'],
+                'Slope': dict_metrics['slope'],
+                'Intercept': dict_metrics['intercept'],
+                'Random uncertainty': dict_metrics['random_uncertainty']
+            })
+            list_reports.append(df_report)
+        return pd.concat(list_reports, ignore_index=True)
+
+    def add_bootstrap_intervals(self, df_output: pd.DataFrame, df_merge: pd.DataFrame, column_pairs: list) -> pd.DataFrame:
+        '''
+        Add the bootstrap confidence intervals of all metrics to a validation report, as the columns "<variable>_ci_low" and "<variable>_ci_high". 
+        The metrics of the report are calculated again from the same rows of the matchup table as the resamples, so that the intervals 
+        always belong to the metrics they are reported with. 
+        Args:
+            df_output (pd.DataFrame): the validation report. 
+            df_merge (pd.DataFrame): the matchup table the report was calculated from. 
+            column_pairs (list): pairs of [reference column, FLEX column]. 
+        Returns:
+            pd.DataFrame: the validation report with the confidence intervals. 
+        '''
+        print(f"Calculating {self.confidence_level:.0%} bootstrap confidence intervals with {self.num_bootstrap} resamples......")
+        dict_point, dict_low, dict_high = self.cal_bootstrap_intervals(df_merge, column_pairs)
+        list_metrics = ['r_2', 'rmse', 'bias', 'slope', 'intercept', 'random_uncertainty']
+        list_columns = list(df_output.columns[:3])
+        for k, pair in enumerate(column_pairs):
+            var_name = pair[1].removesuffix('_flex')
+            df_output[var_name] = [dict_point[metric][k] for metric in list_metrics]
+            df_output[var_name + '_ci_low'] = [dict_low[metric][k] for metric in list_metrics]
+            df_output[var_name + '_ci_high'] = [dict_high[metric][k] for metric in list_metrics]
+            list_columns += [var_name, var_name + '_ci_low', var_name + '_ci_high']
+        return df_output[list_columns]
+
+    def cal_bootstrap_intervals(self, df_merge: pd.DataFrame, column_pairs: list) -> tuple:
+        '''
+        Calculate bootstrap confidence intervals of all metrics of all column pairs. 
+        Each block of resamples is an index matrix of shape (resamples, rows), turned into counts of each row, so that the 
+        sufficient statistics of all resamples and pairs are a single matrix product. 
+        Args:
+            df_merge (pd.DataFrame): the matchup table. 
+            column_pairs (list): pairs of [reference column, FLEX column]. 
+        Returns:
+            tuple: (dict_point, dict_low, dict_high), the metrics of all rows and the lower and upper bounds of each metric, as arrays 
+            with one value per pair. 
+        '''
+        rng = np.random.default_rng(self.random_seed)
+        x, y = self.get_pair_values(df_merge, column_pairs)
+        mask = ~np.isnan(x) & ~np.isnan(y)
+        x = np.where(mask, x, 0)
+        y = np.where(mask, y, 0)
+        num_rows, num_pairs = x.shape
+        values = np.hstack([mask.astype(float), x, y, x * x, y * y, x * y])
+        # Metrics of all rows, from the same sufficient statistics as the resamples
+        sums_all = values.sum(axis=0).reshape(6, num_pairs)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            dict_point = self.cal_metrics_from_statistics(*sums_all)
+        # No interval without at least two rows to resample
+        if num_rows < 2:
+            dict_low = {metric: np.full(num_pairs, np.nan) for metric in dict_point}
+            dict_high = {metric: np.full(num_pairs, np.nan) for metric in dict_point}
+            return dict_point, dict_low, dict_high
+        # Bound the size of the index matrix of a block to about 4 million elements
+        size_block = max(1, min(self.num_bootstrap, 4_000_000 // num_rows))
+        list_sums = []
+        for start in range(0, self.num_bootstrap, size_block):
+            num_resamples = min(size_block, self.num_bootstrap - start)
+            index = rng.integers(0, num_rows, size=(num_resamples, num_rows))
+            # Number of times each row is drawn in each resample
+            counts = np.bincount((index + num_rows * np.arange(num_resamples)[:, np.newaxis]).ravel(), minlength=num_resamples * num_rows)
+            counts = counts.reshape(num_resamples, num_rows).astype(float)
+            list_sums.append(counts @ values)
+        sums = np.vstack(list_sums).reshape(self.num_bootstrap, 6, num_pairs)
+        dict_metrics = self.cal_metrics_from_statistics(sums[:, 0], sums[:, 1], sums[:, 2], sums[:, 3], sums[:, 4], sums[:, 5])
+        # Percentile intervals; resamples without valid rows are ignored
+        alpha = (1 - self.confidence_level) / 2
+        dict_low = {}
+        dict_high = {}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for metric, value in dict_metrics.items():
+                dict_low[metric], dict_high[metric] = np.nanpercentile(value, [100 * alpha, 100 * (1 - alpha)], axis=0)
+        return dict_point, dict_low, dict_high
+
+    def read_statistics_store(self, report_name: str) -> pd.DataFrame:
+        '''
+        Read the sufficient statistics stored in the cache for a validation report. 
+        Args:
+            report_name (str): the name of the validation report, e.g. "L2B_1P_validation". 
+        Returns:
+            pd.DataFrame: sufficient statistics per site_code, date and variable, or None if nothing is stored yet. 
+        '''
+        path_store = os.path.join(self.path_cache, 'statistics', report_name + '.csv')
+        if not os.path.exists(path_store):
+            return None
+        return pd.read_csv(path_store, dtype={'site_code': str, 'date': str, 'digest': str}, float_precision='round_trip')
 
-        # Now compute R²
-        r2 = r2_score(x.to_numpy(), y_pred_from_model)
-        # Get linear regression parameters
-        slope = model.coef_[0]      # coefficient (slope)
-        intercept = model.intercept_  # intercept
-        
-        return r2, slope, intercept
+    def update_statistics_store(self, df_merge: pd.DataFrame, column_pairs: list, report_name: str) -> pd.DataFrame:
+        '''
+        Update the store of the sufficient statistics of a validation report, one partial per site_code, date and variable, so that it 
+        matches the matchup table. Each partial is saved with a digest of its rows: only the partials of the sites and dates whose rows 
+        are new or have changed are calculated again, and the ones of the sites and dates no longer in the matchup table are deleted. 
+        Args:
+            df_merge (pd.DataFrame): the whole matchup table. 
+            column_pairs (list): pairs of [reference column, FLEX column]. 
+            report_name (str): the name of the validation report, e.g. "L2B_1P_validation". 
+        Returns:
+            pd.DataFrame: all the stored sufficient statistics, sorted by site_code and date. 
+        '''
+        df_store = self.read_statistics_store(report_name)
+        df_digest = self.cal_statistics_digest(df_merge, column_pairs)
+        index_merge = pd.MultiIndex.from_arrays([df_merge['site_code'].astype(str), df_merge['date'].astype(str)])
+        if df_store is not None and 'digest' in df_store.columns:
+            # The partials whose rows are unchanged are kept, all others are deleted
+            df_store = df_store.merge(df_digest, on=['site_code', 'date', 'digest'], how='inner')
+            index_store = pd.MultiIndex.from_arrays([df_store['site_code'], df_store['date']])
+            df_merge = df_merge[~index_merge.isin(index_store)]
+        else:
+            # No store yet, or a store without digests
+            df_store = None
+        if len(df_merge) > 0:
+            df_new = self.cal_sufficient_statistics(df_merge, column_pairs, ['site_code', 'date'])
+            df_new = df_new.merge(df_digest, on=['site_code', 'date'], how='left')
+            df_store = df_new if df_store is None or len(df_store) == 0 else pd.concat([df_store, df_new], ignore_index=True)
+        elif df_store is None:
+            df_store = self.cal_sufficient_statistics(df_merge, column_pairs, ['site_code', 'date']).assign(digest=pd.Series(dtype=str))
+        # Same order as the partials of the whole matchup table, so that the merged statistics are the same
+        df_store = df_store.sort_values(['site_code', 'date'], kind='mergesort').reset_index(drop=True)
+        # Save to local storage
+        if not os.path.exists(os.path.join(self.path_cache, 'statistics')):
+            os.makedirs(os.path.join(self.path_cache, 'statistics'))
+        df_store.to_csv(os.path.join(self.path_cache, 'statistics', report_name + '.csv'), index=False)
+        return df_store
+
+    def cal_statistics_digest(self, df_merge: pd.DataFrame, column_pairs: list) -> pd.DataFrame:
+        '''
+        Calculate a digest of the values of all column pairs for each site_code and date, which changes whenever a row of the site 
+        and date is added, removed or modified. 
+        Returns:
+            pd.DataFrame: one row per site_code and date with the key columns and the digest, as a string. 
+        '''
+        x, y = self.get_pair_values(df_merge, column_pairs)
+        temp_hash = pd.util.hash_pandas_object(pd.DataFrame(np.hstack([x, y])), index=False).to_numpy()
+        df_keys = pd.DataFrame({'site_code': df_merge['site_code'].astype(str).values, 'date': df_merge['date'].astype(str).values})
+        # Groups numbered in order of first appearance, as the unique keys
+        temp_codes = df_keys.groupby(['site_code', 'date'], sort=False).ngroup().to_numpy()
+        df_digest = df_keys.drop_duplicates().reset_index(drop=True)
+        # The hashes of the rows are summed with wrap around, so that the digest doesn't depend on the order of the rows
+        temp_digest = np.zeros(len(df_digest), dtype=np.uint64)
+        np.add.at(temp_digest, temp_codes, temp_hash)
+        df_digest['digest'] = temp_digest.astype(str)
+        return df_digest
+
+    def get_pair_values(self, df_merge: pd.DataFrame, column_pairs: list) -> tuple:
+        '''
+        Get the values of all column pairs as two float arrays of shape (rows, pairs). Non-numeric values become NaN. 
+        Returns:
+            tuple: (x, y)
+        '''
+        x = df_merge[[pair[0] for pair in column_pairs]].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        y = df_merge[[pair[1] for pair in column_pairs]].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        return x, y
 
-    def cal_rmse(self, x: np.array, y: np.array) -> float:
-        return np.sqrt(((x - y) ** 2).mean())
-    
-    def cal_mean_residual(self, x: np.array, y: np.array) -> float:
-        return (x - y).mean()
-    
-    def cal_random_uncertainty(self, x: np.array, y: np.array, mean_residual: float) -> float:
-        return ((x - y - mean_residual) ** 2).mean()
+    def cal_sufficient_statistics(self, df_merge: pd.DataFrame, column_pairs: list, keys: Optional[list] = None) -> pd.DataFrame:
+        '''
+        Calculate the sufficient statistics n, sum(x), sum(y), sum(x^2), sum(y^2) and sum(xy) of all column pairs in one pass. 
+        The rows where either value of a pair is missing are excluded from that pair only. 
+        Args:
+            df_merge (pd.DataFrame): the matchup table. 
+            column_pairs (list): pairs of [reference column, FLEX column]. 
+            keys (list): columns of df_merge to group by, e.g. ['site_code', 'date']. No grouping by default. 
+        Returns:
+            pd.DataFrame: one row per group and pair with the key columns, variable, n, sum_x, sum_y, sum_xx, sum_yy and sum_xy. 
+        '''
+        list_variables = [pair[1].removesuffix('_flex') for pair in column_pairs]
+        x, y = self.get_pair_values(df_merge, column_pairs)
+        mask = ~np.isnan(x) & ~np.isnan(y)
+        x = np.where(mask, x, 0)
+        y = np.where(mask, y, 0)
+        list_stats = ['n', 'sum_x', 'sum_y', 'sum_xx', 'sum_yy', 'sum_xy']
+        values = np.hstack([mask.astype(float), x, y, x * x, y * y, x * y])
+        if keys:
+            # One groupby over the keys sums all statistics of all pairs together
+            df_grouped = pd.DataFrame(values).groupby([pd.Series(df_merge[key].astype(str).values, name=key) for key in keys]).sum()
+            df_keys = df_grouped.index.to_frame(index=False)
+            values = df_grouped.to_numpy()
+        else:
+            df_keys = pd.DataFrame(index=[0])
+            values = values.sum(axis=0, keepdims=True)
+        num_groups = values.shape[0]
+        values = values.reshape(num_groups, len(list_stats), len(column_pairs))
+        # Long format: one row per group and variable
+        df_stats = df_keys.loc[df_keys.index.repeat(len(column_pairs))].reset_index(drop=True)
+        df_stats['variable'] = np.tile(list_variables, num_groups)
+        for k, stat in enumerate(list_stats):
+            df_stats[stat] = values[:, k, :].ravel()
+        df_stats['n'] = df_stats['n'].astype(int)
+        return df_stats
+
+    def cal_metrics_from_statistics(self, n, sum_x, sum_y, sum_xx, sum_yy, sum_xy) -> dict:
+        '''
+        Calculate R^2, slope and intercept of the linear regression of x on y, together with RMSE, bias and random uncertainty of x - y, 
+        from the sufficient statistics. All arguments are arrays of the same shape and so are the outputs. 
+        Returns:
+            dict: arrays of 'r_2', 'slope', 'intercept', 'rmse', 'bias' and 'random_uncertainty'. 
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n = np.asarray(n, dtype=float)
+            # Centred sums of squares and products; values below the rounding error of the raw sums are zero
+            s_xx = sum_xx - sum_x ** 2 / n
+            s_yy = sum_yy - sum_y ** 2 / n
+            s_xy = sum_xy - sum_x * sum_y / n
+            s_xx = np.where(s_xx > 1e-10 * np.abs(sum_xx), s_xx, 0)
+            s_yy = np.where(s_yy > 1e-10 * np.abs(sum_yy), s_yy, 0)
+            # Linear regression x = slope * y + intercept; a constant y gives a flat line through the mean of x
+            slope = np.where(s_yy > 0, s_xy / s_yy, 0)
+            intercept = sum_x / n - slope * sum_y / n
+            ss_res = np.maximum(s_xx - slope * s_xy, 0)
+            r_2 = np.where(s_xx > 0, 1 - ss_res / s_xx, np.where(ss_res > 0, 0, 1))
+            # Residuals x - y
+            bias = (sum_x - sum_y) / n
+            mse = np.maximum((sum_xx - 2 * sum_xy + sum_yy) / n, 0)
+            random_uncertainty = mse - bias ** 2
+            random_uncertainty = np.where(random_uncertainty > 1e-10 * mse, random_uncertainty, 0)
+            rmse = np.sqrt(mse)
+        return {
+            'r_2': np.where(n > 0, r_2, np.nan),
+            'slope': np.where(n > 0, slope, np.nan),
+            'intercept': intercept,
+            'rmse': rmse,
+            'bias': bias,
+            'random_uncertainty': random_uncertainty
+        }
 
 class S2(CalVal):
 
-    def __init__(self, site_name, site_lat, site_lon, s2_l2a_name):
+    # Maximum number of values, samples x pixels, of the Monte Carlo arrays evaluated at once (16 MB per float32 array)
+    _MC_CHUNK_SIZE = 4 * 1024 ** 2
+
+    def __init__(self, site_name, site_lat, site_lon, s2_l2a_name, path_main: Optional[str] = None):
         '''
         Args:
             site_name (str): the name of the site. 
             site_lat (float): the latitude of the site. 
             site_lon (float): the longitude of the site. 
             s2_name (str): the name of the S2 L2A image, ending with ".SAFE". 
+            path_main (str): the work directory, the folder of the script by default. 
         '''
-        super().__init__()
+        super().__init__(path_main)
         self.__S2_RESOLUTION = 10
         # Default threshold of CV
         self._threshold_cv = 0.2
@@ -561,6 +1039,26 @@ class S2(CalVal):
         self._area = 900
         # Default cloud coverage
         self._cloud = 0.5
+        # Monte Carlo uncertainty propagation through the transfer functions, disabled by default
+        self._bool_uncertainty = False
+        # Default number of Monte Carlo samples
+        self._num_samples = 1000
+        # Default relative noise (1 sigma) of S2 L2A reflectances
+        self._reflectance_noise = 0.05
+        # Seed of the Monte Carlo random generator, None for a random seed
+        self.random_seed = None
+        # Full-tile rasters processed in row strips within a memory budget, disabled by default
+        self._bool_strip_processing = False
+        # Default memory budget of the strip processing, in MB
+        self._memory_budget = 256
+        # Floating point precision of the S2 indices, "float32" by default or "float64"
+        self._precision = "float32"
+        # Decoded bands shared with other jobs, from the band name to its memory-mapped array, None to read the band files
+        self.shared_bands = None
+        # The 10 m window of the tile covered by the shared bands
+        self.shared_window = None
+        # Export the ROI of each job as shapefiles to the cache folder, for debugging, disabled by default
+        self._bool_export_roi = False
 
         # Site name
         self.site_name = site_name
@@ -579,6 +1077,10 @@ class S2(CalVal):
         self.path_l2a_mtd_tl = None
         # S2 image CRS
         self.s2_crs = None
+        # Zonal statistics of the ROI on the grid of the S2 image, calculated once per job
+        self._zonal_stats = None
+        # ROI rasters written by this job
+        self._roi_rasters = set()
         # S2 image quantification
         self.s2_l2a_quantification = None
         # S2 image offsets
@@ -633,6 +1135,81 @@ class S2(CalVal):
                 raise ValueError("The cloud coverage must be between 0 and 1!!!")
             self._cloud = value
 
+    @property
+    def bool_uncertainty(self):
+        return self._bool_uncertainty
+    @bool_uncertainty.setter
+    def bool_uncertainty(self, value):
+        self._bool_uncertainty = bool(value)
+
+    @property
+    def num_samples(self):
+        return self._num_samples
+    @num_samples.setter
+    def num_samples(self, value):
+        if not value:
+            self._num_samples = 1000
+        else:
+            if int(value) < 2:
+                raise ValueError("The number of Monte Carlo samples must be at least 2!!!")
+            self._num_samples = int(value)
+
+    @property
+    def reflectance_noise(self):
+        return self._reflectance_noise
+    @reflectance_noise.setter
+    def reflectance_noise(self, value):
+        if value is None:
+            self._reflectance_noise = 0.05
+        else:
+            if value < 0:
+                raise ValueError("The relative noise of S2 reflectances can't be negative!!!")
+            self._reflectance_noise = value
+
+    @property
+    def bool_export_roi(self):
+        return self._bool_export_roi
+    @bool_export_roi.setter
+    def bool_export_roi(self, value):
+        self._bool_export_roi = bool(value)
+
+    @property
+    def bool_strip_processing(self):
+        return self._bool_strip_processing
+    @bool_strip_processing.setter
+    def bool_strip_processing(self, value):
+        self._bool_strip_processing = bool(value)
+
+    @property
+    def memory_budget(self):
+        return self._memory_budget
+    @memory_budget.setter
+    def memory_budget(self, value):
+        if not value:
+            self._memory_budget = 256
+        else:
+            if value <= 0:
+                raise ValueError("The memory budget of the strip processing must be greater than 0!!!")
+            self._memory_budget = value
+
+    @property
+    def precision(self):
+        return self._precision
+    @precision.setter
+    def precision(self, value):
+        if value not in ["float32", "float64"]:
+            raise ValueError("The precision of the S2 indices can only be 'float32' or 'float64'!!!")
+        self._precision = value
+
+    @property
+    def zonal_stats(self):
+        return self._zonal_stats
+    @zonal_stats.setter
+    def zonal_stats(self, value):
+        if value is not None and not isinstance(value, ZonalStats):
+            raise ValueError("The zonal statistics can only be a ZonalStats or None!!!")
+        self._zonal_stats = value
+
     # ------------------------------ Private Methods ------------------------------ #
     def __s2_initialization(self) -> None:
         '''
@@ -644,6 +1221,20 @@ class S2(CalVal):
 
     # ------------------------------ Public Methods ------------------------------ #
 
+    def set_s2_image(self, s2_l2a_name: str) -> None:
+        '''
+        Switch to another S2 image of the same site, e.g. along a time series, keeping the settings of the object, its cache folders and
+        its stores. Everything calculated from the previous image is dropped: the zonal statistics, the ROI rasters and the shared bands. 
+        Args:
+            s2_l2a_name (str): the name of the S2 L2A image, ending with ".SAFE". 
+        '''
+        self.s2_l2a_name = s2_l2a_name
+        self._zonal_stats = None
+        self._roi_rasters = set()
+        self.shared_bands = None
+        self.shared_window = None
+        self.__s2_initialization()
+
     def create_cache_subfolder(self, subpath) -> None:
         '''
         Create subfolder inside the cache folder. 
@@ -661,27 +1252,157 @@ class S2(CalVal):
             tuple: (path_l2a_b04, path_l2a_b08, path_l2a_mask, path_l2a_xml_ds, path_l2a_xml_tl)
         '''
         temp_path_l2a = os.path.join(self.path_s2_input, self.site_name, self.s2_l2a_name)
-        for path, subdirs, files in os.walk(temp_path_l2a):
-            for name in files:
-                temp = os.path.join(path, name)
-                if temp[-3:] == 'jp2'in temp and "10m" in temp and "B04" in temp :
-                    path_l2a_b04 = temp
-                if temp[-3:] == 'jp2'in temp and "10m" in temp and "B08" in temp :
-                    path_l2a_b08 = temp
-                # Path to the mask file
-                if "MSK_CLASSI_B00" in temp and temp[-3:] == 'jp2':
-                    path_l2a_mask = temp
-                # Get the path to the XML file "MTD_DS" of L1C raster, where there are values of "Quantification Value" and "Radiometric Offset"
-                if "MTD_DS.xml" in temp:
-                    path_l2a_xml_ds = temp
-                if "MTD_TL.xml" in temp:
-                    path_l2a_xml_tl = temp
         if not os.path.exists(temp_path_l2a):
             print("User Error: Please organise the input S2 images in correct folder structure. ")
             raise FileNotFoundError(f"The input S2 images folder {temp_path_l2a} doesn't contain the correct folder structure or doesn't contain S2 images! Please check the input S2 images folder!")
-        else:
-            return path_l2a_b04, path_l2a_b08, path_l2a_mask, path_l2a_xml_ds, path_l2a_xml_tl
+        dict_files = self.match_s2_l2a_files(self.list_s2_files(temp_path_l2a))
+        list_missing = [i for i in ['B04', 'B08', 'MSK_CLASSI_B00', 'MTD_DS', 'MTD_TL'] if i not in dict_files]
+        if list_missing:
+            raise FileNotFoundError(f"The S2 image {temp_path_l2a} is missing {', '.join(list_missing)}! Please check the input S2 images folder!")
+        return tuple(dict_files[i][1] for i in ['B04', 'B08', 'MSK_CLASSI_B00', 'MTD_DS', 'MTD_TL'])
+
+    @staticmethod
+    def match_s2_l2a_files(list_files: list) -> dict:
+        '''
+        Find the B4, B8, MSK_CLASSI_B00, MTD_DS and MTD_TL files among all files of an S2 L2A product. 
+        Args:
+            list_files (list): the files of the product, from list_s2_files. 
+        Returns:
+            dict: from 'B04', 'B08', 'MSK_CLASSI_B00', 'MTD_DS' and 'MTD_TL' to the matching file, if found. 
+        '''
+        dict_files = {}
+        for file in list_files:
+            temp = file[0]
+            if temp[-3:] == 'jp2' and "10m" in temp and "B04" in temp:
+                dict_files['B04'] = file
+            if temp[-3:] == 'jp2' and "10m" in temp and "B08" in temp:
+                dict_files['B08'] = file
+            # Path to the mask file
+            if "MSK_CLASSI_B00" in temp and temp[-3:] == 'jp2':
+                dict_files['MSK_CLASSI_B00'] = file
+            # Get the path to the XML file "MTD_DS" of L1C raster, where there are values of "Quantification Value" and "Radiometric Offset"
+            if "MTD_DS.xml" in temp:
+                dict_files['MTD_DS'] = file
+            if "MTD_TL.xml" in temp:
+                dict_files['MTD_TL'] = file
+        return dict_files
         
+    @staticmethod
+    def get_product_id(s2_filename: str) -> str:
+        '''
+        Get the ID of an S2 product from the name of its folder or archive, e.g. "S2A_MSIL2A_..._20240717T130024" from "S2A_MSIL2A_..._20240717T130024.SAFE.zip". 
+        '''
+        return s2_filename.split('.')[0]
+
+    def read_band(self, band: str, window: Optional[rio.windows.Window] = None) -> np.ndarray:
+        '''
+        Read a band of the current S2 image, from the shared decoded bands if attached and covering the window, or else from the band file. 
+        Args:
+            band (str): 'B04', 'B08' or 'MSK_CLASSI_B00'. 
+            window (rio.windows.Window): the window to read, on the grid of the band, None for the window of the tile (see get_tile_window). 
+        Returns:
+            np.ndarray: the values of the band, with the three layers first for MSK_CLASSI_B00. Read only if shared. 
+        '''
+        if self.shared_bands is not None and band in self.shared_bands:
+            values = self.shared_bands[band]
+            # The shared window on the 60 m grid of the mask
+            temp_scale = 6 if band == 'MSK_CLASSI_B00' else 1
+            temp_shared = self.shared_window
+            temp_row_off, temp_col_off = temp_shared.row_off // temp_scale, temp_shared.col_off // temp_scale
+            if window is None:
+                return values
+            if temp_row_off <= window.row_off and window.row_off + window.height <= temp_row_off + values.shape[-2] and \
+               temp_col_off <= window.col_off and window.col_off + window.width <= temp_col_off + values.shape[-1]:
+                return values[..., window.row_off - temp_row_off:window.row_off - temp_row_off + window.height,
+                              window.col_off - temp_col_off:window.col_off - temp_col_off + window.width]
+        dict_paths = {'B04': self.path_l2a_b04, 'B08': self.path_l2a_b08, 'MSK_CLASSI_B00': self.path_l2a_mask}
+        src = self.raster_pool.get(dict_paths[band])
+        if src.count > 1:
+            return src.read(window=window)
+        return src.read(1, window=window)
+
+    def get_tile_window(self) -> rio.windows.Window:
+        '''
+        Get the 10 m window of the tile processed by cal_valid_pixels and create_clipping_raster, and covered by the rasters they save 
+        in the cache folder: the window of the shared bands when attached, or else the whole tile. 
+        '''
+        if self.shared_bands is not None:
+            return self.shared_window
+        src = self.raster_pool.get(self.path_l2a_b04)
+        return rio.windows.Window(0, 0, src.width, src.height)
+
+    def get_shared_window(self, latitudes, longitudes, areas) -> Optional[rio.windows.Window]:
+        '''
+        Get the window of the tile to decode for the bands shared by several jobs (see BandShare): the union of the squares of the 
+        reference area of their sites, with a margin of two FLEX pixels (600 m) as the ROI is snapped to the FLEX grid, aligned to 
+        the 60 m grid of the mask. 
+        Args:
+            latitudes, longitudes: the coordinates of the sites, arrays. 
+            areas: the reference areas of the sites in m, an array. 
+        Returns:
+            rio.windows.Window: the window, or None if no site is on the tile. 
+        '''
+        src = self.raster_pool.get(self.path_l2a_b04)
+        temp_x, temp_y = Geodesy.transform_points(longitudes, latitudes, "EPSG:4326", self.s2_crs)
+        temp_x, temp_y, temp_half = np.broadcast_arrays(np.atleast_1d(temp_x), np.atleast_1d(temp_y), np.asarray(areas, dtype=float) / 2 + 600)
+        temp_window = rio.windows.union([rio.windows.from_bounds(x - h, y - h, x + h, y + h, transform=src.transform)
+                                         for x, y, h in zip(temp_x, temp_y, temp_half)])
+        temp_col_start = max(0, int(np.floor(temp_window.col_off / 6)) * 6)
+        temp_row_start = max(0, int(np.floor(temp_window.row_off / 6)) * 6)
+        temp_col_stop = min(src.width, int(np.ceil((temp_window.col_off + temp_window.width) / 6)) * 6)
+        temp_row_stop = min(src.height, int(np.ceil((temp_window.row_off + temp_window.height) / 6)) * 6)
+        if temp_col_stop <= temp_col_start or temp_row_stop <= temp_row_start:
+            return None
+        return rio.windows.Window(temp_col_start, temp_row_start, temp_col_stop - temp_col_start, temp_row_stop - temp_row_start)
+
+    def attach_shared_bands(self, dict_values: dict, window: rio.windows.Window) -> bool:
+        '''
+        Use the decoded bands shared with other jobs, which cover a window of the tile, if the window covers the ROI of this job. 
+        Otherwise the band files are read. 
+        Args:
+            dict_values (dict): from the band name to its array, from BandShare.attach. 
+            window (rio.windows.Window): the 10 m window of the tile covered by the arrays, aligned to the 60 m grid. 
+        Returns:
+            bool: True if the shared bands are used. 
+        '''
+        temp_roi = self.get_zonal_stats().window
+        if not (window.row_off <= temp_roi.row_off and temp_roi.row_off + temp_roi.height <= window.row_off + window.height and
+                window.col_off <= temp_roi.col_off and temp_roi.col_off + temp_roi.width <= window.col_off + window.width):
+            print(f"\033[91mThe shared bands of {self.s2_l2a_name} don't cover the ROI of the site {self.site_name}, the band files will be read instead!\033[0m")
+            return False
+        self.shared_bands = dict_values
+        self.shared_window = window
+        return True
+
+    def clip_tile_window(self, values: np.ndarray) -> np.ndarray:
+        '''
+        Cut an array of the window of the tile (see get_tile_window) to the window of the ROI. 
+        '''
+        temp_tile = self.get_tile_window()
+        temp_roi = self.get_zonal_stats().window
+        return values[..., temp_roi.row_off - temp_tile.row_off:temp_roi.row_off - temp_tile.row_off + temp_roi.height,
+                      temp_roi.col_off - temp_tile.col_off:temp_roi.col_off - temp_tile.col_off + temp_roi.width]
+
+    def ingest_bands(self) -> None:
+        '''
+        Convert B04, B08 and MSK_CLASSI_B00 of the current S2 image once into cloud optimized GeoTIFFs (internally tiled, compressed, 
+        with overviews), saved in the cache folder under the product ID, and use them instead of the JP2 files for all later reads. 
+        Products already converted, e.g. by another site or a previous run, are reused without decoding any JP2 file. 
+        '''
+        temp_product_id = self.get_product_id(self.s2_l2a_name)
+        temp_path_bands = os.path.join(self.path_cache, "s2_bands", temp_product_id)
+        if not os.path.exists(temp_path_bands):
+            os.makedirs(temp_path_bands, exist_ok=True)
+        for attr, band, resampling in [('path_l2a_b04', 'B04', 'average'), ('path_l2a_b08', 'B08', 'average'), ('path_l2a_mask', 'MSK_CLASSI_B00', 'nearest')]:
+            temp_path_cog = os.path.join(temp_path_bands, band + ".tif")
+            if not os.path.exists(temp_path_cog):
+                print(f"Converting {band} of the S2 image {self.s2_l2a_name} into a cloud optimized GeoTIFF......")
+                # Written to a temporary file first, so that an interrupted or concurrent conversion never leaves a partial file
+                temp_path_tmp = temp_path_cog + f".{os.getpid()}.tmp"
+                rio.shutil.copy(getattr(self, attr), temp_path_tmp, driver='COG', compress='DEFLATE', predictor=2, blocksize=512, overview_resampling=resampling)
+                os.replace(temp_path_tmp, temp_path_cog)
+            setattr(self, attr, temp_path_cog)
+
     def get_s2_crs(self) -> str:
         '''
         Get the coordinate reference system (CRS) of the S2 image.
@@ -689,8 +1410,7 @@ class S2(CalVal):
             str: The CRS of the S2 image in EPSG format.
         '''
         # Read the DS xml file of L2A
-        with open(self.path_l2a_mtd_tl, 'r') as f:
-            data = f.read()
+        data = self.read_text(self.path_l2a_mtd_tl)
         bs_l2a_tl = BeautifulSoup(data, "xml")
         # Get the quantification value! 
         l2a_crs = str(bs_l2a_tl.find("HORIZONTAL_CS_CODE").text)
@@ -703,8 +1423,7 @@ class S2(CalVal):
             tuple: (quantification_l2a, offset_l2a_b04, offset_l2a_b08)
         '''
         # Read the DS xml file of L2A
-        with open(self.path_l2a_mtd_ds, 'r') as f:
-            data = f.read()
+        data = self.read_text(self.path_l2a_mtd_ds)
         bs_l2a_ds = BeautifulSoup(data, "xml")
         # Get the quantification value! 
         quantification_l2a = int(bs_l2a_ds.find("BOA_QUANTIFICATION_VALUE").text)
@@ -713,66 +1432,58 @@ class S2(CalVal):
         offset_l2a_b08 = int(bs_l2a_ds.find("BOA_ADD_OFFSET", {"band_id": "7"}).text)
         return quantification_l2a, offset_l2a_b04, offset_l2a_b08
     
-    def create_clipping_shapefile(self) -> gpd.GeoDataFrame:
+    def get_roi_geometry(self) -> tuple:
         '''
-        Create a shapefile to be used for S2 image clipping. This shapefile overlapps perfectly with the pixels of the S2 images. 
+        Get the ROI of the current job, both in EPSG:4326 and in the CRS of the S2 image, transformed with the cached transformers of Geodesy. 
+        The ROI is the box of the FLEX pixels of the ROI, or without a FLEX image (flex_filename is None), a square of the reference area 
+        centred on the site, in the CRS of the S2 image. 
         Returns:
-            gpd.GeoDataFrame: the new shapefile that will used to clip the S2 image. 
+            tuple: (the ROI in EPSG:4326, the ROI in the CRS of the S2 image), as shapely polygons. 
         '''
+        if self.flex_filename is None:
+            temp_x, temp_y = self.get_site_xy()
+            geom_utm = shp.geometry.box(temp_x - self.area / 2, temp_y - self.area / 2, temp_x + self.area / 2, temp_y + self.area / 2)
+            geom = Geodesy.transform_boxes(*geom_utm.bounds, self.s2_crs, "EPSG:4326")[0]
+            return geom, geom_utm
         # Open the FLEX image
-        temp_ds = xr.open_dataset(os.path.join(self.path_flex_input,self.site_name,self.flex_filename))
+        temp_ds = xr.open_dataset(self.get_flex_path(self.site_name, self.flex_filename))
         # Read longitudes and latitudes from the dataset
         longitudes = temp_ds['longitude'].values
         latitudes = temp_ds['latitude'].values
-        # Get the indices of the closest longitudes and latitudes to the site
-        lon_left = np.where(longitudes <= self.site_lon)[0][-1]
-        lon_right = np.where(longitudes >= self.site_lon)[0][0]
-        lat_top = np.where(latitudes >= self.site_lat)[0][-1]
-        lat_bottom = np.where(latitudes <= self.site_lat)[0][0]
-        # print(f"lon_left: {lon_left}, lon_right: {lon_right}, lat_top: {lat_top}, lat_bottom: {lat_bottom}")
-        # Now find the indices of the pixel where the site is located
-        if abs(self.site_lon - longitudes[lon_left]) <= abs(self.site_lon - longitudes[lon_right]):
-            lon_index = lon_left
-        else:
-            lon_index = lon_right
-        if abs(self.site_lat - latitudes[lat_top]) <= abs(self.site_lat - latitudes[lat_bottom]):
-            lat_index = lat_top
-        else:
-            lat_index = lat_bottom
-        # print(f"Site {self.site_name} is located at pixel: {lat_index}, {lon_index} with coordinates: {latitudes[lat_index]}, {longitudes[lon_index]}")
+        temp_ds.close()
+        # The box of the FLEX pixels of the ROI, the same ones as FLEX.cal_sif and FLEX.sif_output
+        temp_lat_slice, temp_lon_slice = self.get_flex_window(latitudes, longitudes, self.site_lat, self.site_lon, self.area)
         lat_dif = abs(latitudes[1] - latitudes[0]) / 2.0
         lon_dif = abs(longitudes[1] - longitudes[0]) / 2.0
-        # Create a box geometry
-        if self.area == 300:
-            miny = latitudes[lat_index] - lat_dif
-            maxy = latitudes[lat_index] + lat_dif
-            minx = longitudes[lon_index] - lon_dif
-            maxx = longitudes[lon_index] + lon_dif
-            # print(f"Creating a shapefile for a 300 m² ROI at {self.site_name} with coordinates: {minx}, {miny}, {maxx}, {maxy}")
-        elif self.area == 600:
-            if abs(self.site_lat - latitudes[lat_index - 1]) < abs(self.site_lat - latitudes[lat_index + 1]):
-                lat_index_600 = lat_index - 1
-            else:
-                lat_index_600 = lat_index + 1
-            if abs(self.site_lon - longitudes[lon_index - 1]) < abs(self.site_lon - longitudes[lon_index + 1]):
-                lon_index_600 = lon_index - 1
-            else:
-                lon_index_600 = lon_index + 1
-            miny = min(latitudes[lat_index_600], latitudes[lat_index]) - lat_dif
-            maxy = max(latitudes[lat_index_600], latitudes[lat_index]) + lat_dif
-            minx = min(longitudes[lon_index_600], longitudes[lon_index]) - lon_dif
-            maxx = max(longitudes[lon_index_600], longitudes[lon_index]) + lon_dif
-            # print(f"Creating a shapefile for a 600 m² ROI at {self.site_name} with coordinates: {minx}, {miny}, {maxx}, {maxy}")
-        else:  
-            miny = min(latitudes[lat_index - 1], latitudes[lat_index + 1]) - lat_dif
-            maxy = max(latitudes[lat_index - 1], latitudes[lat_index + 1]) + lat_dif
-            minx = min(longitudes[lon_index - 1],longitudes[lon_index + 1]) - lon_dif
-            maxx = max(longitudes[lon_index - 1],longitudes[lon_index + 1]) + lon_dif
-            # print(f"Creating a shapefile for a 900 m² ROI at {self.site_name} with coordinates: {minx}, {miny}, {maxx}, {maxy}")
-        # Create a shapefile!
+        miny = latitudes[temp_lat_slice].min() - lat_dif
+        maxy = latitudes[temp_lat_slice].max() + lat_dif
+        minx = longitudes[temp_lon_slice].min() - lon_dif
+        maxx = longitudes[temp_lon_slice].max() + lon_dif
         geom = shp.geometry.box(minx, miny, maxx, maxy)
-        gdf_new = gpd.GeoDataFrame({'value': [0], 'geometry': geom}, crs="EPSG:4326")
-        gdf_new_utm = gdf_new.to_crs(self.s2_crs)
+        geom_utm = Geodesy.transform_boxes(minx, miny, maxx, maxy, "EPSG:4326", self.s2_crs)[0]
+        return geom, geom_utm
+
+    def get_site_xy(self) -> tuple:
+        '''
+        Get the coordinates of the site in the CRS of the S2 image. 
+        Returns:
+            tuple: (x, y) of the site. 
+        '''
+        temp_x, temp_y = Geodesy.transform_points(self.site_lon, self.site_lat, "EPSG:4326", self.s2_crs)
+        return float(temp_x), float(temp_y)
+
+    def create_clipping_shapefile(self, geom: shp.Polygon, geom_utm: shp.Polygon) -> gpd.GeoDataFrame:
+        '''
+        Export the ROI of the job as shapefiles to the cache folder of the site, "roi_4326.shp" and "roi_utm.shp", for inspection only: 
+        the clipping uses the geometry of get_roi_geometry in memory. Only called if bool_export_roi is set. 
+        Args:
+            geom (shp.Polygon): the ROI in EPSG:4326. 
+            geom_utm (shp.Polygon): the ROI in the CRS of the S2 image. 
+        Returns:
+            gpd.GeoDataFrame: the ROI in the CRS of the S2 image. 
+        '''
+        gdf_new = gpd.GeoDataFrame({'value': [0], 'geometry': [geom]}, crs="EPSG:4326")
+        gdf_new_utm = gpd.GeoDataFrame({'value': [0], 'geometry': [geom_utm]}, crs=self.s2_crs)
 
         # Export shapefiles
         gdf_new.to_file(os.path.join(self.path_cache,self.site_name,"roi_4326.shp"))
@@ -784,49 +1495,56 @@ class S2(CalVal):
         '''
         # Suppress divide by zero warning
         np.seterr(all='ignore')
+        if self.bool_strip_processing:
+            self.create_clipping_raster_strips(list_indices)
+            return
+
+        # Get metadata, the rasters covering the window of the tile
+        temp_tile_window = self.get_tile_window()
+        with self.raster_pool.open(self.path_l2a_b04) as src:
+            out_meta = src.meta
+            out_meta.update({
+                "driver": "GTiff",
+                "dtype": self.precision,
+                "crs": src.crs,
+                "transform": rio.windows.transform(temp_tile_window, src.transform),
+                "width": temp_tile_window.width,
+                "height": temp_tile_window.height
+            })
 
         # Read values
-        img_l2a_b04 = rio.open(self.path_l2a_b04)
-        img_l2a_b08 = rio.open(self.path_l2a_b08)
-        values_l2a_b04 = img_l2a_b04.read(1).astype(np.int32)
-        values_l2a_b08 = img_l2a_b08.read(1).astype(np.int32)
-
-        # Get metadata
-        src = img_l2a_b04
-        out_meta = src.meta
-        out_meta.update({
-            "driver": "GTiff",
-            "dtype": "float64",
-            "crs": src.crs,
-            "transform": src.transform
-        })
+        # Bands are read directly in the chosen precision, the digital numbers being exact in both float32 and float64
+        temp_dtype = np.dtype(self.precision)
+        values_l2a_b04 = self.read_band('B04').astype(temp_dtype) + self.offset_l2a_b04
+        values_l2a_b08 = self.read_band('B08').astype(temp_dtype) + self.offset_l2a_b08
         # ------------------------------- Read Mask ROI ------------------------------ #
-        img_mask = rio.open(os.path.join(self.path_cache,self.site_name,"Mask.tif"))
+        img_mask = self.raster_pool.get(os.path.join(self.path_cache,self.site_name,"Mask.tif"))
         values_mask = img_mask.read(1)
-        values_mask = np.where(values_mask == 0, 1, np.nan)
+        values_mask = np.where(values_mask == 0, temp_dtype.type(1), temp_dtype.type(np.nan))
 
         # ----------------------------------- NDVI ----------------------------------- #
         if not os.path.exists(os.path.join(self.path_cache, self.site_name)):
             os.makedirs(os.path.join(self.path_cache, self.site_name))                              
         # Calculate NDVI of L2A! 
         # NDVI = (B8 - B4) / (B8 + B4)
-        temp_ndvi = ((values_l2a_b08 + self.offset_l2a_b08).astype(float) / self.quantification_l2a - (values_l2a_b04 + self.offset_l2a_b04).astype(float) / self.quantification_l2a) / ((values_l2a_b08 + self.offset_l2a_b08).astype(float) / self.quantification_l2a + (values_l2a_b04 + self.offset_l2a_b04).astype(float) / self.quantification_l2a )
+        temp_ndvi = (values_l2a_b08 / self.quantification_l2a - values_l2a_b04 / self.quantification_l2a) / (values_l2a_b08 / self.quantification_l2a + values_l2a_b04 / self.quantification_l2a)
         temp_ndvi = temp_ndvi * values_mask
         if 'NDVI' in list_indices:
             # Save
-            with rio.open(os.path.join(self.path_cache, self.site_name, "NDVI.tif"), 'w',**out_meta) as dest:
+            with self.raster_pool.open_write(os.path.join(self.path_cache, self.site_name, "NDVI.tif"), **out_meta) as dest:
                 dest.write(temp_ndvi, 1)
             # Clip to the ROI! 
             self.clip_raster_by_shapefile(os.path.join(self.path_cache, self.site_name, "NDVI.tif"))
 
         # ---------------------------------- NIRvREF --------------------------------- #
-        if 'NIRvREF' in list_indices:
+        if 'NIRvREF' in list_indices or 'TF2' in list_indices:
             # Calculate NIRvREF of L2A! 
             # NIRvREF = NDVI * B8
-            temp_nirvref = temp_ndvi * (values_l2a_b08 + self.offset_l2a_b08).astype(float) / self.quantification_l2a
+            temp_nirvref = temp_ndvi * values_l2a_b08 / self.quantification_l2a
             temp_nirvref = temp_nirvref * values_mask
+        if 'NIRvREF' in list_indices:
             # Save
-            with rio.open(os.path.join(self.path_cache, self.site_name, "NIRv.tif"), 'w',**out_meta) as dest:
+            with self.raster_pool.open_write(os.path.join(self.path_cache, self.site_name, "NIRv.tif"), **out_meta) as dest:
                 dest.write(temp_nirvref, 1)
             # Clip to the ROI! 
             self.clip_raster_by_shapefile(os.path.join(self.path_cache, self.site_name, "NIRv.tif"))
@@ -834,14 +1552,97 @@ class S2(CalVal):
         # ------------------------------------ TF2 ----------------------------------- #
         if 'TF2' in list_indices:
             # Calculate transfer function 2! B4 * NIRvREF ^ 2
-            temp_tf2 = (values_l2a_b04 + self.offset_l2a_b04).astype(float) / self.quantification_l2a * (temp_nirvref ** 2)
+            temp_tf2 = values_l2a_b04 / self.quantification_l2a * (temp_nirvref ** 2)
             temp_tf2 = temp_tf2 * values_mask
             # Save
-            with rio.open(os.path.join(self.path_cache, self.site_name, "TF2.tif"), 'w',**out_meta) as dest:
+            with self.raster_pool.open_write(os.path.join(self.path_cache, self.site_name, "TF2.tif"), **out_meta) as dest:
                 dest.write(temp_tf2, 1)
             # Clip to the ROI! 
             self.clip_raster_by_shapefile(os.path.join(self.path_cache, self.site_name, "TF2.tif"))
 
+    def create_clipping_raster_strips(self, list_indices = ['NDVI','NIRvREF','TF2']) -> None:
+        '''
+        Same as create_clipping_raster, but the tile is processed in row strips aligned to the blocks of the JP2 bands, and each strip 
+        is written to tiled, compressed GeoTIFFs before the next one is read. The height of the strips is chosen so that the peak 
+        memory stays within the memory budget, whatever the size of the tile. 
+        Args:
+            list_indices (list): the indices to save and clip, among 'NDVI', 'NIRvREF' and 'TF2'. 
+        '''
+        # Suppress divide by zero warning
+        np.seterr(all='ignore')
+        if not os.path.exists(os.path.join(self.path_cache, self.site_name)):
+            os.makedirs(os.path.join(self.path_cache, self.site_name))
+        dict_files = {'NDVI': "NDVI.tif", 'NIRvREF': "NIRv.tif", 'TF2': "TF2.tif"}
+        list_indices = [i for i in ['NDVI', 'NIRvREF', 'TF2'] if i in list_indices]
+        # Output tiles of 256 x 256 pixels
+        temp_tile = 256
+
+        # The rasters cover the window of the tile
+        temp_tile_window = self.get_tile_window()
+        with self.raster_pool.open(self.path_l2a_b04) as img_l2a_b04:
+            out_meta = img_l2a_b04.meta
+            out_meta.update({
+                "driver": "GTiff",
+                "dtype": self.precision,
+                "crs": img_l2a_b04.crs,
+                "transform": rio.windows.transform(temp_tile_window, img_l2a_b04.transform),
+                "width": temp_tile_window.width,
+                "height": temp_tile_window.height,
+                "tiled": True,
+                "blockxsize": temp_tile,
+                "blockysize": temp_tile,
+                "compress": "deflate"
+            })
+            temp_block_shape = img_l2a_b04.block_shapes[0]
+        temp_width = temp_tile_window.width
+        temp_height = temp_tile_window.height
+        # Strips are aligned to the blocks of the JP2 bands and to the output tiles
+        temp_block_rows = int(np.lcm(temp_block_shape[0], temp_tile))
+        # Bytes per pixel of a strip: two uint16 bands, then the mask, B04, B08 (twice), NDVI, NIRvREF, TF2 and about two temporaries
+        temp_dtype = np.dtype(self.precision)
+        temp_bytes_row = temp_width * (2 * 2 + 9 * temp_dtype.itemsize)
+        temp_strip_rows = int(self.memory_budget * 1024 ** 2 // temp_bytes_row) // temp_block_rows * temp_block_rows
+        temp_strip_rows = max(temp_strip_rows, temp_block_rows)
+        if temp_strip_rows == temp_block_rows and temp_block_rows * temp_bytes_row > self.memory_budget * 1024 ** 2:
+            print(f"The memory budget of {self.memory_budget} MB is lower than a single strip of {temp_block_rows} rows, which will be used instead!")
+
+        dict_dest = {}
+        try:
+            for i in list_indices:
+                dict_dest[i] = self.raster_pool.open_write(os.path.join(self.path_cache, self.site_name, dict_files[i]), **out_meta)
+            # The mask stays open, pinned in the pool, while the bands of each strip are read
+            with self.raster_pool.open(os.path.join(self.path_cache, self.site_name, "Mask.tif")) as img_mask:
+                for row_start in range(0, temp_height, temp_strip_rows):
+                    temp_window = rio.windows.Window(0, row_start, temp_width, min(temp_strip_rows, temp_height - row_start))
+                    # The same strip on the grid of the bands
+                    temp_band_window = rio.windows.Window(temp_tile_window.col_off, temp_tile_window.row_off + row_start, temp_window.width, temp_window.height)
+                    values_l2a_b04 = self.read_band('B04', temp_band_window).astype(temp_dtype) + self.offset_l2a_b04
+                    temp_b08_dn = self.read_band('B08', temp_band_window).astype(temp_dtype) + self.offset_l2a_b08
+                    values_mask = np.where(img_mask.read(1, window=temp_window) == 0, temp_dtype.type(1), temp_dtype.type(np.nan))
+                    # NDVI = (B8 - B4) / (B8 + B4)
+                    temp_b04 = values_l2a_b04 / self.quantification_l2a
+                    temp_b08 = temp_b08_dn / self.quantification_l2a
+                    del values_l2a_b04
+                    temp_ndvi = (temp_b08 - temp_b04) / (temp_b08 + temp_b04) * values_mask
+                    if 'NDVI' in dict_dest:
+                        dict_dest['NDVI'].write(temp_ndvi, 1, window=temp_window)
+                    if 'NIRvREF' in dict_dest or 'TF2' in dict_dest:
+                        # NIRvREF = NDVI * B8
+                        temp_nirvref = temp_ndvi * temp_b08_dn / self.quantification_l2a * values_mask
+                        if 'NIRvREF' in dict_dest:
+                            dict_dest['NIRvREF'].write(temp_nirvref, 1, window=temp_window)
+                        if 'TF2' in dict_dest:
+                            # Transfer function 2: B4 * NIRvREF ^ 2
+                            temp_tf2 = temp_b04 * (temp_nirvref ** 2) * values_mask
+                            dict_dest['TF2'].write(temp_tf2, 1, window=temp_window)
+        finally:
+            for dest in dict_dest.values():
+                dest.close()
+
+        # Clip to the ROI! 
+        for i in list_indices:
+            self.clip_raster_by_shapefile(os.path.join(self.path_cache, self.site_name, dict_files[i]))
+
     def cal_l2a_indices(self) -> dict:
         '''
         Calculate the NDVI and NIRVref of L2A images using the values of B04 and B08 bands.
@@ -850,54 +1651,160 @@ class S2(CalVal):
         '''
         # Suppress divide by zero warning
         np.seterr(all='ignore')
-        if not os.path.exists(os.path.join(self.path_cache, self.site_name, "NDVI_ROI.tif")) or not os.path.exists(os.path.join(self.path_cache, self.site_name, "NIRvREF_ROI.tif")):
-            self.create_clipping_raster(['NDVI','NIRvREF'])
-
-        # Calculate avg, std, cv of NDVI inside the ROI
-        image_ndvi_roi = rio.open(os.path.join(self.path_cache, self.site_name, "NDVI_ROI.tif"))
-        values_ndvi_roi = image_ndvi_roi.read(1)
-        temp_ndvi_std = self.cal_std(values_ndvi_roi)
-        temp_ndvi_avg = self.cal_avg(values_ndvi_roi)
-        temp_ndvi_cv = self.cal_cv(values_ndvi_roi)
+        # The ROI rasters of an earlier job of the site are never reused
+        list_indices = self.list_missing_roi_rasters(['NDVI','NIRvREF'])
+        if list_indices:
+            self.create_clipping_raster(list_indices)
+
+        # Calculate avg, std, cv of NDVI inside the ROI, each pixel weighted by its area inside the ROI
+        zonal_stats = self.get_zonal_stats()
+        image_ndvi_roi = self.raster_pool.get(os.path.join(self.path_cache, self.site_name, "NDVI_ROI.tif"))
+        dict_ndvi = zonal_stats.cal_stats(image_ndvi_roi.read(1))
+        temp_ndvi_std = dict_ndvi['std']
+        temp_ndvi_avg = dict_ndvi['avg']
+        temp_ndvi_cv = dict_ndvi['cv']
         temp_ndvi_flag = self.cal_flag(temp_ndvi_cv)
 
         # Calculate avg, std, cv of NIRvREF inside the ROI
-        image_nirv_roi = rio.open(os.path.join(self.path_cache, self.site_name, "NIRv_ROI.tif"))
-        values_nirv_roi = image_nirv_roi.read(1)
-        temp_nirv_std = self.cal_std(values_nirv_roi)
-        temp_nirv_avg = self.cal_avg(values_nirv_roi)
-        temp_nirv_cv = self.cal_cv(values_nirv_roi)
+        image_nirv_roi = self.raster_pool.get(os.path.join(self.path_cache, self.site_name, "NIRv_ROI.tif"))
+        dict_nirv = zonal_stats.cal_stats(image_nirv_roi.read(1))
+        temp_nirv_std = dict_nirv['std']
+        temp_nirv_avg = dict_nirv['avg']
+        temp_nirv_cv = dict_nirv['cv']
         temp_nirv_flag = self.cal_flag(temp_nirv_cv)
 
-        # Manually ensure available memory
-        image_nirv_roi.close()
-        image_ndvi_roi.close()
+        # Save the raw quantities, so that other CV thresholds can be tested later without reading the S2 image again
+        temp_dict = {'site_code': self.site_name, 'date': self.flex_filename.split('.')[0].split('_')[-2], 'flex_filename': self.flex_filename, 's2_filename': self.s2_l2a_name}
+        for index_name, dict_stats in [('ndvi', dict_ndvi), ('nirv', dict_nirv)]:
+            temp_dict.update({index_name + '_n': dict_stats['n'], index_name + '_weight': dict_stats['weight'], index_name + '_sum': dict_stats['sum'],
+                              index_name + '_sum_sq': dict_stats['sum_sq']})
+        temp_dict.update({'ndvi_cv': float(temp_ndvi_cv), 'nirv_cv': float(temp_nirv_cv)})
+        self.results_store.upsert('S2_indices', self.site_name, self.flex_filename, self.s2_l2a_name, temp_dict)
 
         return temp_ndvi_std, temp_ndvi_avg, temp_ndvi_cv, temp_ndvi_flag, temp_nirv_std, temp_nirv_avg, temp_nirv_cv, temp_nirv_flag
         
+    def get_zonal_stats(self) -> ZonalStats:
+        '''
+        Get the zonal statistics of the ROI on the 10 m grid of the current S2 image, shared by all the rasters of the job. 
+        The ROI is built in memory and the coverage of the pixels is calculated only once per job. 
+        '''
+        if self._zonal_stats is None:
+            geom, geom_utm = self.get_roi_geometry()
+            if self.bool_export_roi:
+                self.create_clipping_shapefile(geom, geom_utm)
+            src = self.raster_pool.get(self.path_l2a_b04)
+            self._zonal_stats = ZonalStats.get(geom_utm, src.transform, src.width, src.height)
+        return self._zonal_stats
+
+    def read_roi_indices(self) -> tuple:
+        '''
+        Read only the window of the ROI of B04, B08 and MSK_CLASSI_B00, with no full-tile raster nor any file written, i.e. a few MB
+        per image whatever the size of the tile, and calculate the indices of the window the same way as create_clipping_raster.
+        Returns:
+            tuple: (the combined mask, 0 for a valid pixel, the NDVI, the NIRvREF and the TF2 of the window, NaN on invalid pixels).
+        '''
+        np.seterr(all='ignore')
+        temp_window = self.get_zonal_stats().window
+        temp_dtype = np.dtype(self.precision)
+        values_l2a_b04 = self.read_band('B04', temp_window).astype(temp_dtype) + self.offset_l2a_b04
+        values_l2a_b08 = self.read_band('B08', temp_window).astype(temp_dtype) + self.offset_l2a_b08
+        # The 60 m window of the mask covering the 10 m window, upscaled and cut to the 10 m window
+        temp_row_off, temp_col_off = temp_window.row_off // 6, temp_window.col_off // 6
+        temp_window_mask = rio.windows.Window(temp_col_off, temp_row_off, -(-(temp_window.col_off + temp_window.width) // 6) - temp_col_off,
+                                              -(-(temp_window.row_off + temp_window.height) // 6) - temp_row_off)
+        values_mask_combined = (self.read_band('MSK_CLASSI_B00', temp_window_mask)[0:3] != 0).any(axis=0).astype(np.uint8)
+        values_mask_combined = np.repeat(np.repeat(values_mask_combined, 6, axis=0), 6, axis=1)
+        values_mask_combined = values_mask_combined[temp_window.row_off - temp_row_off * 6:temp_window.row_off - temp_row_off * 6 + temp_window.height,
+                                                    temp_window.col_off - temp_col_off * 6:temp_window.col_off - temp_col_off * 6 + temp_window.width]
+        values_mask = np.where(values_mask_combined == 0, temp_dtype.type(1), temp_dtype.type(np.nan))
+        # NDVI = (B8 - B4) / (B8 + B4), NIRvREF = NDVI * B8, TF2 = B4 * NIRvREF ^ 2
+        temp_ndvi = (values_l2a_b08 / self.quantification_l2a - values_l2a_b04 / self.quantification_l2a) / (values_l2a_b08 / self.quantification_l2a + values_l2a_b04 / self.quantification_l2a)
+        temp_ndvi = temp_ndvi * values_mask
+        temp_nirvref = temp_ndvi * values_l2a_b08 / self.quantification_l2a
+        temp_tf2 = values_l2a_b04 / self.quantification_l2a * (temp_nirvref ** 2)
+        return values_mask_combined, temp_ndvi, temp_nirvref, temp_tf2
+
+    def cal_roi_indices(self) -> dict:
+        '''
+        Calculate the valid pixels and the NDVI, NIRvREF and TF2 statistics of the ROI from the window of the ROI (see read_roi_indices).
+        The indices and the mask are the same as create_clipping_raster and cal_valid_pixels, weighted by the coverage of the ROI.
+        Returns:
+            dict: 'valid_pixels' and 'valid_ratio', and for each of 'ndvi', 'nirv' and 'tf2' its statistics from ZonalStats.cal_stats.
+        '''
+        zonal_stats = self.get_zonal_stats()
+        values_mask, temp_ndvi, temp_nirvref, temp_tf2 = self.read_roi_indices()
+        temp_valid_pixels, temp_valid_ratio = zonal_stats.cal_valid_ratio(values_mask)
+        return {'valid_pixels': temp_valid_pixels, 'valid_ratio': temp_valid_ratio, 'ndvi': zonal_stats.cal_stats(temp_ndvi),
+                'nirv': zonal_stats.cal_stats(temp_nirvref), 'tf2': zonal_stats.cal_stats(temp_tf2)}
+
+    def cal_flex_pixel_indices(self) -> pd.DataFrame:
+        '''
+        Calculate the valid pixels and the NDVI, NIRvREF and TF2 statistics of each FLEX pixel of the ROI, so that every FLEX pixel
+        can be compared on its own. The indices of the window of the ROI are reduced to the FLEX pixels at once (see CellStats), each
+        S2 pixel weighted by its area inside each FLEX pixel, and saved into the table "S2_pixels" of the results store.
+        Returns:
+            pd.DataFrame: one row per FLEX pixel of the ROI, in row-major order.
+        '''
+        # The FLEX pixels of the ROI, the same ones as FLEX.cal_sif and FLEX.sif_output
+        temp_ds = xr.open_dataset(self.get_flex_path(self.site_name, self.flex_filename))
+        longitudes = temp_ds['longitude'].values
+        latitudes = temp_ds['latitude'].values
+        temp_ds.close()
+        temp_lat_slice, temp_lon_slice = self.get_flex_window(latitudes, longitudes, self.site_lat, self.site_lon, self.area)
+        cell_stats = CellStats(self.get_zonal_stats(), self.s2_crs, latitudes[temp_lat_slice], longitudes[temp_lon_slice],
+                               float(latitudes[1] - latitudes[0]), float(longitudes[1] - longitudes[0]))
+        values_mask, temp_ndvi, temp_nirvref, temp_tf2 = self.read_roi_indices()
+        temp_valid_pixels, temp_valid_ratio = cell_stats.cal_valid_ratio(values_mask)
+        temp_rows, temp_cols = np.meshgrid(np.arange(temp_lat_slice.start, temp_lat_slice.stop), np.arange(temp_lon_slice.start, temp_lon_slice.stop), indexing='ij')
+        df_pixels = pd.DataFrame({'site_code': self.site_name, 'flex_filename': self.flex_filename, 's2_filename': self.s2_l2a_name,
+                                  'flex_row': temp_rows.ravel(), 'flex_col': temp_cols.ravel(), 's2_valid_pixels': temp_valid_pixels,
+                                  's2_valid_ratio': temp_valid_ratio * 100})
+        for index_name, values in [('ndvi', temp_ndvi), ('nirv', temp_nirvref), ('tf2', temp_tf2)]:
+            dict_stats = cell_stats.cal_stats(values)
+            df_pixels[f"s2_{index_name}_avg"] = dict_stats['avg']
+            df_pixels[f"s2_{index_name}_sd"] = dict_stats['std']
+            df_pixels[f"s2_{index_name}_cv"] = dict_stats['cv'] * 100
+        self.results_store.upsert('S2_pixels', self.site_name, self.flex_filename, self.s2_l2a_name, df_pixels.to_dict(orient='records'))
+        return df_pixels
+
     def clip_raster_by_shapefile(self, path_raster) -> None:
         '''
-        Clip the raster to the shapefile and save to local storage. 
+        Clip the raster to the window of the ROI and save to local storage. The pixels outside the ROI are set to NaN. 
         Args:
-            path_raster (str): path to the raster to be clipped. 
+            path_raster (str): path to the raster to be clipped, on the 10 m grid of the S2 image and covering the window of the tile. 
         '''
-        # Create the clipping shapefile
-        shp_clipping = self.create_clipping_shapefile()
-        # Read the raster to be clipped
-        raster = rio.open(path_raster)
+        zonal_stats = self.get_zonal_stats()
+        temp_tile_window = self.get_tile_window()
+        temp_window = rio.windows.Window(zonal_stats.window.col_off - temp_tile_window.col_off, zonal_stats.window.row_off - temp_tile_window.row_off,
+                                         zonal_stats.window.width, zonal_stats.window.height)
+        # Read the raster to be clipped, which covers the window of the tile
+        with self.raster_pool.open(path_raster) as raster:
+            out_image = raster.read(window=temp_window)
+            out_meta = raster.meta
         # Clipping! 
-        out_image, out_transform = rio.mask.mask(raster, shp_clipping.geometry, crop=True)
-        out_meta = raster.meta
+        out_image[:, zonal_stats.weights == 0] = np.nan
+        out_transform = zonal_stats.transform
         out_meta.update({"driver": "GTiff",
                         "height": out_image.shape[1],
                         "width": out_image.shape[2],
                         "transform": out_transform})
         # Save!
-        with rio.open(os.path.join(self.path_cache, self.site_name, os.path.splitext(os.path.basename(path_raster))[0] + "_ROI.tif"), "w", **out_meta) as dest:
+        path_roi = os.path.join(self.path_cache, self.site_name, os.path.splitext(os.path.basename(path_raster))[0] + "_ROI.tif")
+        with self.raster_pool.open_write(path_roi, **out_meta) as dest:
             dest.write(out_image)
-        
-        # Manually ensure available memory
-        raster.close()
+        self._roi_rasters.add(path_roi)
+
+    def list_missing_roi_rasters(self, list_indices: list) -> list:
+        '''
+        List the indices whose ROI raster hasn't been written by this job yet. The ROI rasters in the cache folder of the site may 
+        come from an earlier job with another S2 image, so only the ones written by this job are used. 
+        Args:
+            list_indices (list): the indices, among 'NDVI', 'NIRvREF' and 'TF2'. 
+        Returns:
+            list: the indices to save and clip again. 
+        '''
+        dict_files = {'NDVI': "NDVI_ROI.tif", 'NIRvREF': "NIRv_ROI.tif", 'TF2': "TF2_ROI.tif"}
+        return [i for i in list_indices if os.path.join(self.path_cache, self.site_name, dict_files[i]) not in self._roi_rasters]
     
     def cal_valid_pixels(self) -> tuple:
         '''
@@ -905,65 +1812,70 @@ class S2(CalVal):
         Returns:
             tuple: (bool_pass, num_valid_pixels, percentage_valid_pixels)
         '''
-        mask_l2a = rio.open(self.path_l2a_mask)
-        mask_l2a_opaque_clouds = mask_l2a.read(1)
-        mask_l2a_cirrus_clouds = mask_l2a.read(2)
-        mask_l2a_snowice_areas = mask_l2a.read(3)
-        # Check if all three masks are empty. If not empty, we should check if the masked
+        # The mask of the window of the tile
+        values_mask_l2a = self.read_band('MSK_CLASSI_B00')
+        mask_l2a_opaque_clouds = values_mask_l2a[0]
+        mask_l2a_cirrus_clouds = values_mask_l2a[1]
+        mask_l2a_snowice_areas = values_mask_l2a[2]
         mask_combined = mask_l2a_opaque_clouds + mask_l2a_cirrus_clouds + mask_l2a_snowice_areas
-        if np.max(mask_combined) >= 1:
-            # Upscale 60mx60m mask to 10mx10m without modifying any pixel values
-            mask_combined_upscale = np.repeat(mask_combined, 6, axis = 0)
-            mask_combined_upscale = np.repeat(mask_combined_upscale, 6, axis = 1)
-            # Read a random S2 image to retrieve metadata
-            img_l2a_b04 = rio.open(self.path_l2a_b04)
+        # Upscale 60mx60m mask to 10mx10m without modifying any pixel values
+        mask_combined_upscale = np.repeat(mask_combined, 6, axis = 0)
+        mask_combined_upscale = np.repeat(mask_combined_upscale, 6, axis = 1)
+        # Read a random S2 image to retrieve metadata
+        temp_tile_window = self.get_tile_window()
+        with self.raster_pool.open(self.path_l2a_b04) as img_l2a_b04:
             mask_meta = img_l2a_b04.meta
-            # Save this mask to the cache folder
-            with rio.open(os.path.join(self.path_cache,self.site_name,"Mask.tif"), "w", **mask_meta) as dest:
-                dest.write(mask_combined_upscale, indexes = 1)
-            # clip and save the mask raster
-            self.clip_raster_by_shapefile(os.path.join(self.path_cache, self.site_name, "Mask.tif"))
-            # Validate pixels in the ROI
-            temp_mask_clipped = rio.open(os.path.join(self.path_cache, self.site_name, "Mask_ROI.tif"))
-            temp_mask_clipped_values = temp_mask_clipped.read(1)
-            # Manually ensure available memory
-            mask_l2a.close()
-            img_l2a_b04.close()
-            temp_mask_clipped.close()
-            if np.max(temp_mask_clipped_values) >= 1:
-                temp_valid_pixels = np.count_nonzero(temp_mask_clipped_values == 0)
-                temp_invalid_pixels = np.count_nonzero(temp_mask_clipped_values != 0)
-                temp_total_pixels = temp_valid_pixels + temp_invalid_pixels
-                temp_valid_pixels_ratio = temp_valid_pixels / temp_total_pixels
+            mask_meta.update({"transform": rio.windows.transform(temp_tile_window, img_l2a_b04.transform), "width": temp_tile_window.width,
+                              "height": temp_tile_window.height})
+        # Save this mask to the cache folder, always, so that the clipping rasters never use the mask of an earlier job
+        with self.raster_pool.open_write(os.path.join(self.path_cache,self.site_name,"Mask.tif"), **mask_meta) as dest:
+            dest.write(mask_combined_upscale, indexes = 1)
+        # Check if all three masks are empty. If not empty, we should check if the masked
+        if np.max(mask_combined) >= 1:
+            # Validate pixels in the ROI, each pixel counting for its area inside the ROI
+            zonal_stats = self.get_zonal_stats()
+            temp_mask_clipped_values = self.clip_tile_window(mask_combined_upscale)
+            if np.max(temp_mask_clipped_values[zonal_stats.weights > 0]) >= 1:
+                temp_valid_pixels, temp_valid_pixels_ratio = zonal_stats.cal_valid_ratio(temp_mask_clipped_values)
                 if temp_valid_pixels_ratio >= self.cloud:
                     print(f"But the ratio of valid pixels is {temp_valid_pixels_ratio:.2%}, equal to or greater than {self.cloud:.2%}, so we can use these S2 images. ")
                     bool_pass = True
-                    return bool_pass, temp_valid_pixels, temp_valid_pixels_ratio
+                    return self.save_valid_pixels(bool_pass, temp_valid_pixels, temp_valid_pixels_ratio)
                 else:
                     print(f"And the ratio of valid pixels is {temp_valid_pixels_ratio:.2%}, lower than {self.cloud:.2%}, so we can't use these S2 images and hence we can't proceed. ")
                     bool_pass = False
-                    return bool_pass, temp_valid_pixels, temp_valid_pixels_ratio
+                    return self.save_valid_pixels(bool_pass, temp_valid_pixels, temp_valid_pixels_ratio)
             else:
                 print(f"All pixels in the current S2 image are valid! ")
                 bool_pass = True
-                return bool_pass, (self.area / 10) ** 2, 1  
+                return self.save_valid_pixels(bool_pass, (self.area / 10) ** 2, 1)
 
         else:
             print(f"All pixels in the current S2 image are valid! ")
             bool_pass = True
 
-        # Manually ensure available memory
-        mask_l2a.close()
-        return bool_pass, (self.area / 10) ** 2, 1   
+        return self.save_valid_pixels(bool_pass, (self.area / 10) ** 2, 1)
+
+    def save_valid_pixels(self, bool_pass: bool, num_valid_pixels: Union[int, float], ratio_valid_pixels: float) -> tuple:
+        '''
+        Save the valid pixels of the current job into the table "S2_valid" of the results store, so that other cloud thresholds can be 
+        tested later without reading the S2 image again (see FLEX.sweep_thresholds). 
+        Returns:
+            tuple: (bool_pass, num_valid_pixels, ratio_valid_pixels), unchanged. 
+        '''
+        self.results_store.upsert('S2_valid', self.site_name, self.flex_filename, self.s2_l2a_name, {
+            'site_code': self.site_name, 'date': self.flex_filename.split('.')[0].split('_')[-2], 'flex_filename': self.flex_filename,
+            's2_filename': self.s2_l2a_name, 'valid_pixels': float(num_valid_pixels), 'valid_ratio': float(ratio_valid_pixels)})
+        return bool_pass, num_valid_pixels, ratio_valid_pixels
 
     def cal_std(self, value):
-        return np.nanstd(value)
+        return np.nanstd(value, dtype=np.float64)
         
     def cal_avg(self, value):
-        return np.nanmean(value)
+        return np.nanmean(value, dtype=np.float64)
 
     def cal_cv(self, value):
-        return np.nanstd(value) / np.nanmean(value)
+        return np.nanstd(value, dtype=np.float64) / np.nanmean(value, dtype=np.float64)
     
     def cal_flag(self, value):
         if value <= self.threshold_cv:
@@ -973,38 +1885,26 @@ class S2(CalVal):
 
     def cal_transfer_function(self, flex_date) -> bool:
         '''
-        Application of transfer function, and then save the calculated averages into a temporary .csv file in "Cache\\TF
+        Application of transfer function, and then save the calculated averages into the table "TF" of the results store
         Args:
             flex_date (int): The date of the current flex image. 
         Returns:
             bool: The validality of FLOX
         '''
-        if not os.path.exists(os.path.join(self.path_cache, self.site_name, "NIRv_ROI.tif")) or not os.path.exists(os.path.join(self.path_cache, self.site_name, "TF2_ROI.tif")):
-            self.create_clipping_raster(['NIRvREF','TF2'])
+        # The ROI rasters of an earlier job of the site are never reused
+        list_indices = self.list_missing_roi_rasters(['NIRvREF','TF2'])
+        if list_indices:
+            self.create_clipping_raster(list_indices)
 
         # ------------------------ Find the index of the site ------------------------ #
-        # Create a point shapefile of the site, using Lon-Lat
-        df_4326 = pd.DataFrame({
-            "Site": [self.site_name],
-            "Latitude": [self.site_lat],
-            "Longitude": [self.site_lon]
-        })
-        gdf_4326 = gpd.GeoDataFrame(
-            df_4326,
-            geometry = gpd.points_from_xy(df_4326['Longitude'], df_4326['Latitude']),
-            crs = "EPSG:4326"
-        )
-        # Convert the crs from lat-lon to that of the S2 image
-        gdf_s2_crs = gdf_4326.to_crs(self.s2_crs)
-        # Retrieve the coordinates in the new crs of our site
-        site_x = gdf_s2_crs.geometry.x.values[0]
-        site_y = gdf_s2_crs.geometry.y.values[0]
-        # Open image
-        img_tf1 = rio.open(os.path.join(self.path_cache, self.site_name, "NIRv_ROI.tif"))
-        img_tf2 = rio.open(os.path.join(self.path_cache, self.site_name, "TF2_ROI.tif"))
-        # Read values
-        value_tf1 = img_tf1.read(1)
-        value_tf2 = img_tf2.read(1)
+        # Coordinates of our site in the crs of the S2 image
+        site_x, site_y = self.get_site_xy()
+        # Read values and the pixel index of the site, the same in both ROI rasters
+        with self.raster_pool.open(os.path.join(self.path_cache, self.site_name, "NIRv_ROI.tif")) as img_tf1:
+            value_tf1 = img_tf1.read(1)
+            site_row, site_col = img_tf1.index(site_x, site_y)
+        with self.raster_pool.open(os.path.join(self.path_cache, self.site_name, "TF2_ROI.tif")) as img_tf2:
+            value_tf2 = img_tf2.read(1)
 
         # Get the corresponding FLOX data
         df_flox = pd.read_csv(self.file_flox_csv, sep = ';')
@@ -1022,53 +1922,144 @@ class S2(CalVal):
 
         # ------------------------------------ TF1 ----------------------------------- #
         for var_name in ['SIF_O2A','SIF_FARRED_max','SIF_int']:
-            # Get the pixel index of the site
-            site_row, site_col = img_tf1.index(site_x, site_y)
             # Get the value of the site based on the transfer function
             value_s2_flox = value_tf1[site_row, site_col]
             # Get the value of the flox of the current index
             value_flox = df_flox_site[var_name].values[0].item()
-            if isinstance(value_s2_flox, np.float64) and np.isnan(value_s2_flox) or not value_s2_flox:
+            if isinstance(value_s2_flox, np.floating) and np.isnan(value_s2_flox) or not value_s2_flox:
                 print(f"{self.site_name} is inside an invalid pixel. The transfer function won't be applied!")
-                temp_dict[var_name] = 'N/A'
+                temp_dict[var_name] = np.nan
                 bool_flox_invalid = True
             else:
                 # Apply transfer function 1
                 value_tf = value_tf1 / value_s2_flox * value_flox
-                # Calculate average
-                value_tf_avg = np.nanmean(value_tf)
+                # Calculate average, each pixel weighted by its area inside the ROI
+                value_tf_avg = self.get_zonal_stats().cal_stats(value_tf)['avg']
                 # Update the dicct
-                temp_dict[var_name] = str(value_tf_avg)
+                temp_dict[var_name] = float(value_tf_avg)
                 bool_flox_invalid = False
         # ------------------------------------ TF2 ----------------------------------- #
         for var_name in ['SIF_O2B','SIF_RED_max']:
-            # Get the pixel index of the site
-            site_row, site_col = img_tf2.index(site_x, site_y)
             # Get the value of the site based on the transfer function
             value_s2_flox = value_tf2[site_row, site_col]
             # Get the value of the flox of the current index
             value_flox = df_flox_site[var_name].values[0].item()
-            if isinstance(value_s2_flox, np.float64) and np.isnan(value_s2_flox) or not value_s2_flox:
+            if isinstance(value_s2_flox, np.floating) and np.isnan(value_s2_flox) or not value_s2_flox:
                 print(f"{self.site_name} is inside an invalid pixel. The transfer function won't be applied!")
-                temp_dict[var_name] = 'N/A'
+                temp_dict[var_name] = np.nan
             else:
                 # Apply transfer function 2
                 value_tf = value_tf2 / value_s2_flox * value_flox
-                # Calculate average
-                value_tf_avg = np.nanmean(value_tf)
+                # Calculate average, each pixel weighted by its area inside the ROI
+                value_tf_avg = self.get_zonal_stats().cal_stats(value_tf)['avg']
                 # Update the dicct
-                temp_dict[var_name] = str(value_tf_avg)
+                temp_dict[var_name] = float(value_tf_avg)
+
+        # ------------------------- Monte Carlo uncertainty -------------------------- #
+        if self.bool_uncertainty:
+            print(f"Propagating FLOX and S2 uncertainties through the transfer functions with {self.num_samples} Monte Carlo samples......")
+            temp_dict.update(self.cal_tf_uncertainty(value_tf1, value_tf2, site_row, site_col, df_flox_site))
 
-        # Save to local storage  
-        df_dict = pd.DataFrame([temp_dict])
-        if not os.path.exists(os.path.join(self.path_cache,"TF")):
-            os.makedirs(os.path.join(self.path_cache,"TF"))
-        df_dict.to_csv(os.path.join(self.path_cache,"TF",self.site_name + "_" + flex_date + ".csv"), index = False, na_rep= 'N/A')
+        # Save to the results store
+        self.results_store.upsert('TF', self.site_name, self.flex_filename, self.s2_l2a_name, temp_dict)
         return bool_flox_invalid
 
+    def cal_tf_uncertainty(self, value_tf1: np.ndarray, value_tf2: np.ndarray, site_row: int, site_col: int, df_flox_site: pd.DataFrame) -> dict:
+        '''
+        Propagate the FLOX uncertainties and the S2 reflectance noise through the transfer functions by Monte Carlo.
+        The reflectances are the B04 and B08 of the window of the ROI, read as read_roi_indices does (from the shared bands if 
+        attached), and the samples are evaluated in chunks of at most _MC_CHUNK_SIZE values, so that the memory is bounded whatever
+        the number of samples and the size of the ROI. The results don't depend on the size of the chunks.
+        Args:
+            value_tf1 (np.ndarray): NIRvREF values inside the ROI, NaN on the pixels outside the ROI or masked.
+            value_tf2 (np.ndarray): TF2 values inside the ROI, NaN on the pixels outside the ROI or masked.
+            site_row (int): row index of the site inside the ROI.
+            site_col (int): column index of the site inside the ROI.
+            df_flox_site (pd.DataFrame): FLOX record of the site on the FLEX date.
+        Returns:
+            dict: '_un' (standard deviation), '_mc_mean', '_mc_p05', '_mc_p50' and '_mc_p95' of each upscaled SIF metric.
+        '''
+        np.seterr(all='ignore')
+        # Independent streams for the noise of B04, of B08 and of the FLOX values, so that the chunks draw the same samples as one draw
+        rng_b04, rng_b08, rng_flox = np.random.default_rng(self.random_seed).spawn(3)
+        num_samples = self.num_samples
+
+        # The reflectances of the window of the ROI, the same grid as the ROI rasters
+        zonal_stats = self.get_zonal_stats()
+        value_b04 = (self.read_band('B04', zonal_stats.window).astype(np.float32) + self.offset_l2a_b04) / self.quantification_l2a
+        value_b08 = (self.read_band('B08', zonal_stats.window).astype(np.float32) + self.offset_l2a_b08) / self.quantification_l2a
+        # Keep only the valid pixels of the ROI as a flat vector; the site pixel is always kept as the first element
+        bool_valid = ~np.isnan(value_tf1) & ~np.isnan(value_tf2) & (zonal_stats.weights > 0)
+        bool_site_valid = bool(bool_valid[site_row, site_col])
+        bool_valid[site_row, site_col] = False
+        value_b04 = np.concatenate(([value_b04[site_row, site_col]], value_b04[bool_valid])).astype(np.float32)
+        value_b08 = np.concatenate(([value_b08[site_row, site_col]], value_b08[bool_valid])).astype(np.float32)
+        # Area of each pixel inside the ROI, as for the averages of the transfer functions; none for an invalid site pixel
+        weight_site = zonal_stats.weights[site_row, site_col] if bool_site_valid else 0
+        weights = np.concatenate(([weight_site], zonal_stats.weights[bool_valid])).astype(np.float32)
+        weight_roi = weights.sum(dtype=np.float64)
+
+        # Ratio between the weighted ROI average and the site pixel, one per sample, the reflectances of every pixel perturbed
+        # in chunks of (samples, pixels)
+        dict_ratio = {'TF1': np.empty(num_samples), 'TF2': np.empty(num_samples)}
+        temp_chunk = max(1, self._MC_CHUNK_SIZE // value_b04.size)
+        for temp_start in range(0, num_samples, temp_chunk):
+            temp_stop = min(temp_start + temp_chunk, num_samples)
+            shape = (temp_stop - temp_start, value_b04.size)
+            # Evaluated in place, so that a chunk needs at most four (samples, pixels) arrays
+            sample_b04 = rng_b04.standard_normal(shape, dtype=np.float32)
+            sample_b04 *= self.reflectance_noise
+            sample_b04 += 1
+            sample_b04 *= value_b04
+            sample_b08 = rng_b08.standard_normal(shape, dtype=np.float32)
+            sample_b08 *= self.reflectance_noise
+            sample_b08 += 1
+            sample_b08 *= value_b08
+            # NIRvREF = (B8 - B4) / (B8 + B4) * B8, TF2 = B4 * NIRvREF ^ 2
+            temp_sum = sample_b08 + sample_b04
+            sample_tf1 = sample_b08 - sample_b04
+            sample_tf1 /= temp_sum
+            sample_tf1 *= sample_b08
+            del sample_b08
+            sample_tf2 = np.square(sample_tf1, out=temp_sum)
+            sample_tf2 *= sample_b04
+            del sample_b04
+            for tf_name, sample_tf in [('TF1', sample_tf1), ('TF2', sample_tf2)]:
+                temp_site = sample_tf[:, 0].astype(np.float64)
+                # Weighted sum of each sample, NaN counting as zero as for np.nansum
+                temp_sum_roi = np.einsum('ij,j->i', np.nan_to_num(sample_tf, copy=False), weights, dtype=np.float64)
+                dict_ratio[tf_name][temp_start:temp_stop] = temp_sum_roi / weight_roi / temp_site
+        dict_site_value = {'TF1': value_tf1[site_row, site_col], 'TF2': value_tf2[site_row, site_col]}
+        dict_tf_vars = {'TF1': ['SIF_O2A','SIF_FARRED_max','SIF_int'], 'TF2': ['SIF_O2B','SIF_RED_max']}
+
+        temp_dict = {}
+        for tf_name, list_vars in dict_tf_vars.items():
+            if np.isnan(dict_site_value[tf_name]) or not dict_site_value[tf_name]:
+                for var_name in list_vars:
+                    for suffix in ['_un', '_mc_mean', '_mc_p05', '_mc_p50', '_mc_p95']:
+                        temp_dict[var_name + suffix] = np.nan
+                continue
+            # Perturb the FLOX values of all metrics of this transfer function at once: (samples, metrics)
+            value_flox = df_flox_site[list_vars].values[0].astype(float)
+            value_flox_un = df_flox_site[[var_name + '_un' for var_name in list_vars]].values[0].astype(float)
+            sample_flox = value_flox + value_flox_un * rng_flox.standard_normal((num_samples, len(list_vars)))
+            # Upscaled SIF of every sample and metric
+            sample_sif = sample_flox * dict_ratio[tf_name][:, np.newaxis]
+            sif_std = np.nanstd(sample_sif, axis=0)
+            sif_mean = np.nanmean(sample_sif, axis=0)
+            sif_percentiles = np.nanpercentile(sample_sif, [5, 50, 95], axis=0)
+            for k, var_name in enumerate(list_vars):
+                temp_dict[var_name + '_un'] = float(sif_std[k])
+                temp_dict[var_name + '_mc_mean'] = float(sif_mean[k])
+                temp_dict[var_name + '_mc_p05'] = float(sif_percentiles[0, k])
+                temp_dict[var_name + '_mc_p50'] = float(sif_percentiles[1, k])
+                temp_dict[var_name + '_mc_p95'] = float(sif_percentiles[2, k])
+        return temp_dict
+
     def remove_cache(self):
         # Delete cache folder? 
         if self.bool_delete_cache:
+            self.raster_pool.close_folder(os.path.join(self.path_cache, self.site_name))
             if os.path.exists(os.path.join(self.path_cache, self.site_name, "NDVI.tif")):
                 os.remove(os.path.join(self.path_cache, self.site_name, "NDVI.tif"))
             if os.path.exists(os.path.join(self.path_cache, self.site_name, "NIRv.tif")):           
@@ -1080,4 +2071,66 @@ class S2(CalVal):
             if os.path.exists(os.path.join(self.path_cache, self.site_name, "NIRv_ROI.tif")):           
                 os.remove(os.path.join(self.path_cache, self.site_name, "NIRv_ROI.tif"))
             if os.path.exists(os.path.join(self.path_cache, self.site_name, "TF2_ROI.tif")):
-                os.remove(os.path.join(self.path_cache, self.site_name, "TF2_ROI.tif"))
\ No newline at end of file
+                os.remove(os.path.join(self.path_cache, self.site_name, "TF2_ROI.tif"))
+
+class LogRecord:
+    '''
+    One row of the L2B log report, filled by a single job (a site, or a FLEX image of a site) and returned to the main loop. 
+    All fields are 'N/A' until the job sets them, so that every row has all the columns whatever branch the job takes. 
+    '''
+
+    # Columns of the log report, in order
+    __slots__ = ('site_code', 'latitude', 'longitude', 'reference_area', 'time_window', 'threshold_CV', 'vegetation_pixel', 'threshold_cloud',
+                 'flex_date', 'flex_time', 'flex_filename', 'flex_valid_pixels', 's2_filename', 's2_date', 's2_time', 'time_difference_s2_flex',
+                 's2_valid_pixels', 's2_ndvi_avg', 's2_ndvi_sd', 's2_ndvi_cv', 's2_ndvi_cv_flag', 's2_nirv_avg', 's2_nirv_sd', 's2_nirv_cv',
+                 's2_nirv_cv_flag', 'note')
+
+    def __init__(self, site_code: str, latitude: float, longitude: float, reference_area: int, time_window: int, threshold_cv: float, vegetation_pixel: float, threshold_cloud: float):
+        '''
+        Args:
+            site_code (str): the name of the site. 
+            latitude (float): the latitude of the site. 
+            longitude (float): the longitude of the site. 
+            reference_area (int): the size of the ROI in meters. 
+            time_window (int): the maximum time difference in days between the S2 image and the FLEX image. 
+            threshold_cv (float): the threshold of CV, between 0 and 1. 
+            vegetation_pixel (float): the threshold of vegetation pixels, between 0 and 1. 
+            threshold_cloud (float): the minimum ratio of valid pixels, between 0 and 1. 
+        '''
+        for name in self.__slots__:
+            setattr(self, name, 'N/A')
+        self.site_code = site_code
+        self.latitude = latitude
+        self.longitude = longitude
+        self.reference_area = reference_area
+        self.time_window = time_window
+        self.threshold_CV = threshold_cv * 100
+        self.vegetation_pixel = vegetation_pixel * 100
+        self.threshold_cloud = threshold_cloud * 100
+
+    def to_dict(self) -> dict:
+        '''
+        Convert the record to a dict, from column name to value. 
+        '''
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, dict_record: dict) -> 'LogRecord':
+        '''
+        Rebuild a record saved with to_dict, e.g. from the job journal. 
+        '''
+        record = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(record, name, dict_record.get(name, 'N/A'))
+        return record
+
+    @classmethod
+    def to_dataframe(cls, list_records: list) -> pd.DataFrame:
+        '''
+        Assemble the log report from all the records at once, column by column. 
+        Args:
+            list_records (list): the LogRecord of every job. 
+        Returns:
+            pd.DataFrame: the log report. 
+        '''
+        return pd.DataFrame({name: [getattr(record, name) for record in list_records] for name in cls.__slots__}, columns=list(cls.__slots__))
@@ -0,0 +1,150 @@
+import os
+import re
+import json
+import sqlite3
+from contextlib import closing
+import pandas as pd
+import xarray as xr
+import shapely as shp
+
+from site_index import SiteIndex
+
+class FlexCatalog:
+
+    # Constuctor
+    def __init__(self, path_flex_input: str, path_db: str):
+        '''
+        Catalog of the FLEX images, recording once the lat/lon bounds, the grid spacing, the variables and the acquisition time of
+        every file, keyed by its path and its modification time. A file is opened again only when it changes.
+        FLEX images can be put either in the folder of a site, "input_flex_images/<site>/", which assigns them to that site, or all
+        together directly in "input_flex_images", in which case each image is assigned to all the sites it covers, found from the
+        catalog by a query of the spatial index of the sites.
+        Args:
+            path_flex_input (str): path to the folder of the FLEX images.
+            path_db (str): path to the SQLite database file of the run.
+        '''
+        self._path_flex_input = path_flex_input
+        self._path_db = path_db
+        self.__check_db()
+
+    # ------------------------------ Private Methods ----------------------------- #
+
+    # Create the database and its table if not exists
+    def __check_db(self):
+        with closing(self.connect()) as conn, conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS flex_catalog (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    flex_filename TEXT NOT NULL,
+                    site_folder TEXT NOT NULL,
+                    acquisition TEXT,
+                    lat_min REAL,
+                    lat_max REAL,
+                    lon_min REAL,
+                    lon_max REAL,
+                    lat_step REAL,
+                    lon_step REAL,
+                    variables TEXT,
+                    error TEXT
+                )''')
+
+    # All FLEX images, directly in the input folder ('' as site folder) or in the folder of a site
+    def __list_files(self) -> list:
+        list_files = []
+        for entry in os.scandir(self._path_flex_input):
+            if entry.is_file() and entry.name.endswith('.nc'):
+                list_files.append((entry.path, entry.name, ''))
+            elif entry.is_dir():
+                for sub_entry in os.scandir(entry.path):
+                    if sub_entry.is_file() and sub_entry.name.endswith('.nc'):
+                        list_files.append((sub_entry.path, sub_entry.name, entry.name))
+        return list_files
+
+    # Read the metadata of a FLEX image; the bounds are the outer edges of the pixels
+    @staticmethod
+    def __read_metadata(path: str, filename: str) -> dict:
+        temp_match = re.fullmatch(r"^PRS_TD_(\d{8})_(\d{6})\.nc$", filename)
+        record = {'acquisition': temp_match.group(1) + temp_match.group(2) if temp_match else None}
+        try:
+            with xr.open_dataset(path) as temp_ds:
+                longitudes = temp_ds['longitude'].values
+                latitudes = temp_ds['latitude'].values
+                temp_list_vars = list(temp_ds.data_vars)
+            lat_step = abs(latitudes[1] - latitudes[0])
+            lon_step = abs(longitudes[1] - longitudes[0])
+            record.update({'lat_min': float(latitudes.min() - lat_step / 2), 'lat_max': float(latitudes.max() + lat_step / 2),
+                           'lon_min': float(longitudes.min() - lon_step / 2), 'lon_max': float(longitudes.max() + lon_step / 2),
+                           'lat_step': float(lat_step), 'lon_step': float(lon_step), 'variables': json.dumps(temp_list_vars), 'error': None})
+        except Exception as e:
+            record.update({'lat_min': None, 'lat_max': None, 'lon_min': None, 'lon_max': None, 'lat_step': None, 'lon_step': None,
+                           'variables': None, 'error': repr(e)})
+        return record
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def path_flex_input(self):
+        return self._path_flex_input
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    def connect(self) -> sqlite3.Connection:
+        '''
+        Open a new connection to the database. Every call opens its own connection, so the catalog can be used from several processes.
+        '''
+        conn = sqlite3.connect(self._path_db, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def update(self) -> int:
+        '''
+        Bring the catalog up to date with the input folder: new or modified FLEX images are read, removed ones are dropped.
+        Returns:
+            int: the number of FLEX images read.
+        '''
+        list_files = self.__list_files()
+        with closing(self.connect()) as conn:
+            dict_known = {row[0]: (row[1], row[2]) for row in conn.execute('SELECT path, mtime_ns, size FROM flex_catalog')}
+        list_records = []
+        for path, filename, site_folder in list_files:
+            temp_stat = os.stat(path)
+            if dict_known.get(path) == (temp_stat.st_mtime_ns, temp_stat.st_size):
+                continue
+            record = {'path': path, 'mtime_ns': temp_stat.st_mtime_ns, 'size': temp_stat.st_size, 'flex_filename': filename, 'site_folder': site_folder}
+            record.update(self.__read_metadata(path, filename))
+            list_records.append(record)
+        set_removed = set(dict_known) - set(path for path, filename, site_folder in list_files)
+        with closing(self.connect()) as conn, conn:
+            if list_records:
+                temp_columns = list(list_records[0].keys())
+                conn.executemany(f'''
+                    INSERT OR REPLACE INTO flex_catalog ({', '.join(temp_columns)}) VALUES ({', '.join(['?'] * len(temp_columns))})''',
+                    [tuple(record[col] for col in temp_columns) for record in list_records])
+            conn.executemany('DELETE FROM flex_catalog WHERE path = ?', [(path,) for path in set_removed])
+        return len(list_records)
+
+    def read_catalog(self) -> pd.DataFrame:
+        '''
+        Read the whole catalog, one row per FLEX image.
+        '''
+        with closing(self.connect()) as conn:
+            return pd.read_sql_query('SELECT * FROM flex_catalog ORDER BY site_folder, flex_filename', conn)
+
+    def find_scenes(self, site_index: SiteIndex) -> pd.DataFrame:
+        '''
+        Find, in one query of the spatial index of the sites, the sites covered by each FLEX image of the catalog, i.e. the sites whose
+        point falls inside the image. Images which can't be read cover no site.
+        Args:
+            site_index (SiteIndex): the spatial index of the sites, from CalVal.get_site_info.
+        Returns:
+            pd.DataFrame: one row per FLEX image and site covered, with path, flex_filename, site_folder and site_code.
+        '''
+        df_catalog = self.read_catalog()
+        df_catalog = df_catalog[df_catalog['error'].isna()]
+        temp_bounds = df_catalog[['lon_min', 'lat_min', 'lon_max', 'lat_max']].to_numpy(dtype=float)
+        temp_boxes = shp.box(temp_bounds[:, 0], temp_bounds[:, 1], temp_bounds[:, 2], temp_bounds[:, 3])
+        df_match = site_index.query(dict(zip(df_catalog['path'], temp_boxes)), predicate='contains', geometry='site')
+        df_match = df_match.rename(columns={'footprint': 'path'})
+        return df_catalog[['path', 'flex_filename', 'site_folder']].merge(df_match, on='path', how='inner')
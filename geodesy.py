@@ -0,0 +1,57 @@
+from functools import lru_cache
+import numpy as np
+import shapely as shp
+from pyproj import Transformer
+
+# Transformers already created, by source and target CRS
+@lru_cache(maxsize=32)
+def _get_transformer(crs_from: str, crs_to: str) -> Transformer:
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+class Geodesy:
+    '''
+    Coordinate transforms of points and boxes in bulk, over arrays, with one pyproj Transformer per pair of CRS created once per
+    process and reused by all the jobs, instead of a GeoDataFrame and a to_crs call for every site or ROI.
+    The coordinates are always in (x, y) order, i.e. (longitude, latitude) for EPSG:4326.
+    '''
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    @staticmethod
+    def get_transformer(crs_from, crs_to) -> Transformer:
+        '''
+        Get the transformer from a CRS to another, e.g. from "EPSG:4326" to the CRS of an S2 image, creating it only the first time.
+        '''
+        return _get_transformer(str(crs_from), str(crs_to))
+
+    @staticmethod
+    def transform_points(x, y, crs_from, crs_to) -> tuple:
+        '''
+        Transform points from a CRS to another, all points in one call.
+        Args:
+            x: the x coordinates (longitudes in EPSG:4326), a number or an array.
+            y: the y coordinates (latitudes in EPSG:4326), a number or an array.
+            crs_from: the CRS of the points.
+            crs_to: the target CRS.
+        Returns:
+            tuple: (the x coordinates, the y coordinates) in the target CRS, as arrays.
+        '''
+        temp_x, temp_y = Geodesy.get_transformer(crs_from, crs_to).transform(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        return np.asarray(temp_x), np.asarray(temp_y)
+
+    @staticmethod
+    def transform_boxes(minx, miny, maxx, maxy, crs_from, crs_to) -> np.ndarray:
+        '''
+        Transform boxes from a CRS to another, all corners in one call. Like GeoDataFrame.to_crs, only the corners are transformed,
+        so the edges of the boxes stay straight in the target CRS.
+        Args:
+            minx, miny, maxx, maxy: the bounds of the boxes in the source CRS, numbers or arrays.
+            crs_from: the CRS of the boxes.
+            crs_to: the target CRS.
+        Returns:
+            np.ndarray: the boxes as shapely polygons in the target CRS.
+        '''
+        minx, miny, maxx, maxy = np.broadcast_arrays(*[np.atleast_1d(np.asarray(i, dtype=float)) for i in [minx, miny, maxx, maxy]])
+        # Corners in the same order as shapely.box
+        temp_x, temp_y = Geodesy.transform_points(np.stack([maxx, maxx, minx, minx], axis=-1), np.stack([miny, maxy, maxy, miny], axis=-1), crs_from, crs_to)
+        return shp.polygons(np.stack([temp_x, temp_y], axis=-1))
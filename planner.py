@@ -0,0 +1,296 @@
+import os
+import re
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+from class_calval import FLEX, S2
+from site_index import SiteIndex
+
+class Planner:
+
+    # Constuctor
+    def __init__(self, flex: FLEX, num_workers: int = 8):
+        '''
+        A preflight scanner of all inputs. Before any heavy work starts, it checks the names of the FLEX images, the folders and
+        the SAFE structure of the S2 images and the FLOX coverage of every site, and it builds the plan of all jobs
+        (one per FLEX image of a site) with the S2 image each job will use and the bytes it will read.
+        Sites are scanned in parallel, since the scan only lists folders and reads file sizes.
+        Args:
+            flex (FLEX): the FLEX class, holding the input paths.
+            num_workers (int): the number of sites scanned at the same time. Defaults to 8.
+        '''
+        self._flex = flex
+        self._num_workers = num_workers
+
+    # ------------------------------ Private Methods ----------------------------- #
+
+    # Scan all FLEX images of a site
+    def __scan_site(self, row: pd.Series, dict_flox_dates: dict, df_catalog: pd.DataFrame, df_scenes: pd.DataFrame) -> tuple:
+        temp_site_name = row['Sites']
+        list_jobs = []
+        list_issues = []
+
+        # FLEX images of the site: the ones in its folder, then the ones of the flat folder covering the site
+        temp_site_path_input = os.path.join(self._flex.path_flex_input, temp_site_name)
+        temp_site_flex_images_list_nc = []
+        if os.path.exists(temp_site_path_input):
+            temp_site_flex_images_list_nc = [i for i in os.listdir(temp_site_path_input) if i.endswith('.nc')]
+        df_site_scenes = df_scenes[df_scenes['site_code'] == temp_site_name]
+        temp_site_flex_images_list_nc += [i for i in df_site_scenes.loc[df_site_scenes['site_folder'] == '', 'flex_filename']
+                                          if i not in temp_site_flex_images_list_nc]
+        set_covered = set(df_site_scenes['path'])
+        if not os.path.exists(temp_site_path_input) and len(temp_site_flex_images_list_nc) == 0:
+            list_issues.append(self.__issue(temp_site_name, None, 'SKIP', f"Folder '{temp_site_path_input}' not found and no FLEX image covering the site"))
+            return list_jobs, list_issues
+        if len(temp_site_flex_images_list_nc) == 0:
+            list_issues.append(self.__issue(temp_site_name, None, 'SKIP', 'No input FLEX images'))
+            return list_jobs, list_issues
+
+        # S2 images of the site, the ones without a valid sensing date in their names are ignored by the run
+        temp_path_s2_images = os.path.join(self._flex.path_s2_input, temp_site_name)
+        temp_list_s2 = []
+        if os.path.exists(temp_path_s2_images):
+            for temp_s2_image in os.listdir(temp_path_s2_images):
+                if self.get_s2_date(temp_s2_image) is None:
+                    list_issues.append(self.__issue(temp_site_name, None, 'WARNING', f"S2 image '{temp_s2_image}' has no valid sensing date in its name and will be ignored"))
+                else:
+                    temp_list_s2.append(temp_s2_image)
+        # The SAFE structure of each S2 image is checked only once per site
+        dict_safe = {}
+
+        for temp_flex_filename in temp_site_flex_images_list_nc:
+            temp_path_flex = self._flex.get_flex_path(temp_site_name, temp_flex_filename)
+            job = {'site_code': temp_site_name, 'flex_filename': temp_flex_filename, 'flex_date': 'N/A', 's2_filename': 'N/A',
+                   'time_difference_s2_flex': 'N/A', 'status': 'ready', 'note': '',
+                   'flex_bytes': os.path.getsize(temp_path_flex), 's2_bytes': 0}
+            list_jobs.append(job)
+            try:
+                self._flex.check_filename(temp_flex_filename)
+            except ValueError as e:
+                self.__set_job(job, list_issues, 'ERROR', str(e))
+                continue
+            if temp_path_flex in df_catalog.index and pd.notna(df_catalog.at[temp_path_flex, 'error']):
+                self.__set_job(job, list_issues, 'ERROR', f"FLEX image can't be read: {df_catalog.at[temp_path_flex, 'error']}")
+                continue
+            if temp_path_flex not in set_covered:
+                self.__set_job(job, list_issues, 'ERROR', 'FLEX image does not cover the site')
+                continue
+            temp_flex_date = temp_flex_filename.split('.')[0].split('_')[-2]
+            job['flex_date'] = temp_flex_date
+            if temp_site_name not in dict_flox_dates:
+                self.__set_job(job, list_issues, 'ERROR', 'Site not found in the FLOX input')
+                continue
+            if temp_flex_date not in dict_flox_dates[temp_site_name]:
+                self.__set_job(job, list_issues, 'SKIP', f'No FLOX data on the same date {temp_flex_date}')
+                continue
+            if not os.path.exists(temp_path_s2_images):
+                self.__set_job(job, list_issues, 'ERROR', f"Folder '{temp_path_s2_images}' not found")
+                continue
+            if len(temp_list_s2) == 0:
+                self.__set_job(job, list_issues, 'SKIP', 'No input Sentinel-2 images')
+                continue
+            temp_s2_image_final, temp_timediff_final = self.find_nearest_s2(temp_list_s2, temp_flex_date)
+            job['s2_filename'] = temp_s2_image_final
+            job['time_difference_s2_flex'] = temp_timediff_final.days
+            if temp_timediff_final.days > row['Time Window Days']:
+                self.__set_job(job, list_issues, 'SKIP', f"No input Sentinel-2 images available within {row['Time Window Days']} days")
+                continue
+            if temp_s2_image_final not in dict_safe:
+                dict_safe[temp_s2_image_final] = self.scan_safe(os.path.join(temp_path_s2_images, temp_s2_image_final))
+            temp_dict_files, temp_list_missing = dict_safe[temp_s2_image_final]
+            job['s2_bytes'] = sum(temp_dict_files.values())
+            if temp_list_missing:
+                self.__set_job(job, list_issues, 'ERROR', f"S2 image '{temp_s2_image_final}' is missing {', '.join(temp_list_missing)}")
+        return list_jobs, list_issues
+
+    # Check that the S2 image of each ready job covers the ROI of its site, reading only the header of B04 of each image once
+    def __check_coverage(self, site_index: SiteIndex, list_jobs: list, list_issues: list):
+        list_ready = [job for job in list_jobs if job['status'] == 'ready']
+        list_paths = list(dict.fromkeys(os.path.join(self._flex.path_s2_input, job['site_code'], job['s2_filename']) for job in list_ready))
+        with ThreadPoolExecutor(max_workers=self._num_workers) as executor:
+            list_footprints = list(executor.map(self.__get_s2_footprint, list_paths))
+        dict_all = dict(zip(list_paths, list_footprints))
+        dict_footprints = {path: footprint for path, footprint in dict_all.items() if not isinstance(footprint, Exception)}
+        # All sites against all footprints in one query of the index
+        set_intersects = set(site_index.query(dict_footprints, predicate='intersects').itertuples(index=False, name=None))
+        set_contains = set(site_index.query(dict_footprints, predicate='contains').itertuples(index=False, name=None))
+        for job in list_ready:
+            temp_path = os.path.join(self._flex.path_s2_input, job['site_code'], job['s2_filename'])
+            temp_footprint = dict_all[temp_path]
+            if isinstance(temp_footprint, Exception):
+                self.__set_job(job, list_issues, 'ERROR', f"The footprint of the S2 image '{job['s2_filename']}' cannot be read: {temp_footprint!r}")
+            elif (temp_path, job['site_code']) not in set_intersects:
+                self.__set_job(job, list_issues, 'ERROR', f"S2 image '{job['s2_filename']}' does not cover the site")
+            elif (temp_path, job['site_code']) not in set_contains:
+                list_issues.append(self.__issue(job['site_code'], job['flex_filename'], 'WARNING', f"The ROI of the site may be partly outside the S2 image '{job['s2_filename']}'"))
+
+    # Footprint of an S2 image, or the error raised while reading it
+    @staticmethod
+    def __get_s2_footprint(path_safe: str):
+        try:
+            return SiteIndex.get_raster_footprint(S2.match_s2_l2a_files(S2.list_s2_files(path_safe))['B04'][1])
+        except Exception as e:
+            return e
+
+    # Record an issue of a job and change its status
+    def __set_job(self, job: dict, list_issues: list, level: str, message: str):
+        job['status'] = 'skip' if level == 'SKIP' else 'error'
+        job['note'] = message
+        list_issues.append(self.__issue(job['site_code'], job['flex_filename'], level, message))
+
+    @staticmethod
+    def __issue(site_code, flex_filename, level, message):
+        return {'site_code': site_code, 'flex_filename': flex_filename if flex_filename else 'N/A', 'level': level, 'message': message}
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    @staticmethod
+    def get_s2_date(s2_filename: str):
+        '''
+        Get the sensing date of an S2 image from its name, such as "S2A_MSIL2A_20220718T100611_N0510_R022_T32TQQ_20240717T130024.SAFE".
+        Returns:
+            datetime: the sensing date, or None if the name is not in the correct format.
+        '''
+        temp_list = s2_filename.split('_')
+        if len(temp_list) < 3 or not re.fullmatch(r"\d{8}T\d{6}", temp_list[2]):
+            return None
+        try:
+            return datetime.strptime(temp_list[2].split('T')[0], '%Y%m%d')
+        except ValueError:
+            return None
+
+    @staticmethod
+    def find_nearest_s2(list_s2: list, flex_date: str) -> tuple:
+        '''
+        Find the S2 image with the nearest date to a FLEX image. Ties are won by the first image of the list.
+        Args:
+            list_s2 (list): the names of the S2 images of a site.
+            flex_date (str): the date of the FLEX image, in format YYYYMMDD.
+        Returns:
+            tuple: (the name of the S2 image, the time difference between the S2 image and the FLEX image).
+        '''
+        temp_flex_image_datetime = datetime.strptime(flex_date, '%Y%m%d')
+        temp_s2_image_final = None
+        temp_timediff_final = None
+        for temp_s2_image in list_s2:
+            temp_timediff = Planner.get_s2_date(temp_s2_image) - temp_flex_image_datetime
+            if temp_s2_image_final is None or abs(temp_timediff) < abs(temp_timediff_final):
+                temp_timediff_final = temp_timediff
+                temp_s2_image_final = temp_s2_image
+        return temp_s2_image_final, temp_timediff_final
+
+    @staticmethod
+    def scan_safe(path_safe: str) -> tuple:
+        '''
+        Check the SAFE structure of an S2 L2A image, either a folder or a zipped archive, looking for the same files as S2.get_s2_l2a_paths.
+        Args:
+            path_safe (str): the path to the .SAFE folder or archive.
+        Returns:
+            tuple: (dict from the file to its size in bytes, list of the missing files).
+        '''
+        dict_files = {key: file[2] for key, file in S2.match_s2_l2a_files(S2.list_s2_files(path_safe)).items()}
+        list_missing = [i for i in ['B04', 'B08', 'MSK_CLASSI_B00', 'MTD_DS', 'MTD_TL'] if i not in dict_files]
+        return dict_files, list_missing
+
+    def plan(self, df_site: pd.DataFrame, dict_flox_dates: dict) -> tuple:
+        '''
+        Scan the inputs of all sites in parallel and build the job plan. The FLEX images of each site are the ones in its folder and the
+        ones directly in the FLEX input folder covering the site, found from the FLEX catalog. The FLEX and the S2 image of each job
+        must cover the site.
+        Args:
+            df_site (pd.DataFrame): the info of all sites, from FLEX.get_site_info.
+            dict_flox_dates (dict): the dates of the FLOX data of each site, from FLEX.check_flox_dates.
+        Returns:
+            tuple: (the job plan, one row per FLEX image of a site; the issues found, one row per issue).
+        '''
+        site_index = self._flex.site_index if self._flex.site_index is not None else SiteIndex(df_site)
+        # Only new or modified FLEX images are opened, then the sites they cover are found in one query of the index
+        temp_num_read = self._flex.flex_catalog.update()
+        print(f"{temp_num_read} FLEX image(s) added to the catalog or updated!")
+        df_catalog = self._flex.flex_catalog.read_catalog().set_index('path')
+        df_scenes = self._flex.flex_catalog.find_scenes(site_index)
+        with ThreadPoolExecutor(max_workers=self._num_workers) as executor:
+            list_results = list(executor.map(lambda row: self.__scan_site(row, dict_flox_dates, df_catalog, df_scenes), [row for index, row in df_site.iterrows()]))
+        list_jobs = [job for jobs, issues in list_results for job in jobs]
+        list_issues = [issue for jobs, issues in list_results for issue in issues]
+        self.__check_coverage(site_index, list_jobs, list_issues)
+        df_plan = pd.DataFrame(list_jobs, columns=['site_code', 'flex_filename', 'flex_date', 's2_filename', 'time_difference_s2_flex',
+                                                   'status', 'note', 'flex_bytes', 's2_bytes'])
+        df_plan['total_bytes'] = df_plan['flex_bytes'] + df_plan['s2_bytes']
+        df_issues = pd.DataFrame(list_issues, columns=['site_code', 'flex_filename', 'level', 'message'])
+        return df_plan, df_issues
+
+    @staticmethod
+    def print_plan(df_plan: pd.DataFrame, df_issues: pd.DataFrame) -> None:
+        '''
+        Print the job plan, the issues found and the estimated bytes to read.
+        '''
+        print("\033[92m" + "*" * 5 + "JOB PLAN" + "*" * 5 + "\033[0m")
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 250, 'display.max_colwidth', 70):
+            print(df_plan[['site_code', 'flex_filename', 's2_filename', 'time_difference_s2_flex', 'status', 'total_bytes']].to_string(index=False))
+            if len(df_issues) > 0:
+                print("\033[92m" + "*" * 5 + "ISSUES" + "*" * 5 + "\033[0m")
+                print(df_issues.to_string(index=False))
+        df_ready = df_plan[df_plan['status'] == 'ready']
+        # Each file is read at least once, however many jobs use it
+        temp_unique_bytes = df_ready.drop_duplicates(['site_code', 'flex_filename'])['flex_bytes'].sum() + \
+            df_ready.drop_duplicates(['site_code', 's2_filename'])['s2_bytes'].sum()
+        print(f"{len(df_ready)} job(s) ready, {(df_plan['status'] == 'skip').sum()} to be skipped and {(df_plan['status'] == 'error').sum()} with errors!")
+        print(f"Estimated data to read: {df_ready['total_bytes'].sum() / 1024 ** 2:.1f} MB in total, {temp_unique_bytes / 1024 ** 2:.1f} MB of distinct files.")
+        print("\033[92m" + "*" * 5 + "JOB PLAN DONE" + "*" * 5 + "\033[0m")
+
+    @staticmethod
+    def order_jobs(df_plan: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Order the jobs by their shared inputs: grouped by S2 product, then by FLEX image, then by site, so that the jobs reading
+        the same files run one after another while the opened datasets, the decoded windows and the parsed metadata are still hot.
+        Groups keep the order in which they first appear in the plan.
+        Args:
+            df_plan (pd.DataFrame): the job plan, from plan.
+        Returns:
+            pd.DataFrame: the job plan in the new order, keeping the original index.
+        '''
+        df_order = df_plan.copy()
+        list_rank = []
+        for col in ['s2_filename', 'flex_filename', 'site_code']:
+            temp_dict_rank = {value: i for i, value in enumerate(pd.unique(df_order[col]))}
+            df_order['rank_' + col] = df_order[col].map(temp_dict_rank)
+            list_rank.append('rank_' + col)
+        return df_order.sort_values(list_rank, kind='stable').drop(columns=list_rank)
+
+    @staticmethod
+    def cal_locality(df_plan: pd.DataFrame, df_order: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Compare the reuse of the inputs between the order of Sites.csv and the locality-aware order. A job reuses an input when
+        the previous job has read the same one, i.e. the number of reuses is the number of jobs minus the number of runs of
+        consecutive jobs sharing the input. Only the jobs ready to run are counted.
+        Args:
+            df_plan (pd.DataFrame): the job plan in the order of Sites.csv, from plan.
+            df_order (pd.DataFrame): the job plan in the locality-aware order, from order_jobs.
+        Returns:
+            pd.DataFrame: one row per kind of input, with the number of distinct inputs, jobs and reuses in both orders.
+        '''
+        list_rows = []
+        for temp_input, col in [('S2 product', 's2_filename'), ('FLEX image', 'flex_filename')]:
+            temp_row = {'input': temp_input}
+            for temp_order, df in [('site_order', df_plan), ('locality_order', df_order)]:
+                temp_values = df.loc[df['status'] == 'ready', col]
+                temp_runs = int((temp_values != temp_values.shift()).sum())
+                temp_row['distinct'] = temp_values.nunique()
+                temp_row['jobs'] = len(temp_values)
+                temp_row['reuse_' + temp_order] = len(temp_values) - temp_runs
+            list_rows.append(temp_row)
+        return pd.DataFrame(list_rows, columns=['input', 'distinct', 'jobs', 'reuse_site_order', 'reuse_locality_order'])
+
+    @staticmethod
+    def print_locality(df_locality: pd.DataFrame) -> None:
+        '''
+        Print the locality report, from cal_locality.
+        '''
+        print("\033[92m" + "*" * 5 + "LOCALITY REPORT" + "*" * 5 + "\033[0m")
+        print(df_locality.to_string(index=False))
+        for index, row in df_locality.iterrows():
+            print(f"{row['input']}: {row['jobs']} job(s) read {row['distinct']} distinct input(s), "
+                  f"{row['reuse_locality_order']} of them reuse the input of the previous job (instead of {row['reuse_site_order']} in the order of Sites.csv)!")
+        print("\033[92m" + "*" * 5 + "LOCALITY REPORT DONE" + "*" * 5 + "\033[0m")
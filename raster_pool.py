@@ -0,0 +1,158 @@
+import os
+import atexit
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+import rasterio as rio
+
+class RasterPool:
+
+    # Constuctor
+    def __init__(self, max_handles: int = 16):
+        '''
+        A bounded pool of open rasterio datasets, keyed by path, shared by all the stages and all the jobs of a process. A raster is
+        opened, and its header parsed, only the first time it is read; later reads reuse the open dataset, e.g. the JP2 bands of an
+        S2 image used by several sites or FLEX images. The least recently used datasets are closed when the pool is full, the ones
+        of modified files are opened again, and all of them are closed at the exit of the process.
+        Files written by a job must be opened with open_write, which first closes the pooled dataset of the same path.
+        The datasets are meant to be read by one thread at a time. A dataset from get is kept only for the time of a read; a dataset
+        used across other reads of the pool must be opened with the context manager open, which pins it so that it is never
+        evicted, the pool growing above its maximum for as long as needed.
+        Args:
+            max_handles (int): the maximum number of datasets kept open. Defaults to 16.
+        '''
+        self._handles = OrderedDict()
+        # Number of users of each pinned dataset
+        self._pins = {}
+        self._lock = threading.RLock()
+        self.max_handles = max_handles
+        self._num_opened = 0
+        self._num_reused = 0
+        self._num_evicted = 0
+        atexit.register(self.close_all)
+
+    # ------------------------------ Private Methods ----------------------------- #
+
+    # Modification time and size of a file, None for the GDAL virtual paths (e.g. inside a zip archive), which are not modified
+    @staticmethod
+    def __get_stamp(path: str):
+        try:
+            temp_stat = os.stat(path)
+        except OSError:
+            return None
+        return temp_stat.st_mtime_ns, temp_stat.st_size
+
+    # Close the least recently used datasets above the maximum, except the pinned ones and the most recently used, just returned
+    def __evict(self) -> None:
+        for path in [i for i in list(self._handles)[:-1] if i not in self._pins]:
+            if len(self._handles) <= self._max_handles:
+                break
+            self._handles.pop(path)[0].close()
+            self._num_evicted += 1
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def max_handles(self):
+        return self._max_handles
+    @max_handles.setter
+    def max_handles(self, value):
+        if not isinstance(value, int) or value < 1:
+            raise ValueError("The maximum number of open rasters must be an integer greater than 0!!!")
+        with self._lock:
+            self._max_handles = value
+            self.__evict()
+
+    @property
+    def num_open(self):
+        return len(self._handles)
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    def get(self, path: str) -> rio.io.DatasetReader:
+        '''
+        Get the open dataset of a raster, opening it only if it isn't in the pool or if the file has been modified since.
+        Don't close the dataset: the pool does.
+        Args:
+            path (str): the path to the raster, as for rio.open.
+        Returns:
+            rio.io.DatasetReader: the open dataset.
+        '''
+        temp_stamp = self.__get_stamp(path)
+        with self._lock:
+            if path in self._handles:
+                src, stamp = self._handles[path]
+                # A pinned dataset is kept even if the file has been modified, as it is still in use
+                if (stamp == temp_stamp or path in self._pins) and not src.closed:
+                    self._handles.move_to_end(path)
+                    self._num_reused += 1
+                    return src
+                del self._handles[path]
+                src.close()
+            src = rio.open(path)
+            self._handles[path] = (src, temp_stamp)
+            self._num_opened += 1
+            self.__evict()
+            return src
+
+    @contextmanager
+    def open(self, path: str):
+        '''
+        Get the open dataset of a raster as get does, pinned in the pool until the end of the with block, so that it stays open
+        whatever the other reads of the pool inside the block. To be used as "with pool.open(path) as src:".
+        Args:
+            path (str): the path to the raster, as for rio.open.
+        Yields:
+            rio.io.DatasetReader: the open dataset.
+        '''
+        with self._lock:
+            src = self.get(path)
+            self._pins[path] = self._pins.get(path, 0) + 1
+        try:
+            yield src
+        finally:
+            with self._lock:
+                self._pins[path] -= 1
+                if self._pins[path] == 0:
+                    del self._pins[path]
+                self.__evict()
+
+    def open_write(self, path: str, **profile) -> rio.io.DatasetWriter:
+        '''
+        Open a raster for writing, closing first the pooled dataset of the same path. To be used as rio.open(path, 'w', **profile).
+        '''
+        self.close(path)
+        return rio.open(path, 'w', **profile)
+
+    def close(self, path: str) -> None:
+        '''
+        Close the pooled dataset of a path, if any, e.g. before the file is overwritten or removed.
+        '''
+        with self._lock:
+            if path in self._handles:
+                self._handles.pop(path)[0].close()
+
+    def close_folder(self, path_folder: str) -> None:
+        '''
+        Close the pooled datasets of all the files inside a folder, e.g. before the folder is removed.
+        '''
+        temp_prefix = os.path.join(path_folder, '')
+        with self._lock:
+            for path in [i for i in self._handles if i.startswith(temp_prefix)]:
+                self._handles.pop(path)[0].close()
+
+    def close_all(self) -> None:
+        '''
+        Close all pooled datasets.
+        '''
+        with self._lock:
+            while self._handles:
+                self._handles.popitem()[1][0].close()
+
+    def stats(self) -> dict:
+        '''
+        Get the counts of the pool: 'open' (the datasets open now), 'max' (the maximum), 'opened' (the datasets opened so far),
+        'reused' (the reads served by an open dataset) and 'evicted' (the datasets closed because the pool was full).
+        '''
+        with self._lock:
+            return {'open': len(self._handles), 'max': self._max_handles, 'opened': self._num_opened, 'reused': self._num_reused,
+                    'evicted': self._num_evicted}
@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import sqlite3
+from typing import Optional
+from contextlib import closing
+import numpy as np
+import pandas as pd
+
+# Convert numpy scalars, which the json module can't serialize
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class ResultsStore:
+
+    # Constuctor
+    def __init__(self, path_db: str):
+        '''
+        A SQLite results store in WAL mode, shared by all the jobs of a run. Each job upserts its records keyed by
+        (table, site_code, flex_filename), together with the S2 image it used, so that concurrent writers and reruns never
+        duplicate rows, even when a rerun picks another S2 image, and each final table is produced by a single query.
+        Args:
+            path_db (str): path to the SQLite database file.
+        '''
+        self._path_db = path_db
+        self.__check_db()
+
+    # ------------------------------ Private Methods ----------------------------- #
+
+    # Create the database and its table if not exists
+    def __check_db(self):
+        if not os.path.exists(os.path.dirname(self._path_db)):
+            os.makedirs(os.path.dirname(self._path_db))
+        with closing(self.connect()) as conn, conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    table_name TEXT NOT NULL,
+                    site_code TEXT NOT NULL,
+                    flex_filename TEXT NOT NULL,
+                    s2_filename TEXT NOT NULL,
+                    record TEXT NOT NULL,
+                    PRIMARY KEY (table_name, site_code, flex_filename, s2_filename)
+                )''')
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def path_db(self):
+        return self._path_db
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    def connect(self) -> sqlite3.Connection:
+        '''
+        Open a new connection to the store. Every call opens its own connection, so the store can be used from several processes.
+        '''
+        conn = sqlite3.connect(self._path_db, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def upsert(self, table_name: str, site_code: str, flex_filename: str, s2_filename: str, record: dict) -> None:
+        '''
+        Insert the record of a job, or replace it if the job has already been saved, whatever the S2 image it used then.
+        Args:
+            table_name (str): the name of the table, e.g. "TF".
+            site_code (str): the name of the site.
+            flex_filename (str): the name of the FLEX image.
+            s2_filename (str): the name of the S2 image.
+            record (dict or list): the row to save, from column name to value, or a list of rows, e.g. one per FLEX pixel.
+        '''
+        with closing(self.connect()) as conn, conn:
+            # The rows of an earlier run of the job with another S2 image are replaced too, in the same transaction
+            conn.execute('''
+                DELETE FROM results WHERE table_name = ? AND site_code = ? AND flex_filename = ? AND s2_filename != ?''',
+                (table_name, str(site_code), str(flex_filename), str(s2_filename)))
+            conn.execute('''
+                INSERT INTO results (table_name, site_code, flex_filename, s2_filename, record) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (table_name, site_code, flex_filename, s2_filename) DO UPDATE SET record = excluded.record''',
+                (table_name, str(site_code), str(flex_filename), str(s2_filename), json.dumps(record, default=_to_json)))
+
+    def delete_job(self, site_code: str, flex_filename: str) -> None:
+        '''
+        Delete the records of a job from all tables, e.g. the ones of an earlier run before the job is run again.
+        Args:
+            site_code (str): the name of the site.
+            flex_filename (str): the name of the FLEX image.
+        '''
+        with closing(self.connect()) as conn, conn:
+            conn.execute('DELETE FROM results WHERE site_code = ? AND flex_filename = ?', (str(site_code), str(flex_filename)))
+
+    def read_table(self, table_name: str, jobs: Optional[list] = None) -> pd.DataFrame:
+        '''
+        Read all records of a table with a single query.
+        Args:
+            table_name (str): the name of the table, e.g. "TF".
+            jobs (list): the (site_code, flex_filename) pairs of the jobs to read, e.g. the ones of the current plan. All jobs by default.
+        Returns:
+            pd.DataFrame: one row per job, or per row of the jobs saved as lists of rows, ordered by site_code, flex_filename and s2_filename.
+            Empty if there is no record.
+        '''
+        with closing(self.connect()) as conn:
+            if jobs is None:
+                rows = conn.execute('''
+                    SELECT record FROM results WHERE table_name = ? ORDER BY site_code, flex_filename, s2_filename''', (table_name,)).fetchall()
+            else:
+                # The pairs are joined from a temporary table, whatever their number
+                conn.execute('CREATE TEMP TABLE jobs (site_code TEXT NOT NULL, flex_filename TEXT NOT NULL)')
+                conn.executemany('INSERT INTO jobs VALUES (?, ?)', {(str(site_code), str(flex_filename)) for site_code, flex_filename in jobs})
+                rows = conn.execute('''
+                    SELECT r.record FROM results r JOIN jobs j ON r.site_code = j.site_code AND r.flex_filename = j.flex_filename
+                    WHERE r.table_name = ? ORDER BY r.site_code, r.flex_filename, r.s2_filename''', (table_name,)).fetchall()
+        list_rows = []
+        for row in rows:
+            temp_record = json.loads(row[0])
+            list_rows.extend(temp_record if isinstance(temp_record, list) else [temp_record])
+        return pd.DataFrame(list_rows)
+
+class JobJournal:
+
+    # Constuctor
+    def __init__(self, path_db: str, max_attempts: int = 3):
+        '''
+        A write-ahead journal of the jobs of a run, kept in the same SQLite database as the results store. Each job, i.e. a FLEX image
+        of a site, is marked "running" before any work starts and "done", "skipped" (missing or unusable inputs) or "failed" when it
+        ends, together with the S2 scene it used and its row of the log report. A run restarted after an interruption skips the jobs
+        already done, runs the skipped ones again, retries the failed or interrupted ones up to max_attempts times and rebuilds the
+        final reports from the journal and the results store. The journal only covers an interrupted run: it is cleared when a run
+        finishes, so that a new run never reuses the outcome of a run with other inputs or settings.
+        Args:
+            path_db (str): path to the SQLite database file.
+            max_attempts (int): the maximum number of attempts of a job. Defaults to 3.
+        '''
+        self._path_db = path_db
+        self._max_attempts = max_attempts
+        self.__check_db()
+
+    # ------------------------------ Private Methods ----------------------------- #
+
+    # Create the database and its table if not exists
+    def __check_db(self):
+        if not os.path.exists(os.path.dirname(self._path_db)):
+            os.makedirs(os.path.dirname(self._path_db))
+        with closing(self.connect()) as conn, conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    site_code TEXT NOT NULL,
+                    flex_filename TEXT NOT NULL,
+                    s2_filename TEXT,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    record TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (site_code, flex_filename)
+                )''')
+
+    # Save the outcome of a job
+    def __end_job(self, site_code, flex_filename, state, s2_filename, error, record):
+        with closing(self.connect()) as conn, conn:
+            conn.execute('''
+                UPDATE jobs SET state = ?, attempts = CASE WHEN ? = 'skipped' THEN 0 ELSE attempts END, s2_filename = ?, error = ?, record = ?,
+                updated = ? WHERE site_code = ? AND flex_filename = ?''',
+                (state, state, None if s2_filename is None else str(s2_filename), error, json.dumps(record, default=_to_json),
+                 time.time(), str(site_code), str(flex_filename)))
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def path_db(self):
+        return self._path_db
+
+    @property
+    def max_attempts(self):
+        return self._max_attempts
+    @max_attempts.setter
+    def max_attempts(self, value):
+        if isinstance(value, int) and value > 0:
+            self._max_attempts = value
+        else:
+            raise ValueError("!!!The maximum number of attempts must be a positive integer!!!")
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    def connect(self) -> sqlite3.Connection:
+        '''
+        Open a new connection to the journal. Every call opens its own connection, so the journal can be used from several processes.
+        '''
+        conn = sqlite3.connect(self._path_db, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get_job(self, site_code: str, flex_filename: str) -> Optional[dict]:
+        '''
+        Read the entry of a job.
+        Args:
+            site_code (str): the name of the site.
+            flex_filename (str): the name of the FLEX image.
+        Returns:
+            dict: the state, attempts, S2 scene, error and log record of the job, or None if the job has never started.
+        '''
+        with closing(self.connect()) as conn:
+            row = conn.execute('''
+                SELECT state, attempts, s2_filename, error, record FROM jobs WHERE site_code = ? AND flex_filename = ?''',
+                (str(site_code), str(flex_filename))).fetchone()
+        if row is None:
+            return None
+        return {'state': row[0], 'attempts': row[1], 's2_filename': row[2], 'error': row[3],
+                'record': json.loads(row[4]) if row[4] is not None else None}
+
+    def should_run(self, site_code: str, flex_filename: str) -> bool:
+        '''
+        Check if a job has to be (re)processed: it has never started, it was skipped for missing inputs, or it failed or was interrupted
+        with attempts left.
+        '''
+        job = self.get_job(site_code, flex_filename)
+        if job is None or job['state'] == 'skipped':
+            return True
+        if job['state'] == 'done':
+            return False
+        return job['attempts'] < self._max_attempts
+
+    def start_job(self, site_code: str, flex_filename: str) -> int:
+        '''
+        Mark a job as running before any work starts, and count the attempt.
+        Returns:
+            int: the number of the current attempt.
+        '''
+        with closing(self.connect()) as conn, conn:
+            conn.execute('''
+                INSERT INTO jobs (site_code, flex_filename, state, attempts, updated) VALUES (?, ?, 'running', 1, ?)
+                ON CONFLICT (site_code, flex_filename) DO UPDATE SET state = 'running', attempts = attempts + 1, error = NULL, updated = excluded.updated''',
+                (str(site_code), str(flex_filename), time.time()))
+            return conn.execute('SELECT attempts FROM jobs WHERE site_code = ? AND flex_filename = ?',
+                                (str(site_code), str(flex_filename))).fetchone()[0]
+
+    def finish_job(self, site_code: str, flex_filename: str, s2_filename: str, record: dict) -> None:
+        '''
+        Mark a job as done, together with the S2 scene it used and its row of the log report.
+        '''
+        self.__end_job(site_code, flex_filename, 'done', s2_filename, None, record)
+
+    def skip_job(self, site_code: str, flex_filename: str, s2_filename: str, record: dict) -> None:
+        '''
+        Mark a job as skipped for missing or unusable inputs, together with its row of the log report. Skipped jobs are always run again,
+        and a skip doesn't count as an attempt.
+        '''
+        self.__end_job(site_code, flex_filename, 'skipped', s2_filename, None, record)
+
+    def fail_job(self, site_code: str, flex_filename: str, error: str, record: dict) -> None:
+        '''
+        Mark a job as failed, together with the error and its row of the log report.
+        '''
+        self.__end_job(site_code, flex_filename, 'failed', None, error, record)
+
+    def read_journal(self) -> pd.DataFrame:
+        '''
+        Read all the jobs of the journal, ordered by site_code and flex_filename.
+        '''
+        with closing(self.connect()) as conn:
+            return pd.read_sql_query('''
+                SELECT site_code, flex_filename, s2_filename, state, attempts, error FROM jobs ORDER BY site_code, flex_filename''', conn)
+
+    def clear(self) -> None:
+        '''
+        Remove all the jobs from the journal, so that the next run starts from scratch.
+        '''
+        with closing(self.connect()) as conn, conn:
+            conn.execute('DELETE FROM jobs')
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import shapely as shp
+import rasterio as rio
+import rasterio.warp
+
+class SiteIndex:
+
+    # Length of one degree of latitude, in m
+    _METERS_PER_DEGREE = 111320
+
+    # Constuctor
+    def __init__(self, df_site: pd.DataFrame, flex_resolution: int = 300):
+        '''
+        Spatial index (STRtree) of the sites of Sites.csv, over both their points and their ROI boxes. It answers in bulk which sites
+        fall in a set of footprints, e.g. S2 tiles or FLEX scenes, so that large catalogs of sites can be joined against the
+        products without testing every site against every product.
+        The ROI box of a site is the largest box its ROI can cover once snapped to the FLEX grid, i.e. half the reference area plus
+        half a FLEX pixel on each side of the site, in degrees (EPSG:4326).
+        Args:
+            df_site (pd.DataFrame): the info of all sites, from CalVal.get_site_info.
+            flex_resolution (int): the resolution of the FLEX images in m. Defaults to 300.
+        '''
+        self._site_codes = df_site['Sites'].astype(str).to_numpy()
+        temp_lat = df_site['Latitude'].to_numpy(dtype=float)
+        temp_lon = df_site['Longitude'].to_numpy(dtype=float)
+        temp_half_lat = (df_site['ROI'].to_numpy(dtype=float) + flex_resolution) / 2 / self._METERS_PER_DEGREE
+        temp_half_lon = temp_half_lat / np.cos(np.radians(temp_lat))
+        self._points = shp.points(temp_lon, temp_lat)
+        self._boxes = shp.box(temp_lon - temp_half_lon, temp_lat - temp_half_lat, temp_lon + temp_half_lon, temp_lat + temp_half_lat)
+        self._tree_points = shp.STRtree(self._points)
+        self._tree_boxes = shp.STRtree(self._boxes)
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def site_codes(self):
+        return self._site_codes
+
+    @property
+    def points(self):
+        return self._points
+
+    @property
+    def boxes(self):
+        return self._boxes
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    def query(self, footprints, predicate: str = 'intersects', geometry: str = 'roi') -> pd.DataFrame:
+        '''
+        Find the sites falling in each footprint, all footprints at once.
+        Args:
+            footprints: a shapely geometry, a list of them or a dict from a name to a geometry, in EPSG:4326.
+            predicate (str): the shapely predicate tested as predicate(footprint, site), e.g. 'intersects' or 'contains'. Defaults to 'intersects'.
+            geometry (str): 'roi' to test the ROI boxes of the sites, 'site' to test their points. Defaults to 'roi'.
+        Returns:
+            pd.DataFrame: one row per match, with the footprint (its name, or its position in the list) and the site_code.
+        '''
+        if geometry not in ['roi', 'site']:
+            raise ValueError("The geometry can only be 'roi' or 'site'!")
+        if isinstance(footprints, dict):
+            list_names = list(footprints.keys())
+            footprints = list(footprints.values())
+        else:
+            footprints = [footprints] if isinstance(footprints, shp.Geometry) else list(footprints)
+            list_names = list(range(len(footprints)))
+        temp_tree = self._tree_boxes if geometry == 'roi' else self._tree_points
+        index_footprints, index_sites = temp_tree.query(np.asarray(footprints, dtype=object), predicate=predicate)
+        return pd.DataFrame({'footprint': np.asarray(list_names, dtype=object)[index_footprints],
+                             'site_code': self._site_codes[index_sites]})
+
+    @staticmethod
+    def get_raster_footprint(path_raster: str) -> shp.Geometry:
+        '''
+        Get the footprint of a raster, e.g. a band of an S2 tile, in EPSG:4326. Only the header of the raster is read.
+        '''
+        with rio.open(path_raster) as src:
+            temp_bounds = src.bounds
+            temp_crs = src.crs
+        # Densify the edges, so that they follow the curvature of the projection
+        temp_box = shp.segmentize(shp.box(*temp_bounds), max(temp_bounds.right - temp_bounds.left, temp_bounds.top - temp_bounds.bottom) / 20)
+        temp_geom = rio.warp.transform_geom(temp_crs, 'EPSG:4326', shp.geometry.mapping(temp_box))
+        return shp.geometry.shape(temp_geom)
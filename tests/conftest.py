@@ -0,0 +1,112 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rio
+import xarray as xr
+from pyproj import Transformer
+from rasterio.transform import from_origin
+
+# The modules of the prototype are flat files in the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from class_calval import FLEX, S2
+
+SITE_CODE = "IT-JDS"
+SITE_LAT = 44.874305
+SITE_LON = 11.979201
+FLEX_FILENAME = "PRS_TD_20220717_093225.nc"
+SAFE_NAME = "S2A_MSIL2A_20220718T100611_N0510_R022_T32TQQ_20240717T130024.SAFE"
+GRANULE = os.path.join("GRANULE", "L2A_T32TQQ_A000001_20220718T100611")
+MTD_DS = ('<?xml version="1.0"?><root><BOA_QUANTIFICATION_VALUE unit="none">10000</BOA_QUANTIFICATION_VALUE>'
+          '<BOA_ADD_OFFSET band_id="3">-1000</BOA_ADD_OFFSET><BOA_ADD_OFFSET band_id="7">-1000</BOA_ADD_OFFSET></root>')
+MTD_TL = '<?xml version="1.0"?><root><HORIZONTAL_CS_CODE>EPSG:32632</HORIZONTAL_CS_CODE></root>'
+SIF_COLUMNS = ["SIF_FARRED_max", "SIF_FARRED_max_wvl", "SIF_RED_max", "SIF_RED_max_wvl", "SIF_O2B", "SIF_O2A", "SIF_int"]
+# The S2 tile: 600 x 600 pixels of 10 m in EPSG:32632, centred on the site and aligned to the 60 m grid of the mask, in JP2 blocks of
+# 256 x 256 pixels, so that the strip processing reads several strips
+TILE_SIZE = 600
+BLOCK_SIZE = 256
+
+
+def write_safe(path_safe: str, seed: int = 0) -> dict:
+    '''
+    Write a small S2 L2A product: the JP2 bands B04 and B08, the mask MSK_CLASSI_B00 with one cloudy 60 m cell near the site,
+    and the metadata of the datastrip and of the tile. Returns the values of the bands, from the band name to its array.
+    '''
+    rng = np.random.default_rng(seed)
+    temp_x, temp_y = Transformer.from_crs("EPSG:4326", "EPSG:32632", always_xy=True).transform(SITE_LON, SITE_LAT)
+    temp_x0, temp_y0 = round(temp_x / 60) * 60 - TILE_SIZE * 5, round(temp_y / 60) * 60 + TILE_SIZE * 5
+    values_mask = np.zeros((3, TILE_SIZE // 6, TILE_SIZE // 6), dtype=np.uint8)
+    values_mask[0, TILE_SIZE // 12 - 3, TILE_SIZE // 12 + 2] = 1
+    dict_values = {'B04': rng.integers(1300, 1700, (TILE_SIZE, TILE_SIZE)).astype(np.uint16),
+                   'B08': rng.integers(3500, 5500, (TILE_SIZE, TILE_SIZE)).astype(np.uint16),
+                   'MSK_CLASSI_B00': values_mask}
+    path_granule = os.path.join(path_safe, GRANULE)
+    dict_paths = {'B04': os.path.join(path_granule, "IMG_DATA", "R10m", "T32TQQ_20220718T100611_B04_10m.jp2"),
+                  'B08': os.path.join(path_granule, "IMG_DATA", "R10m", "T32TQQ_20220718T100611_B08_10m.jp2"),
+                  'MSK_CLASSI_B00': os.path.join(path_granule, "QI_DATA", "MSK_CLASSI_B00.jp2")}
+    for band, values in dict_values.items():
+        os.makedirs(os.path.dirname(dict_paths[band]), exist_ok=True)
+        temp_res = 60 if band == 'MSK_CLASSI_B00' else 10
+        values = values if values.ndim > 2 else values[np.newaxis]
+        with rio.open(dict_paths[band], "w", driver="JP2OpenJPEG", width=values.shape[2], height=values.shape[1], count=values.shape[0],
+                      dtype=values.dtype, crs="EPSG:32632", transform=from_origin(temp_x0, temp_y0, temp_res, temp_res),
+                      blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE) as dest:
+            dest.write(values)
+    os.makedirs(os.path.join(path_safe, "DATASTRIP", "DS_X"))
+    with open(os.path.join(path_safe, "DATASTRIP", "DS_X", "MTD_DS.xml"), "w") as f:
+        f.write(MTD_DS)
+    with open(os.path.join(path_granule, "MTD_TL.xml"), "w") as f:
+        f.write(MTD_TL)
+    return dict_values
+
+
+@pytest.fixture
+def workspace(tmp_path) -> str:
+    '''
+    A work directory with one site: the sites and FLOX tables, one FLEX image of 300 m pixels and one S2 L2A product.
+    '''
+    path_main = str(tmp_path)
+    os.makedirs(os.path.join(path_main, "input"))
+    pd.DataFrame({'site_code': [SITE_CODE], 'latitude': [SITE_LAT], 'longitude': [SITE_LON], 'reference_area(m)': [900],
+                  'time_window(days)': [15], 'threshold_cloud(%)': [50], 'threshold_CV(%)': [20], 'vegetation_pixel(%)': [50]
+                  }).to_csv(os.path.join(path_main, "input", "sites.csv"), index=False)
+    rng = np.random.default_rng(1)
+    dict_flox = {'ID_SITE': [SITE_CODE], 'LONGITUDE': [SITE_LON], 'LATITUDE': [SITE_LAT], 'UTC_datetime': ["17/07/2022 09:32"]}
+    for column in SIF_COLUMNS:
+        dict_flox[column] = rng.uniform(0.1, 1.5, 1)
+        dict_flox[column + '_un'] = rng.uniform(0.01, 0.1, 1)
+    pd.DataFrame(dict_flox).to_csv(os.path.join(path_main, "input", "flox_sifparms_filt_flextime_aggr_avg_allsites.csv"), sep=";", index=False)
+    # An 11 x 11 grid of 300 m pixels centred on the site
+    temp_dlat = 300 / 111320.0
+    temp_dlon = 300 / (111320.0 * np.cos(np.radians(SITE_LAT)))
+    latitudes = SITE_LAT + temp_dlat * np.arange(5, -6, -1)
+    longitudes = SITE_LON + temp_dlon * np.arange(-5, 6)
+    ds = xr.Dataset({column: (("latitude", "longitude"), rng.uniform(0.1, 1.5, (11, 11))) for column in SIF_COLUMNS},
+                    coords={'latitude': latitudes, 'longitude': longitudes})
+    os.makedirs(os.path.join(path_main, "input_flex_images", SITE_CODE))
+    ds.to_netcdf(os.path.join(path_main, "input_flex_images", SITE_CODE, FLEX_FILENAME))
+    write_safe(os.path.join(path_main, "input_s2_images", SITE_CODE, SAFE_NAME))
+    return path_main
+
+
+@pytest.fixture
+def flex(workspace) -> FLEX:
+    return FLEX(workspace)
+
+
+@pytest.fixture
+def new_s2(workspace):
+    '''
+    Build the S2 object of a job of the site and of the FLEX image of the work directory, as Main.py does, with the given settings.
+    '''
+    def make(s2_l2a_name: str = SAFE_NAME, **settings) -> S2:
+        s2 = S2(SITE_CODE, SITE_LAT, SITE_LON, s2_l2a_name, path_main=workspace)
+        s2.flex_filename = FLEX_FILENAME
+        for key, value in settings.items():
+            setattr(s2, key, value)
+        s2.create_cache_subfolder(SITE_CODE)
+        return s2
+    return make
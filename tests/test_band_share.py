@@ -0,0 +1,65 @@
+import os
+from contextlib import closing
+
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.windows import Window
+
+from band_share import BandShare
+
+PRODUCT_ID = "S2A_MSIL2A_20220718T100611_N0510_R022_T32TQQ_20240717T130024"
+
+
+@pytest.fixture
+def bands(new_s2):
+    # The band files of the S2 product of the work directory, and their values
+    s2 = new_s2()
+    dict_paths = {'B04': s2.path_l2a_b04, 'B08': s2.path_l2a_b08, 'MSK_CLASSI_B00': s2.path_l2a_mask}
+    dict_values = {}
+    for band, path in dict_paths.items():
+        with rio.open(path) as src:
+            dict_values[band] = src.read() if src.count > 1 else src.read(1)
+    return s2, dict_paths, dict_values
+
+
+def test_only_the_registered_window_is_decoded(tmp_path, bands):
+    s2, dict_paths, dict_values = bands
+    band_share = BandShare(os.path.join(str(tmp_path), "cache"), os.path.join(str(tmp_path), "cache", "results.sqlite"))
+    window = Window(24, 36, 48, 60)
+    band_share.register(PRODUCT_ID, 1, window)
+    dict_shared = band_share.attach(PRODUCT_ID, dict_paths)
+    np.testing.assert_array_equal(dict_shared['B04'], dict_values['B04'][36:96, 24:72])
+    np.testing.assert_array_equal(dict_shared['MSK_CLASSI_B00'], dict_values['MSK_CLASSI_B00'][:, 6:16, 4:12])
+    del dict_shared
+    band_share.release(PRODUCT_ID)
+    assert not os.path.exists(os.path.join(band_share.path_share, PRODUCT_ID))
+
+
+def test_read_band_inside_and_outside_the_shared_window(tmp_path, bands):
+    s2, dict_paths, dict_values = bands
+    band_share = BandShare(os.path.join(str(tmp_path), "cache"), os.path.join(str(tmp_path), "cache", "results.sqlite"))
+    window = Window(24, 36, 48, 60)
+    band_share.register(PRODUCT_ID, 1, window)
+    s2.shared_bands = band_share.attach(PRODUCT_ID, dict_paths)
+    s2.shared_window = window
+    # Windows on the grid of the band, inside the shared window
+    np.testing.assert_array_equal(s2.read_band('B04', Window(30, 40, 10, 12)), dict_values['B04'][40:52, 30:40])
+    np.testing.assert_array_equal(s2.read_band('MSK_CLASSI_B00', Window(5, 7, 3, 4)), dict_values['MSK_CLASSI_B00'][:, 7:11, 5:8])
+    # The window of the tile, and a window outside the shared one, read from the band file
+    np.testing.assert_array_equal(s2.read_band('B04'), dict_values['B04'][36:96, 24:72])
+    np.testing.assert_array_equal(s2.read_band('B04', Window(0, 0, 30, 30)), dict_values['B04'][:30, :30])
+
+
+def test_clean_removes_the_shares_not_in_the_plan(tmp_path, bands):
+    s2, dict_paths, dict_values = bands
+    path_cache = os.path.join(str(tmp_path), "cache")
+    band_share = BandShare(path_cache, os.path.join(path_cache, "results.sqlite"))
+    band_share.register(PRODUCT_ID, 2, Window(0, 0, 60, 60))
+    band_share.attach(PRODUCT_ID, dict_paths)
+    # An interrupted run left its shares, and a new run doesn't use the product any more
+    band_share = BandShare(path_cache, os.path.join(path_cache, "results.sqlite"))
+    band_share.clean(["S2B_MSIL2A_20220720T100559_N0510_R022_T32TQQ_20240720T120000"])
+    assert os.listdir(band_share.path_share) == []
+    with closing(band_share.connect()) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM band_shares').fetchone()[0] == 0
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+
+def test_cv_flags_are_the_same_in_float32_and_float64(new_s2):
+    dict_32 = new_s2(precision="float32").cal_roi_indices()
+    dict_64 = new_s2(precision="float64").cal_roi_indices()
+    assert dict_32['valid_pixels'] == dict_64['valid_pixels']
+    for index_name in ['ndvi', 'nirv', 'tf2']:
+        assert dict_32[index_name]['n'] == dict_64[index_name]['n']
+        np.testing.assert_allclose(dict_32[index_name]['avg'], dict_64[index_name]['avg'], rtol=1e-6)
+        np.testing.assert_allclose(dict_32[index_name]['cv'], dict_64[index_name]['cv'], rtol=1e-5)
+
+
+@pytest.mark.parametrize('index_name', ['ndvi', 'nirv'])
+@pytest.mark.parametrize('margin', [-1e-4, -1e-5, 1e-5, 1e-4])
+def test_cv_flags_near_the_threshold(new_s2, index_name, margin):
+    s2_32 = new_s2(precision="float32")
+    s2_64 = new_s2(precision="float64")
+    temp_cv_64 = s2_64.cal_roi_indices()[index_name]['cv']
+    temp_cv_32 = s2_32.cal_roi_indices()[index_name]['cv']
+    # Thresholds just above and just below the CV of the ROI
+    s2_32.threshold_cv = s2_64.threshold_cv = temp_cv_64 * (1 + margin)
+    assert s2_32.cal_flag(temp_cv_32) == s2_64.cal_flag(temp_cv_64) == int(margin > 0)
+
+
+# The strip processing with a budget of a single strip of JP2 blocks, i.e. three strips of the tile, the last one shorter
+@pytest.mark.parametrize('settings', [{}, {'bool_strip_processing': True, 'memory_budget': 0.05}], ids=['tile', 'strips'])
+def test_cv_flags_of_the_jobs_are_the_same_in_float32_and_float64(new_s2, settings):
+    # The path of the jobs: the mask, the ROI rasters of the indices written by create_clipping_raster, then their statistics
+    dict_results = {}
+    for precision in ["float32", "float64"]:
+        s2 = new_s2(precision=precision, **settings)
+        s2.cal_valid_pixels()
+        dict_results[precision] = s2.cal_l2a_indices()
+    # (std, avg, cv, flag) of the NDVI, then of the NIRvREF
+    for k in range(0, 8, 4):
+        np.testing.assert_allclose(dict_results["float32"][k:k + 3], dict_results["float64"][k:k + 3], rtol=1e-5)
+        assert dict_results["float32"][k + 3] == dict_results["float64"][k + 3]
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+
+from raster_pool import RasterPool
+
+
+@pytest.fixture
+def rasters(tmp_path):
+    # Three small rasters, each filled with its own index
+    list_paths = []
+    for i in range(3):
+        list_paths.append(os.path.join(str(tmp_path), f"band_{i}.tif"))
+        with rio.open(list_paths[-1], "w", driver="GTiff", width=8, height=8, count=1, dtype="uint16", crs="EPSG:32632",
+                      transform=from_origin(600000, 5000000, 10, 10)) as dest:
+            dest.write(np.full((1, 8, 8), i, dtype=np.uint16))
+    return list_paths
+
+
+def test_get_evicts_the_least_recently_used(rasters):
+    pool = RasterPool(max_handles=1)
+    src = pool.get(rasters[0])
+    pool.get(rasters[1])
+    assert src.closed
+    assert pool.stats()['evicted'] == 1
+    assert pool.num_open == 1
+    pool.close_all()
+
+
+def test_pinned_dataset_is_never_evicted(rasters):
+    pool = RasterPool(max_handles=1)
+    with pool.open(rasters[0]) as src:
+        # Other reads of the pool, as read_band does while a caller holds a dataset
+        for path in rasters[1:] * 2:
+            assert pool.get(path).read(1)[0, 0] == rasters.index(path)
+        assert not src.closed
+        assert src.read(1)[0, 0] == 0
+        # Pinned twice, still open after the inner block
+        with pool.open(rasters[0]) as src_inner:
+            assert src_inner is src
+        pool.get(rasters[1])
+        assert not src.closed
+    # Evicted back to the maximum once unpinned
+    assert pool.num_open == 1
+    assert src.closed
+    pool.close_all()
+
+
+def test_max_handles_must_be_positive():
+    pool = RasterPool()
+    with pytest.raises(ValueError):
+        pool.max_handles = 0
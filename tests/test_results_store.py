@@ -0,0 +1,33 @@
+import os
+
+from results_store import ResultsStore
+
+
+def test_rerun_with_another_s2_image_replaces_the_job(tmp_path):
+    results_store = ResultsStore(os.path.join(str(tmp_path), "results.sqlite"))
+    results_store.upsert('TF', 'IT-JDS', 'FLEX_20220717.nc', 'S2A_MSIL2A_20220716', {'s2_filename': 'S2A_MSIL2A_20220716'})
+    results_store.upsert('TF', 'IT-JDS', 'FLEX_20220718.nc', 'S2A_MSIL2A_20220716', {'s2_filename': 'S2A_MSIL2A_20220716'})
+    results_store.upsert('TF', 'IT-JDS', 'FLEX_20220717.nc', 'S2B_MSIL2A_20220718', {'s2_filename': 'S2B_MSIL2A_20220718'})
+    df_tf = results_store.read_table('TF')
+    assert len(df_tf) == 2
+    assert sorted(df_tf['s2_filename']) == ['S2A_MSIL2A_20220716', 'S2B_MSIL2A_20220718']
+
+
+def test_only_the_jobs_of_the_plan_are_read(tmp_path):
+    results_store = ResultsStore(os.path.join(str(tmp_path), "results.sqlite"))
+    for site_code, flex_filename in [('IT-JDS', 'FLEX_20220717.nc'), ('IT-JDS', 'FLEX_20220718.nc'), ('IT-OLD', 'FLEX_20220717.nc')]:
+        results_store.upsert('TF', site_code, flex_filename, 'S2A_MSIL2A_20220716', {'site_code': site_code, 'flex_filename': flex_filename})
+    df_tf = results_store.read_table('TF', [('IT-JDS', 'FLEX_20220718.nc'), ('IT-JDS', 'FLEX_20220717.nc'), ('IT-NEW', 'FLEX_20220717.nc')])
+    assert list(zip(df_tf['site_code'], df_tf['flex_filename'])) == [('IT-JDS', 'FLEX_20220717.nc'), ('IT-JDS', 'FLEX_20220718.nc')]
+    assert results_store.read_table('TF', []).empty
+    assert len(results_store.read_table('TF')) == 3
+
+
+def test_delete_job_removes_its_records_from_all_tables(tmp_path):
+    results_store = ResultsStore(os.path.join(str(tmp_path), "results.sqlite"))
+    for table_name in ['TF', 'FLEX_avg']:
+        for flex_filename in ['FLEX_20220717.nc', 'FLEX_20220718.nc']:
+            results_store.upsert(table_name, 'IT-JDS', flex_filename, 'S2A_MSIL2A_20220716', {'flex_filename': flex_filename})
+    results_store.delete_job('IT-JDS', 'FLEX_20220717.nc')
+    for table_name in ['TF', 'FLEX_avg']:
+        assert list(results_store.read_table(table_name)['flex_filename']) == ['FLEX_20220718.nc']
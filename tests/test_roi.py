@@ -0,0 +1,20 @@
+import os
+
+import numpy as np
+
+from conftest import SITE_CODE
+
+
+def test_the_roi_is_built_in_memory(new_s2):
+    s2 = new_s2()
+    zonal_stats = s2.get_zonal_stats()
+    geom, geom_utm = s2.get_roi_geometry()
+    np.testing.assert_allclose(zonal_stats.weights.sum() * 100, geom_utm.area, rtol=1e-6)
+    assert not [i for i in os.listdir(os.path.join(s2.path_cache, SITE_CODE)) if i.startswith("roi_")]
+
+
+def test_the_roi_shapefiles_are_exported_for_debugging(new_s2):
+    s2 = new_s2(bool_export_roi=True)
+    s2.get_zonal_stats()
+    for name in ["roi_4326.shp", "roi_utm.shp"]:
+        assert os.path.exists(os.path.join(s2.path_cache, SITE_CODE, name))
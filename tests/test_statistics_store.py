@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from class_calval import FLEX
+
+COLUMN_PAIRS = FLEX._COLUMN_PAIRS_TF
+
+
+def make_matchup(num_rows: int = 12, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df_merge = pd.DataFrame({
+        'site_code': [f"IT-{k % 3}" for k in range(num_rows)],
+        'date': [f"202207{k % 4 + 10}" for k in range(num_rows)],
+    })
+    for pair in COLUMN_PAIRS:
+        df_merge[pair[0]] = rng.normal(1.0, 0.3, num_rows)
+        df_merge[pair[1]] = df_merge[pair[0]] + rng.normal(0.0, 0.1, num_rows)
+    df_merge.loc[3, COLUMN_PAIRS[1][1]] = np.nan
+    return df_merge
+
+
+def full_report(flex: FLEX, df_merge: pd.DataFrame) -> pd.DataFrame:
+    df_stats = flex.cal_sufficient_statistics(df_merge, COLUMN_PAIRS, ['site_code', 'date'])
+    return flex.create_validation_report(df_stats)
+
+
+def incremental_report(flex: FLEX, df_merge: pd.DataFrame) -> pd.DataFrame:
+    return flex.create_validation_report(flex.update_statistics_store(df_merge, COLUMN_PAIRS, "L2B_1P_TF_validation"))
+
+
+def test_incremental_report_matches_full_recompute_after_a_row_changes(flex):
+    df_merge = make_matchup()
+    pd.testing.assert_frame_equal(incremental_report(flex, df_merge), full_report(flex, df_merge))
+    df_merge.loc[5, COLUMN_PAIRS[0][1]] += 0.5
+    pd.testing.assert_frame_equal(incremental_report(flex, df_merge), full_report(flex, df_merge))
+
+
+def test_incremental_report_matches_full_recompute_after_a_row_is_removed(flex):
+    df_merge = make_matchup()
+    incremental_report(flex, df_merge)
+    df_merge = df_merge.drop(index=7).reset_index(drop=True)
+    pd.testing.assert_frame_equal(incremental_report(flex, df_merge), full_report(flex, df_merge))
+
+
+def test_sites_and_dates_no_longer_in_the_matchup_are_deleted(flex):
+    df_merge = make_matchup()
+    incremental_report(flex, df_merge)
+    df_merge = df_merge[df_merge['site_code'] != 'IT-2'].reset_index(drop=True)
+    df_store = flex.update_statistics_store(df_merge, COLUMN_PAIRS, "L2B_1P_TF_validation")
+    assert 'IT-2' not in set(df_store['site_code'])
+    pd.testing.assert_frame_equal(flex.create_validation_report(df_store), full_report(flex, df_merge))
+
+
+def test_unchanged_partials_are_not_calculated_again(flex, monkeypatch):
+    df_merge = make_matchup()
+    incremental_report(flex, df_merge)
+    list_num_rows = []
+    cal_sufficient_statistics = FLEX.cal_sufficient_statistics
+    def spy(self, df, column_pairs, keys=None):
+        list_num_rows.append(len(df))
+        return cal_sufficient_statistics(self, df, column_pairs, keys)
+    monkeypatch.setattr(FLEX, 'cal_sufficient_statistics', spy)
+    df_merge.loc[0, COLUMN_PAIRS[2][0]] = 2.0
+    incremental_report(flex, df_merge)
+    # Only the rows of the site and date of the changed row
+    temp_mask = (df_merge['site_code'] == df_merge.loc[0, 'site_code']) & (df_merge['date'] == df_merge.loc[0, 'date'])
+    assert list_num_rows == [temp_mask.sum()]
+
+
+def test_bootstrap_report_metrics_come_from_the_resampled_rows(flex):
+    flex.num_bootstrap = 200
+    flex.confidence_level = 0.9
+    flex.random_seed = 0
+    df_merge = make_matchup()
+    # A report of other rows, whose metrics must be replaced by the ones of the resampled rows
+    df_output = full_report(flex, make_matchup(seed=1))
+    df_output = flex.add_bootstrap_intervals(df_output, df_merge, COLUMN_PAIRS)
+    df_expected = full_report(flex, df_merge)
+    for pair in COLUMN_PAIRS:
+        var_name = pair[1].removesuffix('_flex')
+        np.testing.assert_allclose(df_output[var_name], df_expected[var_name])
+        assert (df_output[var_name + '_ci_low'] <= df_output[var_name + '_ci_high']).all()
+
+
+@pytest.mark.parametrize('num_rows', [0, 1])
+def test_bootstrap_intervals_of_less_than_two_rows_are_nan(flex, num_rows):
+    flex.random_seed = 0
+    df_merge = make_matchup().iloc[:num_rows]
+    df_output = flex.add_bootstrap_intervals(full_report(flex, make_matchup()), df_merge, COLUMN_PAIRS)
+    for pair in COLUMN_PAIRS:
+        var_name = pair[1].removesuffix('_flex')
+        assert df_output[var_name + '_ci_low'].isna().all()
+        assert df_output[var_name + '_ci_high'].isna().all()
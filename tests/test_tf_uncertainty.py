@@ -0,0 +1,92 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rio
+
+from class_calval import S2
+from conftest import FLEX_FILENAME, SITE_CODE
+
+FLEX_DATE = FLEX_FILENAME.split('_')[2]
+TF_VARS = {'TF1': ['SIF_O2A', 'SIF_FARRED_max', 'SIF_int'], 'TF2': ['SIF_O2B', 'SIF_RED_max']}
+
+
+def run_transfer_function(s2: S2) -> dict:
+    s2.cal_valid_pixels()
+    s2.cal_transfer_function(FLEX_DATE)
+    df_tf = s2.results_store.read_table('TF')
+    return df_tf[df_tf['site_code'] == SITE_CODE].iloc[0].to_dict()
+
+
+def dense_reference(s2: S2) -> dict:
+    # All samples of all pixels at once, straight from the band files, with the same random streams as cal_tf_uncertainty
+    rng_b04, rng_b08, rng_flox = np.random.default_rng(s2.random_seed).spawn(3)
+    zonal_stats = s2.get_zonal_stats()
+    with rio.open(s2.path_l2a_b04) as src:
+        value_b04 = (src.read(1, window=zonal_stats.window).astype(np.float32) - 1000) / 10000
+    with rio.open(s2.path_l2a_b08) as src:
+        value_b08 = (src.read(1, window=zonal_stats.window).astype(np.float32) - 1000) / 10000
+    with rio.open(os.path.join(s2.path_cache, SITE_CODE, "NIRv_ROI.tif")) as src:
+        value_tf1 = src.read(1)
+        site_row, site_col = src.index(*s2.get_site_xy())
+    bool_valid = ~np.isnan(value_tf1) & (zonal_stats.weights > 0)
+    bool_valid[site_row, site_col] = False
+    value_b04 = np.concatenate(([value_b04[site_row, site_col]], value_b04[bool_valid]))
+    value_b08 = np.concatenate(([value_b08[site_row, site_col]], value_b08[bool_valid]))
+    weights = np.concatenate(([zonal_stats.weights[site_row, site_col]], zonal_stats.weights[bool_valid])).astype(np.float32)
+    shape = (s2.num_samples, value_b04.size)
+    sample_b04 = value_b04 * (1 + s2.reflectance_noise * rng_b04.standard_normal(shape, dtype=np.float32))
+    sample_b08 = value_b08 * (1 + s2.reflectance_noise * rng_b08.standard_normal(shape, dtype=np.float32))
+    sample_tf1 = (sample_b08 - sample_b04) / (sample_b08 + sample_b04) * sample_b08
+    sample_tf2 = sample_b04 * sample_tf1 ** 2
+    dict_ratio = {'TF1': (sample_tf1 * weights).sum(axis=1, dtype=np.float64) / weights.sum(dtype=np.float64) / sample_tf1[:, 0],
+                  'TF2': (sample_tf2 * weights).sum(axis=1, dtype=np.float64) / weights.sum(dtype=np.float64) / sample_tf2[:, 0]}
+    df_flox = pd.read_csv(s2.file_flox_csv, sep=';')
+    dict_reference = {}
+    for tf_name, list_vars in TF_VARS.items():
+        value_flox = df_flox[list_vars].values[0]
+        value_flox_un = df_flox[[i + '_un' for i in list_vars]].values[0]
+        sample_sif = (value_flox + value_flox_un * rng_flox.standard_normal((s2.num_samples, len(list_vars)))) * dict_ratio[tf_name][:, np.newaxis]
+        for k, var_name in enumerate(list_vars):
+            dict_reference[var_name + '_un'] = sample_sif[:, k].std()
+            dict_reference[var_name + '_mc_mean'] = sample_sif[:, k].mean()
+            dict_reference[var_name + '_mc_p50'] = np.percentile(sample_sif[:, k], 50)
+    return dict_reference
+
+
+def test_without_noise_the_samples_are_the_transfer_functions(workspace, new_s2):
+    df_flox = pd.read_csv(os.path.join(workspace, "input", "flox_sifparms_filt_flextime_aggr_avg_allsites.csv"), sep=';')
+    df_flox[[i for i in df_flox.columns if i.endswith('_un')]] = 0
+    df_flox.to_csv(os.path.join(workspace, "input", "flox_sifparms_filt_flextime_aggr_avg_allsites.csv"), sep=';', index=False)
+    dict_tf = run_transfer_function(new_s2(bool_uncertainty=True, num_samples=50, reflectance_noise=0, random_seed=0))
+    for var_name in TF_VARS['TF1'] + TF_VARS['TF2']:
+        for suffix in ['_mc_mean', '_mc_p05', '_mc_p95']:
+            np.testing.assert_allclose(dict_tf[var_name + suffix], dict_tf[var_name], rtol=1e-5)
+        assert dict_tf[var_name + '_un'] == pytest.approx(0, abs=1e-6 * dict_tf[var_name])
+
+
+def test_chunked_samples_match_a_dense_reference(new_s2, monkeypatch):
+    # Chunks of a few samples, the last one shorter
+    monkeypatch.setattr(S2, '_MC_CHUNK_SIZE', 30000)
+    s2 = new_s2(bool_uncertainty=True, num_samples=40, random_seed=7)
+    dict_tf = run_transfer_function(s2)
+    dict_reference = dense_reference(s2)
+    for key, value in dict_reference.items():
+        np.testing.assert_allclose(dict_tf[key], value, rtol=1e-5)
+
+
+def test_default_samples_take_well_under_a_second(new_s2):
+    s2 = new_s2(num_samples=1000, random_seed=0)
+    s2.cal_valid_pixels()
+    s2.cal_transfer_function(FLEX_DATE)
+    with rio.open(os.path.join(s2.path_cache, SITE_CODE, "NIRv_ROI.tif")) as src:
+        value_tf1 = src.read(1)
+        site_row, site_col = src.index(*s2.get_site_xy())
+    with rio.open(os.path.join(s2.path_cache, SITE_CODE, "TF2_ROI.tif")) as src:
+        value_tf2 = src.read(1)
+    df_flox = pd.read_csv(s2.file_flox_csv, sep=';')
+    temp_start = time.perf_counter()
+    s2.cal_tf_uncertainty(value_tf1, value_tf2, site_row, site_col, df_flox)
+    assert time.perf_counter() - temp_start < 1
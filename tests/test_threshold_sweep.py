@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+from class_calval import FLEX
+
+S2_FILENAME = "S2A_MSIL2A_20220718T100611_N0510_R022_T32TQQ_20240717T130024.SAFE"
+# Two FLEX images of the same site on the same date, the second one mostly cloudy on S2
+DICT_JOBS = {'PRS_TD_20220717_093225.nc': 0.9, 'PRS_TD_20220717_101510.nc': 0.6}
+
+
+def save_jobs(flex: FLEX) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    list_rows = []
+    for flex_filename, valid_ratio in DICT_JOBS.items():
+        flex.results_store.upsert('S2_valid', 'IT-JDS', flex_filename, S2_FILENAME, {
+            'site_code': 'IT-JDS', 'date': '20220717', 'flex_filename': flex_filename, 's2_filename': S2_FILENAME,
+            'valid_pixels': 81 * valid_ratio, 'valid_ratio': valid_ratio})
+        flex.results_store.upsert('S2_indices', 'IT-JDS', flex_filename, S2_FILENAME, {
+            'site_code': 'IT-JDS', 'date': '20220717', 'flex_filename': flex_filename, 's2_filename': S2_FILENAME, 'ndvi_cv': 0.1, 'nirv_cv': 0.2})
+        temp_row = {'site_code': 'IT-JDS', 'date': 20220717, 'flex_filename': flex_filename, 's2_filename': S2_FILENAME}
+        for pair in FLEX._COLUMN_PAIRS_FLOX + FLEX._COLUMN_PAIRS_TF:
+            temp_row.setdefault(pair[0], rng.uniform(0.1, 1.5))
+            temp_row.setdefault(pair[1], rng.uniform(0.1, 1.5))
+        list_rows.append(temp_row)
+    df_merge = pd.DataFrame(list_rows)
+    flex.write_output(df_merge, "L2B_1P_matchup")
+    return df_merge
+
+
+def test_flex_images_of_a_site_on_the_same_date_are_separate_jobs(flex):
+    df_merge = save_jobs(flex)
+    df_flags, df_reports = flex.sweep_thresholds([0.2], [0.5, 0.8])
+    assert len(df_flags) == 4
+    assert df_flags.groupby('threshold_cloud')['pass'].sum().to_dict() == {50.0: 2, 80.0: 1}
+    df_reports = df_reports[df_reports['report'] == 'L2B_1P_validation'].set_index(['threshold_cloud', 'variable'])
+    assert (df_reports.loc[50.0, 'n'] == 2).all()
+    assert (df_reports.loc[80.0, 'n'] == 1).all()
+    assert (df_reports.loc[80.0, 'n_jobs'] == 1).all()
+    # Only the FLEX image passing the stricter cloud threshold is left
+    for pair in FLEX._COLUMN_PAIRS_FLOX:
+        var_name = pair[1].removesuffix('_flex')
+        np.testing.assert_allclose(df_reports.loc[(80.0, var_name), 'bias'], df_merge.loc[0, pair[0]] - df_merge.loc[0, pair[1]])
@@ -0,0 +1,43 @@
+import os
+
+import pandas as pd
+import xarray as xr
+
+from class_calval import S2
+from conftest import FLEX_FILENAME, SAFE_NAME, SITE_CODE, write_safe
+from time_series import TimeSeries
+
+# A second S2 image of the tile, five days later
+SAFE_NAME_2 = "S2B_MSIL2A_20220723T100559_N0510_R022_T32TQQ_20240718T091512.SAFE"
+
+
+def test_the_images_of_a_site_share_one_s2_object(flex, workspace, monkeypatch):
+    write_safe(os.path.join(workspace, "input_s2_images", SITE_CODE, SAFE_NAME_2), seed=1)
+    list_s2 = []
+    temp_init = S2.__init__
+    def init(self, *args, **kwargs):
+        list_s2.append(self)
+        temp_init(self, *args, **kwargs)
+    monkeypatch.setattr(S2, '__init__', init)
+    series = TimeSeries(flex)
+    series.run(flex.get_site_info())
+    assert len(list_s2) == 1
+    df_series = pd.read_csv(os.path.join(series.path_output, f"{SITE_CODE}_S2_time_series.csv"))
+    assert list(df_series['s2_filename']) == [SAFE_NAME, SAFE_NAME_2]
+    assert df_series['note'].isna().all()
+    # Each row holds the indices of its own image
+    assert df_series['ndvi_avg'].nunique() == 2
+    assert list(df_series['ndvi_season_n']) == [1, 2]
+
+
+def test_a_flex_image_outside_the_site_fails_once(flex, workspace, capsys):
+    path_flex = os.path.join(workspace, "input_flex_images", SITE_CODE, FLEX_FILENAME)
+    with xr.open_dataset(path_flex) as ds:
+        ds = ds.assign_coords(latitude=ds['latitude'] + 1).load()
+    ds.to_netcdf(path_flex)
+    series = TimeSeries(flex)
+    series.run(flex.get_site_info())
+    temp_out = capsys.readouterr().out
+    assert temp_out.count("None of the FLEX images of the site") == 1
+    assert "can't be read" not in temp_out
+    assert not os.path.exists(os.path.join(series.path_output, f"{SITE_CODE}_S2_time_series.csv"))
@@ -0,0 +1,102 @@
+import os
+import shutil
+import zipfile
+
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.windows import Window
+
+from class_calval import CalVal
+from conftest import GRANULE, MTD_DS, SAFE_NAME, SITE_CODE
+
+
+def write_zip(path_safe: str) -> str:
+    path_zip = path_safe + ".zip"
+    with zipfile.ZipFile(path_zip, "w", zipfile.ZIP_DEFLATED) as z:
+        for path, subdirs, files in os.walk(path_safe):
+            for name in files:
+                temp = os.path.join(path, name)
+                z.write(temp, os.path.relpath(temp, os.path.dirname(path_safe)))
+    return path_zip
+
+
+@pytest.fixture
+def safe(workspace):
+    # The S2 product of the work directory, with its zipped archive next to it
+    path_safe = os.path.join(workspace, "input_s2_images", SITE_CODE, SAFE_NAME)
+    dict_values = {}
+    for band, path in [('B04', os.path.join("IMG_DATA", "R10m", "T32TQQ_20220718T100611_B04_10m.jp2")),
+                       ('B08', os.path.join("IMG_DATA", "R10m", "T32TQQ_20220718T100611_B08_10m.jp2")),
+                       ('MSK_CLASSI_B00', os.path.join("QI_DATA", "MSK_CLASSI_B00.jp2"))]:
+        with rio.open(os.path.join(path_safe, GRANULE, path)) as src:
+            dict_values[band] = src.read()
+    return path_safe, write_zip(path_safe), dict_values
+
+
+def test_list_s2_files_of_an_archive_matches_the_folder(safe):
+    path_safe, path_zip, dict_values = safe
+    list_folder = CalVal.list_s2_files(path_safe)
+    list_zip = CalVal.list_s2_files(path_zip)
+    # The members of the archive are inside the .SAFE folder
+    assert sorted((os.path.join(SAFE_NAME, i[0]), i[2]) for i in list_folder) == sorted((i[0], i[2]) for i in list_zip)
+    for member, path, size in list_zip:
+        assert path == f"/vsizip/{os.path.abspath(path_zip)}/{member}"
+
+
+def test_bands_are_read_from_the_archive(safe):
+    path_safe, path_zip, dict_values = safe
+    path_b04 = [i[1] for i in CalVal.list_s2_files(path_zip) if i[0].endswith("_B04_10m.jp2")][0]
+    with rio.open(path_b04) as src:
+        np.testing.assert_array_equal(src.read(1), dict_values['B04'][0])
+
+
+def test_read_text_of_an_archive_member(safe):
+    path_safe, path_zip, dict_values = safe
+    dict_paths = {os.path.basename(i[0]): i[1] for i in CalVal.list_s2_files(path_zip)}
+    assert CalVal.read_text(dict_paths["MTD_DS.xml"]) == MTD_DS
+    with open(os.path.join(path_safe, GRANULE, "MTD_TL.xml")) as f:
+        assert CalVal.read_text(dict_paths["MTD_TL.xml"]) == f.read()
+
+
+def test_metadata_are_parsed_from_the_archive(safe, new_s2):
+    path_safe, path_zip, dict_values = safe
+    shutil.rmtree(path_safe)
+    s2 = new_s2(SAFE_NAME + ".zip")
+    assert s2.path_l2a_mtd_ds.startswith("/vsizip/")
+    assert s2.get_s2_l2a_metadata() == (10000, -1000, -1000)
+    assert s2.s2_crs == "EPSG:32632"
+
+
+def test_s2_paths_are_found_in_the_archive(safe, new_s2):
+    path_safe, path_zip, dict_values = safe
+    shutil.rmtree(path_safe)
+    s2 = new_s2(SAFE_NAME + ".zip")
+    list_paths = s2.get_s2_l2a_paths()
+    assert all(i.startswith(f"/vsizip/{os.path.abspath(path_zip)}/{SAFE_NAME}/") for i in list_paths)
+    assert [os.path.basename(i) for i in list_paths] == ["T32TQQ_20220718T100611_B04_10m.jp2", "T32TQQ_20220718T100611_B08_10m.jp2",
+                                                         "MSK_CLASSI_B00.jp2", "MTD_DS.xml", "MTD_TL.xml"]
+    assert (s2.path_l2a_b04, s2.path_l2a_b08, s2.path_l2a_mask) == list_paths[:3]
+
+
+def test_windows_of_the_bands_are_read_from_the_archive(safe, new_s2):
+    path_safe, path_zip, dict_values = safe
+    shutil.rmtree(path_safe)
+    s2 = new_s2(SAFE_NAME + ".zip")
+    # A window across the JP2 blocks, and the window of the ROI
+    for window in [Window(200, 230, 120, 90), s2.get_zonal_stats().window]:
+        for band in ['B04', 'B08']:
+            np.testing.assert_array_equal(s2.read_band(band, window), dict_values[band][0][window.toslices()])
+    np.testing.assert_array_equal(s2.read_band('MSK_CLASSI_B00', Window(30, 40, 25, 20)), dict_values['MSK_CLASSI_B00'][:, 40:60, 30:55])
+
+
+def test_list_s2_files_of_a_rewritten_archive(safe):
+    path_safe, path_zip, dict_values = safe
+    num_files = len(CalVal.list_s2_files(path_zip))
+    with open(os.path.join(path_safe, "manifest.safe"), "w") as f:
+        f.write("<manifest/>")
+    os.remove(path_zip)
+    write_zip(path_safe)
+    list_zip = CalVal.list_s2_files(path_zip)
+    assert len(list_zip) == num_files + 1
+    assert os.path.join(SAFE_NAME, "manifest.safe") in [i[0] for i in list_zip]
@@ -0,0 +1,221 @@
+import os
+import numpy as np
+import pandas as pd
+
+from class_calval import FLEX, S2
+from planner import Planner
+
+class RunningStats:
+
+    # Constuctor
+    def __init__(self):
+        '''
+        Running mean and standard deviation of a stream of values, updated one value at a time with Welford's algorithm, in constant
+        memory and without the loss of precision of the sums of squares. NaN values are ignored.
+        '''
+        self._n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def n(self):
+        return self._n
+
+    @property
+    def mean(self):
+        return self._mean if self._n > 0 else np.nan
+
+    @property
+    def std(self):
+        # Sample standard deviation
+        return np.sqrt(self._m2 / (self._n - 1)) if self._n > 1 else np.nan
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    def update(self, value: float) -> None:
+        '''
+        Add a value to the statistics.
+        '''
+        if value is None or np.isnan(value):
+            return
+        self._n += 1
+        temp_delta = value - self._mean
+        self._mean += temp_delta / self._n
+        self._m2 += temp_delta * (value - self._mean)
+
+class TimeSeries:
+
+    # Indices of the table
+    _INDICES = ['ndvi', 'nirv', 'tf2']
+
+    # Constuctor
+    def __init__(self, flex: FLEX, num_rows_buffer: int = 50):
+        '''
+        Time series of the NDVI, NIRvREF and TF2 statistics of the ROI of every S2 image of a site, not only the ones paired with a
+        FLEX image, to follow the homogeneity of the sites over the seasons.
+        The S2 images of a site are streamed in date order through S2.cal_roi_indices, which reads only the window of the ROI, and
+        the rows are written to the table of the site every num_rows_buffer images, so that the memory stays bounded whatever the
+        number of images. Along the series, the mean and the standard deviation of each index of the current season are updated
+        online (RunningStats), the last row of each season holding the statistics of the whole season.
+        The ROI is the one of the FLEX pixels around the site when a FLEX image of the site is available, or else a square of the
+        reference area centred on the site. The coverage of the pixels by the ROI is calculated once per S2 tile.
+        Args:
+            flex (FLEX): the FLEX class, holding the input and output paths and the FLEX catalog.
+            num_rows_buffer (int): the number of rows kept in memory before being written to the table. Defaults to 50.
+        '''
+        self._flex = flex
+        self._num_rows_buffer = num_rows_buffer
+        self._path_output = os.path.join(flex.path_output, "time_series")
+        # Floating point precision of the S2 indices
+        self.precision = "float32"
+        if not os.path.exists(self._path_output):
+            os.makedirs(self._path_output)
+
+    # ------------------------------ Private Methods ----------------------------- #
+
+    # A FLEX image covering the site, to snap the ROI on the FLEX grid, or None if the site has no FLEX image
+    def __find_flex_image(self, site_name: str, df_scenes: pd.DataFrame):
+        # The images of the folder of the site, then the ones of the flat folder, as in the plan of the jobs
+        temp_site_path_input = os.path.join(self._flex.path_flex_input, site_name)
+        temp_list_nc = []
+        if os.path.exists(temp_site_path_input):
+            temp_list_nc = sorted(i for i in os.listdir(temp_site_path_input) if i.endswith('.nc'))
+        df_site_scenes = df_scenes[df_scenes['site_code'] == site_name]
+        temp_list_nc += sorted(i for i in df_site_scenes.loc[df_site_scenes['site_folder'] == '', 'flex_filename'] if i not in temp_list_nc)
+        if not temp_list_nc:
+            return None
+        set_covered = set(df_site_scenes['path'])
+        for temp_flex_filename in temp_list_nc:
+            if self._flex.get_flex_path(site_name, temp_flex_filename) in set_covered:
+                return temp_flex_filename
+        raise ValueError(f"None of the FLEX images of the site {site_name} covers the site, so its ROI can't be found!")
+
+    # Write the buffered rows to the temporary table of the site
+    @staticmethod
+    def __flush(list_rows: list, path_table: str) -> None:
+        if list_rows:
+            pd.DataFrame(list_rows).to_csv(path_table, mode='a', header=not os.path.exists(path_table), index=False, na_rep='N/A', float_format='%.6g')
+            list_rows.clear()
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def path_output(self):
+        return self._path_output
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    @staticmethod
+    def get_season(s2_date) -> str:
+        '''
+        Get the meteorological season of a date, e.g. "2022-JJA". December belongs to the winter of the next year, e.g. "2023-DJF".
+        '''
+        temp_season = ['DJF', 'DJF', 'MAM', 'MAM', 'MAM', 'JJA', 'JJA', 'JJA', 'SON', 'SON', 'SON', 'DJF'][s2_date.month - 1]
+        return f"{s2_date.year + (s2_date.month == 12)}-{temp_season}"
+
+    def list_s2_images(self, site_name: str) -> list:
+        '''
+        List the S2 images of a site in date order, ignoring the ones without a valid sensing date in their names.
+        Returns:
+            list: the names of the S2 images.
+        '''
+        temp_path_s2_images = os.path.join(self._flex.path_s2_input, site_name)
+        if not os.path.exists(temp_path_s2_images):
+            return []
+        temp_list_s2 = [i for i in os.listdir(temp_path_s2_images) if Planner.get_s2_date(i) is not None]
+        return sorted(temp_list_s2, key=lambda i: (Planner.get_s2_date(i), i))
+
+    def run_site(self, row: pd.Series, df_scenes: pd.DataFrame) -> tuple:
+        '''
+        Calculate the time series of a site and write its table "<site>_S2_time_series.csv" in the time series output folder.
+        Args:
+            row (pd.Series): the info of the site, a row of CalVal.get_site_info.
+            df_scenes (pd.DataFrame): the FLEX images of the flat folder covering each site, from FlexCatalog.find_scenes.
+        Returns:
+            tuple: (the number of S2 images, the number of them with enough valid pixels).
+        '''
+        temp_site_name = row['Sites']
+        # Checked once for all the S2 images of the site
+        temp_flex_filename = self.__find_flex_image(temp_site_name, df_scenes)
+        path_table = os.path.join(self._path_output, f"{temp_site_name}_S2_time_series.csv")
+        # Written to a temporary file first, so that an interrupted run never leaves a partial table
+        path_table_tmp = path_table + f".{os.getpid()}.tmp"
+        if os.path.exists(path_table_tmp):
+            os.remove(path_table_tmp)
+        list_rows = []
+        dict_zonal_stats = {}
+        temp_season = None
+        dict_running = {}
+        temp_num_valid = 0
+        # A single S2 object for all the images of the site, switched from one image to the next
+        s2 = None
+        list_s2 = self.list_s2_images(temp_site_name)
+        for temp_s2_image in list_s2:
+            temp_s2_date = Planner.get_s2_date(temp_s2_image)
+            temp_row = {'site_code': temp_site_name, 's2_filename': temp_s2_image, 's2_date': temp_s2_date.strftime('%Y%m%d'),
+                        's2_time': temp_s2_image.split('_')[2].split('T')[1], 'season': self.get_season(temp_s2_date)}
+            # The seasonal statistics start again at each new season, the images being in date order
+            if temp_row['season'] != temp_season:
+                temp_season = temp_row['season']
+                dict_running = {i: RunningStats() for i in self._INDICES}
+            try:
+                if s2 is None:
+                    s2 = S2(temp_site_name, row['Latitude'], row['Longitude'], temp_s2_image, self._flex.path_main)
+                    s2.area = row['ROI']
+                    s2.cloud = row['Threshold Cloud']
+                    s2.flex_filename = temp_flex_filename
+                    s2.precision = self.precision
+                    s2.create_cache_subfolder(temp_site_name)
+                else:
+                    s2.set_s2_image(temp_s2_image)
+                # The coverage of the pixels by the ROI is the same for all images of the same tile
+                temp_tile = (temp_s2_image.split('_')[5], s2.s2_crs)
+                s2.zonal_stats = dict_zonal_stats.get(temp_tile)
+                dict_stats = s2.cal_roi_indices()
+                dict_zonal_stats[temp_tile] = s2.zonal_stats
+                temp_row.update({'valid_pixels': dict_stats['valid_pixels'], 'valid_ratio': dict_stats['valid_ratio'] * 100})
+                temp_bool_valid = dict_stats['valid_ratio'] >= s2.cloud
+                temp_row['note'] = '' if temp_bool_valid else f"The percentage of invalid pixels exceeding {s2.cloud * 100}%"
+            except Exception as e:
+                print(f"\033[91mThe S2 image {temp_s2_image} of the site {temp_site_name} can't be read: {e}\033[0m")
+                dict_stats = None
+                temp_bool_valid = False
+                temp_row.update({'valid_pixels': np.nan, 'valid_ratio': np.nan, 'note': f"Not readable: {e}"})
+            for index_name in self._INDICES:
+                temp_avg = dict_stats[index_name]['avg'] if dict_stats is not None else np.nan
+                temp_row.update({f"{index_name}_avg": temp_avg,
+                                 f"{index_name}_sd": dict_stats[index_name]['std'] if dict_stats is not None else np.nan,
+                                 f"{index_name}_cv": dict_stats[index_name]['cv'] * 100 if dict_stats is not None else np.nan})
+                # Only the images with enough valid pixels enter the seasonal statistics
+                if temp_bool_valid:
+                    dict_running[index_name].update(float(temp_avg))
+                temp_row.update({f"{index_name}_season_n": dict_running[index_name].n, f"{index_name}_season_avg": dict_running[index_name].mean,
+                                 f"{index_name}_season_sd": dict_running[index_name].std})
+            temp_num_valid += temp_bool_valid
+            list_rows.append(temp_row)
+            if len(list_rows) >= self._num_rows_buffer:
+                self.__flush(list_rows, path_table_tmp)
+        self.__flush(list_rows, path_table_tmp)
+        if os.path.exists(path_table_tmp):
+            os.replace(path_table_tmp, path_table)
+        return len(list_s2), temp_num_valid
+
+    def run(self, df_site: pd.DataFrame) -> None:
+        '''
+        Calculate the time series of all sites, one table per site.
+        Args:
+            df_site (pd.DataFrame): the info of all sites, from CalVal.get_site_info.
+        '''
+        self._flex.flex_catalog.update()
+        df_scenes = self._flex.flex_catalog.find_scenes(self._flex.site_index)
+        for index, row in df_site.iterrows():
+            print(f"Now calculating the time series of the site {row['Sites']}......")
+            try:
+                temp_num_s2, temp_num_valid = self.run_site(row, df_scenes)
+            except ValueError as e:
+                print(f"\033[91mThe time series of the site {row['Sites']} can't be calculated: {e}\033[0m")
+                continue
+            if temp_num_s2 == 0:
+                print(f"\033[91mNo S2 image found for the site {row['Sites']}!\033[0m")
+            else:
+                print(f"{temp_num_s2} S2 image(s) of the site {row['Sites']} done, {temp_num_valid} of them with enough valid pixels!")
@@ -0,0 +1,209 @@
+from functools import lru_cache
+import numpy as np
+import shapely as shp
+import rasterio as rio
+import rasterio.windows
+from affine import Affine
+
+from geodesy import Geodesy
+
+# Zonal statistics already calculated, by ROI and grid
+@lru_cache(maxsize=64)
+def _get_zonal_stats(geometry_wkb: bytes, transform: tuple, width: int, height: int):
+    return ZonalStats(shp.from_wkb(geometry_wkb), Affine(*transform), width, height)
+
+class ZonalStats:
+
+    # Constuctor
+    def __init__(self, geometry: shp.Geometry, transform: Affine, width: int, height: int):
+        '''
+        Zonal statistics of a ROI on a raster grid. The coverage fraction of every pixel by the ROI, between 0 and 1, is calculated
+        once, exactly, from the area of the intersection of the pixel with the ROI; all the rasters on the same grid, i.e. the
+        indices and the masks of an S2 image, are then cut to the window of the ROI and weighted by the same coverage fractions.
+        Unlike clipping by the centre of the pixels, the pixels crossing the edge of the ROI count for their covered area only,
+        which matters when a lat/lon ROI is rotated in the UTM grid of the S2 image.
+        Use ZonalStats.get to reuse the weights of the same grid and ROI.
+        Args:
+            geometry (shp.Geometry): the ROI, in the CRS of the grid.
+            transform (Affine): the transform of the grid.
+            width (int): the number of columns of the grid.
+            height (int): the number of rows of the grid.
+        '''
+        # Window of the pixels touching the bounds of the ROI, cut to the grid
+        temp_window = rio.windows.from_bounds(*geometry.bounds, transform=transform)
+        temp_col_off, temp_row_off = int(np.floor(temp_window.col_off)), int(np.floor(temp_window.row_off))
+        temp_window = rio.windows.Window(temp_col_off, temp_row_off, int(np.ceil(temp_window.col_off + temp_window.width)) - temp_col_off,
+                                         int(np.ceil(temp_window.row_off + temp_window.height)) - temp_row_off)
+        self._window = temp_window.intersection(rio.windows.Window(0, 0, width, height))
+        self._transform = rio.windows.transform(self._window, transform)
+        # Corners of all pixels of the window at once
+        temp_rows, temp_cols = np.mgrid[0:self._window.height, 0:self._window.width]
+        temp_x0, temp_y0 = self._transform * (temp_cols, temp_rows)
+        temp_x1, temp_y1 = self._transform * (temp_cols + 1, temp_rows + 1)
+        temp_pixels = shp.box(np.minimum(temp_x0, temp_x1), np.minimum(temp_y0, temp_y1), np.maximum(temp_x0, temp_x1), np.maximum(temp_y0, temp_y1))
+        shp.prepare(geometry)
+        self._weights = shp.area(shp.intersection(temp_pixels, geometry)) / abs(transform.a * transform.e - transform.b * transform.d)
+        self._weights = np.clip(self._weights, 0, 1)
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @property
+    def weights(self):
+        return self._weights
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    @staticmethod
+    def get(geometry: shp.Geometry, transform: Affine, width: int, height: int) -> 'ZonalStats':
+        '''
+        Get the zonal statistics of a ROI on a grid, calculating the coverage fractions only the first time the same ROI and grid are used.
+        '''
+        return _get_zonal_stats(shp.to_wkb(geometry), tuple(transform)[:6], int(width), int(height))
+
+    def clip(self, values: np.ndarray) -> np.ndarray:
+        '''
+        Cut an array of the whole grid to the window of the ROI. Arrays with several bands are cut along their last two axes.
+        '''
+        return values[..., self._window.row_off:self._window.row_off + self._window.height, self._window.col_off:self._window.col_off + self._window.width]
+
+    def cal_stats(self, values: np.ndarray) -> dict:
+        '''
+        Calculate the weighted statistics of the values of the window, ignoring NaN.
+        Args:
+            values (np.ndarray): the values of the window, from clip or read over the window.
+        Returns:
+            dict: 'n' (the number of valid pixels touching the ROI), 'weight' (their covered area in pixels), 'sum' and 'sum_sq'
+            (the weighted sums of the values and of their squares), 'avg', 'std' and 'cv'.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        temp_weights = np.where(np.isnan(values), 0, self._weights)
+        values = np.where(temp_weights > 0, values, 0)
+        temp_weight = temp_weights.sum()
+        temp_sum = (temp_weights * values).sum()
+        temp_sum_sq = (temp_weights * values ** 2).sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            temp_avg = temp_sum / temp_weight if temp_weight > 0 else np.nan
+            temp_std = np.sqrt((temp_weights * (values - temp_avg) ** 2).sum() / temp_weight) if temp_weight > 0 else np.nan
+            temp_cv = temp_std / temp_avg
+        return {'n': int(np.count_nonzero(temp_weights)), 'weight': float(temp_weight), 'sum': float(temp_sum), 'sum_sq': float(temp_sum_sq),
+                'avg': temp_avg, 'std': temp_std, 'cv': temp_cv}
+
+    def cal_valid_ratio(self, values_mask: np.ndarray) -> tuple:
+        '''
+        Calculate the valid area of the ROI from a mask of the window, where 0 is a valid pixel.
+        Returns:
+            tuple: (the valid area in pixels, the ratio of the valid area to the area of the ROI).
+        '''
+        temp_valid = float((self._weights * (np.asarray(values_mask) == 0)).sum())
+        return temp_valid, temp_valid / float(self._weights.sum())
+
+class CellStats:
+
+    # Constuctor
+    def __init__(self, zonal_stats: ZonalStats, crs, latitudes: np.ndarray, longitudes: np.ndarray, lat_step: float, lon_step: float):
+        '''
+        Zonal statistics of every cell of a lat/lon grid covering a ROI, e.g. the FLEX pixels of the ROI of a site, on the window of
+        the ROI of a raster grid, e.g. the 10 m grid of an S2 image. The coverage fraction of every pixel by every cell is calculated
+        once: the pixels whose four corners fall in the same cell belong to it with their coverage by the ROI, and only the pixels
+        crossing the edge of a cell are intersected exactly with the cells around them. All the rasters of the window are then
+        reduced to the cells at once by weighted sums, without clipping the rasters cell by cell.
+        Args:
+            zonal_stats (ZonalStats): the zonal statistics of the ROI on the raster grid.
+            crs: the CRS of the raster grid, e.g. "EPSG:32632".
+            latitudes (np.ndarray): the latitudes of the centres of the cells, ascending or descending.
+            longitudes (np.ndarray): the longitudes of the centres of the cells, ascending or descending.
+            lat_step (float): the signed spacing of the latitudes of the lat/lon grid.
+            lon_step (float): the signed spacing of the longitudes of the lat/lon grid.
+        '''
+        temp_height, temp_width = zonal_stats.weights.shape
+        num_lat, num_lon = len(latitudes), len(longitudes)
+        temp_lat_edge = float(latitudes[0]) - lat_step / 2
+        temp_lon_edge = float(longitudes[0]) - lon_step / 2
+        # Cell of the corners of all pixels of the window, -1 outside the cells
+        temp_rows, temp_cols = np.mgrid[0:temp_height + 1, 0:temp_width + 1]
+        temp_x, temp_y = zonal_stats.transform * (temp_cols, temp_rows)
+        temp_lon, temp_lat = Geodesy.transform_points(temp_x, temp_y, crs, 'EPSG:4326')
+        temp_i = np.floor((temp_lat - temp_lat_edge) / lat_step).astype(int)
+        temp_j = np.floor((temp_lon - temp_lon_edge) / lon_step).astype(int)
+        temp_label = np.where((temp_i >= 0) & (temp_i < num_lat) & (temp_j >= 0) & (temp_j < num_lon), temp_i * num_lon + temp_j, -1)
+        temp_corners = np.stack([temp_label[:-1, :-1], temp_label[:-1, 1:], temp_label[1:, :-1], temp_label[1:, 1:]])
+        # Pixels inside one cell
+        temp_inside = (temp_corners == temp_corners[0]).all(axis=0) & (temp_corners[0] >= 0)
+        self._weights = np.zeros((num_lat * num_lon, temp_height, temp_width))
+        temp_r, temp_c = np.nonzero(temp_inside)
+        self._weights[temp_corners[0][temp_r, temp_c], temp_r, temp_c] = zonal_stats.weights[temp_r, temp_c]
+        # Pixels crossing the edge of a cell, intersected with the (up to 4) cells spanned by their corners
+        temp_r, temp_c = np.nonzero(~temp_inside & (zonal_stats.weights > 0))
+        if len(temp_r) > 0:
+            temp_i_corners = np.clip(np.stack([temp_i[temp_r, temp_c], temp_i[temp_r, temp_c + 1], temp_i[temp_r + 1, temp_c], temp_i[temp_r + 1, temp_c + 1]]), 0, num_lat - 1)
+            temp_j_corners = np.clip(np.stack([temp_j[temp_r, temp_c], temp_j[temp_r, temp_c + 1], temp_j[temp_r + 1, temp_c], temp_j[temp_r + 1, temp_c + 1]]), 0, num_lon - 1)
+            temp_k, temp_cells = [], []
+            for temp_ci in [temp_i_corners.min(axis=0), temp_i_corners.max(axis=0)]:
+                for temp_cj in [temp_j_corners.min(axis=0), temp_j_corners.max(axis=0)]:
+                    temp_k.append(np.arange(len(temp_r)))
+                    temp_cells.append(temp_ci * num_lon + temp_cj)
+            temp_pairs = np.unique(np.stack([np.concatenate(temp_k), np.concatenate(temp_cells)], axis=1), axis=0)
+            # The cells as polygons in the CRS of the raster grid, from their corners
+            temp_edge_rows, temp_edge_cols = np.mgrid[0:num_lat + 1, 0:num_lon + 1]
+            temp_cell_x, temp_cell_y = Geodesy.transform_points(temp_lon_edge + temp_edge_cols * lon_step, temp_lat_edge + temp_edge_rows * lat_step, 'EPSG:4326', crs)
+            temp_cell_coords = np.stack([np.stack([temp_cell_x[:-1, :-1], temp_cell_x[:-1, 1:], temp_cell_x[1:, 1:], temp_cell_x[1:, :-1]], axis=-1),
+                                         np.stack([temp_cell_y[:-1, :-1], temp_cell_y[:-1, 1:], temp_cell_y[1:, 1:], temp_cell_y[1:, :-1]], axis=-1)], axis=-1)
+            temp_cell_polygons = shp.polygons(temp_cell_coords.reshape(num_lat * num_lon, 4, 2))
+            temp_pr, temp_pc = temp_r[temp_pairs[:, 0]], temp_c[temp_pairs[:, 0]]
+            temp_x0, temp_y0 = zonal_stats.transform * (temp_pc, temp_pr)
+            temp_x1, temp_y1 = zonal_stats.transform * (temp_pc + 1, temp_pr + 1)
+            temp_pixels = shp.box(np.minimum(temp_x0, temp_x1), np.minimum(temp_y0, temp_y1), np.maximum(temp_x0, temp_x1), np.maximum(temp_y0, temp_y1))
+            temp_area = shp.area(shp.intersection(temp_pixels, temp_cell_polygons[temp_pairs[:, 1]]))
+            temp_pixel_area = abs(zonal_stats.transform.a * zonal_stats.transform.e - zonal_stats.transform.b * zonal_stats.transform.d)
+            self._weights[temp_pairs[:, 1], temp_pr, temp_pc] = np.clip(temp_area / temp_pixel_area, 0, 1)
+        self._weights = self._weights.reshape(num_lat * num_lon, -1)
+        self._shape = (num_lat, num_lon)
+
+    # ------------------------------ Getter & Setter ----------------------------- #
+    @property
+    def weights(self):
+        return self._weights
+
+    @property
+    def shape(self):
+        return self._shape
+
+    # ------------------------------ Public Methods ------------------------------ #
+
+    def cal_stats(self, values: np.ndarray) -> dict:
+        '''
+        Calculate the weighted statistics of the values of the window in every cell, ignoring NaN, as ZonalStats.cal_stats.
+        Args:
+            values (np.ndarray): the values of the window of the ROI.
+        Returns:
+            dict: 'n', 'weight', 'sum', 'sum_sq', 'avg', 'std' and 'cv', each an array of one value per cell, in row-major order.
+        '''
+        values = np.asarray(values, dtype=np.float64).ravel()
+        temp_weights = np.where(np.isnan(values), 0, self._weights)
+        values = np.where(np.isnan(values), 0, values)
+        temp_weight = temp_weights.sum(axis=1)
+        temp_sum = temp_weights @ values
+        temp_sum_sq = temp_weights @ values ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            temp_avg = np.where(temp_weight > 0, temp_sum / temp_weight, np.nan)
+            temp_std = np.sqrt((temp_weights * (values - temp_avg[:, np.newaxis]) ** 2).sum(axis=1) / temp_weight)
+            temp_cv = temp_std / temp_avg
+        return {'n': np.count_nonzero(temp_weights, axis=1), 'weight': temp_weight, 'sum': temp_sum, 'sum_sq': temp_sum_sq,
+                'avg': temp_avg, 'std': temp_std, 'cv': temp_cv}
+
+    def cal_valid_ratio(self, values_mask: np.ndarray) -> tuple:
+        '''
+        Calculate the valid area of every cell from a mask of the window, where 0 is a valid pixel.
+        Returns:
+            tuple: (the valid area of each cell in pixels, the ratio of the valid area to the area of each cell).
+        '''
+        temp_valid = self._weights @ (np.asarray(values_mask).ravel() == 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return temp_valid, temp_valid / self._weights.sum(axis=1)